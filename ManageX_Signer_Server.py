@@ -1,7 +1,7 @@
 import threading
-from flask import Flask, request, render_template, jsonify,send_from_directory, abort
+from flask import Flask, request, render_template, jsonify,send_from_directory, abort, g, Response
 from config_loader import load_config
-from sign_pdf_pfx import sign_pdf_pfx
+from sign_pdf_pfx import sign_pdf_pfx, sign_pdf_batch, prepare_pdf_pfx, sign_hash_pfx, submit_pdf_job
 from flask_cors import CORS
 from io import BytesIO
 import requests
@@ -12,7 +12,29 @@ import os
 import random
 import time
 from werkzeug.utils import secure_filename
-from transaction_tracker import log_transaction, fix_malformed_json
+from werkzeug.exceptions import RequestEntityTooLarge
+from transaction_tracker import log_transaction, fix_malformed_json, get_transactions, get_live_stats
+from signing_executor import get_executor_stats
+from transaction_index import query_transactions
+from signed_output_store import SIGNED_PDF_FOLDER, record_access, start_store_maintenance
+from job_queue import get_job, start_job_workers
+from metrics import render_metrics, REQUESTS_TOTAL, REQUESTS_IN_FLIGHT, REQUEST_DURATION
+from credential_cache import invalidate as invalidate_credential, prewarm as prewarm_credentials
+from pkcs11_backend import prewarm_pkcs11
+from validation import PIN_FOLDER, MAX_STREAM_PDF_SIZE_BYTES
+from pdf_utils import spool_stream, spooled_size, map_spooled, PDFTooLarge
+from env import (
+    CREDENTIAL_CACHE_PREWARM,
+    MAX_STREAM_PDF_SIZE_MB,
+    STREAM_SPOOL_MEMORY_MB,
+    STREAM_DEFAULT_RESPONSE_MODE,
+    LIVE_STATS_STREAM_ENABLED,
+    LIVE_STATS_MAX_STREAMS,
+    LIVE_STATS_PUSH_INTERVAL,
+    LIVE_STATS_STREAM_MAX_SECONDS,
+    TRANSACTION_QUERY_DEFAULT_LIMIT
+)
+import json
 import shutil
 import re
 from cryptography.hazmat.primitives.serialization import pkcs12
@@ -20,8 +42,6 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 
-LOG_FILE = os.path.join(os.getcwd(), 'transaction_log.json')
-
 # Folder to save the uploaded .pfx files
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'save', 'PFX')
 PIN_UPLOAD_FOLDER = os.path.join(os.getcwd(), 'save', 'PIN')  # Folder for PIN data
@@ -41,6 +61,32 @@ app.secret_key = secure_token = os.environ.get('FLASK_SECRET_KEY', ''.join(rando
 # Enable CORS support for all origins
 CORS(app, resources={r"/*": {"origins": ["http://*", "https://*"]}}, supports_credentials=True)
 
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUESTS_TOTAL.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_DURATION.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    if 'request_started' in g:
+        REQUESTS_IN_FLIGHT.dec()
+
+
+# Prometheus scrape endpoint
+@app.route('/metrics')
+def serve_metrics():
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # Allowed file extension for .pfx files
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() == 'pfx'
@@ -50,7 +96,7 @@ def serve_signed_pdf(filename):
     """Serve the signed PDF from the directory where signed PDFs are stored."""
     
     # Get the absolute path to the signed_pdf directory inside the app's directory
-    signed_pdfs_dir = os.path.join(os.path.abspath(os.getcwd()), 'signed_pdfs')
+    signed_pdfs_dir = os.path.join(os.path.abspath(os.getcwd()), SIGNED_PDF_FOLDER)
     
     # Debug: Print the path to check if it's correct
     print(f"Signed PDFs directory: {signed_pdfs_dir}")
@@ -66,8 +112,11 @@ def serve_signed_pdf(filename):
         print(f"File not found: {file_path}")
         abort(404, description=f"File '{filename}' not found")
     
-    # Send the file from the specified directory
-    return send_from_directory(signed_pdfs_dir, filename)
+    # Served files are evicted last
+    record_access(filename)
+
+    # Send the file from the specified directory (supports Range / conditional requests)
+    return send_from_directory(signed_pdfs_dir, filename, mimetype='application/pdf', conditional=True)
 
 # Serve the signed PDF
 @app.route('/signed_pdf/<filename>')
@@ -82,16 +131,82 @@ def page_not_found(e):
 # Default route that shows the status of the service
 @app.route('/')
 def home():
-    return render_template('status.html')
+    return render_template('status.html', live_stats_stream=LIVE_STATS_STREAM_ENABLED)
 
-# Route to serve the transaction_log.json
+# Route to serve the transaction log (read back from the journal)
 @app.route('/transaction_log.json')
 def serve_transaction_log():
-    return send_from_directory(os.getcwd(), 'transaction_log.json')
+    return jsonify(get_transactions())
+
+
+# Running transaction counters for the status page (cheap; does not read the log)
+@app.route('/api/stats')
+def serve_live_stats():
+    since = request.args.get('since', type=int)
+    return jsonify(get_live_stats(since_seq=since))
+
+
+# Open live-stats streams; each one holds a server thread for up to LIVE_STATS_STREAM_MAX_SECONDS
+_live_streams = threading.BoundedSemaphore(LIVE_STATS_MAX_STREAMS)
+
+
+# Server-sent events (opt-in): a full snapshot first, then only the records added since the last event
+@app.route('/api/stats/stream')
+def stream_live_stats():
+    if not LIVE_STATS_STREAM_ENABLED:
+        abort(404)
+    if not _live_streams.acquire(blocking=False):
+        return jsonify({'error': 'Too many live stats streams. Poll /api/stats instead.'}), 503, {'Retry-After': '60'}
+
+    def generate():
+        stats = get_live_stats()
+        last_seq = stats['seq']
+        yield f"id: {last_seq}\nevent: stats\ndata: {json.dumps(stats)}\n\n"
+
+        started = time.monotonic()
+        last_sent = started
+        while time.monotonic() - started < LIVE_STATS_STREAM_MAX_SECONDS:
+            time.sleep(LIVE_STATS_PUSH_INTERVAL)
+            stats = get_live_stats(since_seq=last_seq)
+            if stats['seq'] != last_seq:
+                last_seq = stats['seq']
+                last_sent = time.monotonic()
+                yield f"id: {last_seq}\nevent: stats\ndata: {json.dumps(stats)}\n\n"
+            elif time.monotonic() - last_sent >= 15:
+                # Keep idle connections open through proxies
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs when the response is closed: after the stream ends, when the client disconnects,
+    # and also when the body is never iterated (e.g. a HEAD request)
+    response.call_on_close(_live_streams.release)
+    return response
+
+
+# Transaction history: newest first, paginated with next_cursor, served from the SQLite index
+@app.route('/api/transactions')
+def serve_transactions():
+    try:
+        return jsonify(query_transactions(
+            status=request.args.get('status'),
+            txn_prefix=request.args.get('txn'),
+            reason=request.args.get('reason'),
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            cursor=request.args.get('cursor'),
+            limit=request.args.get('limit', TRANSACTION_QUERY_DEFAULT_LIMIT),
+        ))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+
 
+# Signing executor counters and per-job timing, used to size the signing pool
+@app.route('/api/executor')
+def serve_executor_stats():
+    return jsonify(get_executor_stats())
 
-# A mock list to store transaction_ids and prevent duplicates (in a real scenario, you would use a database)
-existing_transaction_ids = set()
 
 @app.route('/sign/api/v1.0/postjson', methods=['POST'])
 def handle_signing_request_v1():
@@ -116,6 +231,166 @@ def handle_signing_request_v1():
         return {"error": "An internal server error occurred"}, 500
 
 
+# Metadata of a streamed upload: form field name -> request header
+STREAM_FIELDS = {
+    'transaction_id': 'X-Transaction-Id',
+    'timestamp': 'X-Timestamp',
+    'SN': 'X-SN',
+    'page': 'X-Page',
+    'coordinates': 'X-Coordinates',
+    'invisiblesign': 'X-Invisible-Sign',
+    'search_text': 'X-Search-Text',
+    'search_position': 'X-Search-Position',
+    'search_occurrence': 'X-Search-Occurrence',
+    'response_mode': 'X-Response-Mode',
+}
+
+# Fields above that belong in the request's pdf options
+STREAM_PDF_FIELDS = ('page', 'coordinates', 'invisiblesign', 'search_text', 'search_position', 'search_occurrence')
+
+# Room for the form fields and part headers of a multipart upload
+STREAM_FORM_OVERHEAD_BYTES = 64 * 1024
+
+
+@app.route('/sign/api/v1.0/postpdf', methods=['POST'])
+def handle_streaming_signing_request_v1():
+    """Sign a PDF sent as a raw application/pdf body or as the `file` part of a multipart form."""
+    txn_id = None
+    spool = None
+    try:
+        # Caps what Werkzeug reads (and spools to disk) for a multipart form, also for a chunked
+        # body without Content-Length; a larger body raises RequestEntityTooLarge
+        request.max_content_length = MAX_STREAM_PDF_SIZE_BYTES + STREAM_FORM_OVERHEAD_BYTES
+
+        # Metadata comes from form fields (multipart) or X-* headers (raw body)
+        fields = {}
+        for field, header in STREAM_FIELDS.items():
+            value = request.form.get(field) if request.mimetype == 'multipart/form-data' else None
+            fields[field] = value if value is not None else request.headers.get(header)
+
+        txn_id = fields['transaction_id']
+        if not txn_id:
+            return {"error": "Transaction ID is missing"}, 400
+
+        if request.mimetype == 'multipart/form-data':
+            # Werkzeug has already spooled the file part (to disk when large); it is used as is
+            file_key = next((key for key in request.files if key.lower() == 'file'), None)
+            if not file_key:
+                return {"error": "No file part"}, 400
+            spool = request.files[file_key].stream
+            if spooled_size(spool) > MAX_STREAM_PDF_SIZE_BYTES:
+                log_transaction(txn_id, "failure", f"PDF size exceeds {MAX_STREAM_PDF_SIZE_MB}MB")
+                return {"error": f"PDF size exceeds {MAX_STREAM_PDF_SIZE_MB}MB."}, 413
+        elif request.mimetype == 'application/pdf':
+            try:
+                spool = spool_stream(request.stream, MAX_STREAM_PDF_SIZE_BYTES, STREAM_SPOOL_MEMORY_MB * 1024 * 1024)
+            except PDFTooLarge:
+                log_transaction(txn_id, "failure", f"PDF size exceeds {MAX_STREAM_PDF_SIZE_MB}MB")
+                return {"error": f"PDF size exceeds {MAX_STREAM_PDF_SIZE_MB}MB."}, 413
+        else:
+            return {"error": "Content-Type must be application/pdf or multipart/form-data"}, 415
+
+        request_data = {
+            "request": {
+                "command": "managexserversign",
+                "timestamp": fields['timestamp'],
+                "transaction_id": txn_id,
+                "pfx": {"SN": fields['SN']},
+                "response_mode": fields['response_mode'] or STREAM_DEFAULT_RESPONSE_MODE,
+                "pdf": {
+                    key: fields[key] for key in STREAM_PDF_FIELDS if fields[key] is not None
+                },
+            }
+        }
+
+        # Sign straight from the spooled body (no base64 round trip, no copy of a large upload)
+        response = sign_pdf_pfx(request_data, txn_id, pdf_data=map_spooled(spool, STREAM_SPOOL_MEMORY_MB * 1024 * 1024))
+
+        if not response:
+            log_transaction(txn_id, "failure", "Certificate Not Found")
+            return {"error": "An error occurred during the signing process. Certificate Not Found."}, 500
+
+        return response
+    except RequestEntityTooLarge:
+        return {"error": f"PDF size exceeds {MAX_STREAM_PDF_SIZE_MB}MB."}, 413
+    except Exception as e:
+        log_transaction(txn_id, "failure", f"Internal server error: {str(e)}")
+        return {"error": "An internal server error occurred"}, 500
+    finally:
+        if spool is not None:
+            spool.close()
+
+
+@app.route('/sign/api/v1.0/batch', methods=['POST'])
+def handle_batch_signing_request_v1():
+    try:
+        # Parse the request data
+        request_data = request.get_json()
+        if not isinstance(request_data, dict):
+            return {"error": "Invalid JSON body"}, 400
+
+        # Sign every document of the batch with the shared credential
+        return sign_pdf_batch(request_data)
+    except Exception as e:
+        return {"error": "An internal server error occurred"}, 500
+
+
+@app.route('/sign/api/v1.0/jobs', methods=['POST'])
+def handle_signing_job_request_v1():
+    try:
+        # Parse the request data
+        request_data = request.get_json()
+        txn_id = request_data.get('request', {}).get('transaction_id')
+        if not txn_id:
+            return {"error": "Transaction ID is missing"}, 400
+
+        # Queue the request and answer with its job ID
+        return submit_pdf_job(request_data, txn_id)
+    except Exception as e:
+        log_transaction(txn_id, "failure", f"Internal server error: {str(e)}")
+        return {"error": "An internal server error occurred"}, 500
+
+
+@app.route('/jobs/<job_id>')
+def serve_job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return {"error": "Job not found"}, 404
+    return jsonify(job)
+
+
+@app.route('/sign/api/v1.0/prepare', methods=['POST'])
+def handle_prepare_request_v1():
+    try:
+        # Parse the request data
+        request_data = request.get_json()
+        txn_id = request_data.get('request', {}).get('transaction_id')
+        if not txn_id:
+            return {"error": "Transaction ID is missing"}, 400
+
+        # Build the signature update and return its digest
+        return prepare_pdf_pfx(request_data, txn_id)
+    except Exception as e:
+        log_transaction(txn_id, "failure", f"Internal server error: {str(e)}")
+        return {"error": "An internal server error occurred"}, 500
+
+
+@app.route('/sign/api/v1.0/signhash', methods=['POST'])
+def handle_sign_hash_request_v1():
+    try:
+        # Parse the request data
+        request_data = request.get_json()
+        txn_id = request_data.get('request', {}).get('transaction_id')
+        if not txn_id:
+            return {"error": "Transaction ID is missing"}, 400
+
+        # Sign the digest and return the CMS signature
+        return sign_hash_pfx(request_data, txn_id)
+    except Exception as e:
+        log_transaction(txn_id, "failure", f"Internal server error: {str(e)}")
+        return {"error": "An internal server error occurred"}, 500
+
+
 @app.route('/upload', methods=['POST'])
 def upload_pfx_file():
     try:
@@ -179,6 +454,9 @@ def upload_pfx_file():
                 # Save the PIN information to the .txt file
                 with open(pin_file_path, 'w') as pin_file:
                     pin_file.write(pin_content)  # Write the content to the file
+
+                # Drop any cached credential for this SN so the new PFX is used
+                invalidate_credential(hex_serial_number)
                 
                 # Remove the .pfx extension from the filename
                 file_name_without_extension = filename.rsplit('.', 1)[0]
@@ -220,49 +498,6 @@ def load_pfx(file_path, password):
         raise ValueError(f"Error loading PFX file: {str(e)}")
 
 
-    
-def get_folder_size(folder_path):
-    total_size = 0
-    # Walk through the folder and sum up the sizes of files
-    for dirpath, dirnames, filenames in os.walk(folder_path):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            total_size += os.path.getsize(file_path)
-    return total_size
-
-def delete_files_in_folder(folder_path):
-    """Deletes all files in the folder efficiently."""
-    for dirpath, dirnames, filenames in os.walk(folder_path, topdown=False):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            os.remove(file_path)  # Remove the file
-
-def monitor_folder(folder_path, max_size_mb=100, check_interval=10):
-    max_size_bytes = max_size_mb * 1024 * 1024  # max size in bytes
-
-    while True:
-        folder_size = get_folder_size(folder_path)
-        
-        # If the folder size exceeds the limit, empty the folder
-        if folder_size > max_size_bytes:
-            print(f"Folder size exceeded {max_size_mb} MB. Emptying the folder...")
-            delete_files_in_folder(folder_path)
-            print(f"Folder has been emptied. Current size: 0 MB.")
-        
-        # Sleep for a longer period before checking again
-        time.sleep(check_interval)  # Adjust the time interval as needed
-
-def start_monitoring(folder_path, max_size_mb=100):
-    # Running the monitoring function in a separate thread
-    monitoring_thread = threading.Thread(target=monitor_folder, args=(folder_path, max_size_mb))
-    monitoring_thread.daemon = True
-    monitoring_thread.start()
-
-# Folder path (change this to your actual folder path)
-folder_path = 'signed_pdfs'
-
-
-
 # Function to run the Flask app
 def run_flask_app():
     config = load_config()  # Load config
@@ -273,18 +508,30 @@ def run_flask_app():
 
 if __name__ == '__main__':
 
-    # Fix the transaction log file
-    fixed_logs = fix_malformed_json(LOG_FILE)
-    
-    start_monitoring(folder_path, max_size_mb=100)
+    # Recover the tail of the transaction journal after an unclean shutdown
+    fix_malformed_json()
+
+    # Track signed_pdfs incrementally and evict old files by size / TTL
+    start_store_maintenance()
 
     # Load config from file
     config = load_config()
 
-    # Use the config values, fallback to defaults if not present
-    host = config.get('FLASK_HOST', '0.0.0.0')
-    port = config.get('FLASK_PORT', 5020)
+    if config.get('SERVER_MODE', 'development') == 'production':
+        # Multi-worker WSGI server; it warms credentials itself before forking
+        from production_server import run_production_server
+        run_production_server(app, config)
+    else:
+        # Decrypt the uploaded PFX credentials ahead of the first signing request
+        if CREDENTIAL_CACHE_PREWARM:
+            threading.Thread(target=prewarm_credentials, args=(PIN_FOLDER,), daemon=True).start()
+
+        # Open and log in the session pools of the PKCS#11 signers
+        threading.Thread(target=prewarm_pkcs11, daemon=True).start()
+
+        # Run queued signing jobs, including those left over from the last run
+        start_job_workers()
 
-    # Run Flask in a separate thread
-    flask_thread = threading.Thread(target=run_flask_app)
-    flask_thread.start()
+        # Run Flask in a separate thread
+        flask_thread = threading.Thread(target=run_flask_app)
+        flask_thread.start()
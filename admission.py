@@ -0,0 +1,327 @@
+# admission.py
+"""
+Per-signer admission control, keyed by the request's pfx.SN.
+
+Every SN has a token bucket (SN_RATE_LIMIT requests per second, SN_RATE_BURST at once,
+overridable per SN in SN_QUOTAS in managex_signer.config); a request that finds it empty
+is answered 429 with Retry-After before any work is done.
+
+Admitted requests then share the signing workers through a weighted fair queue: while
+all ADMISSION_CONCURRENCY slots are busy, waiting requests are served in order of their
+virtual finish time, which grows with the size of each SN's earlier requests divided by
+its weight. One SN sending many large documents therefore only delays its own requests,
+and a small signer's request waits behind at most one request of every other SN.
+
+Buckets are kept in SQLite and shared by every worker process (RATE_LIMIT_BACKEND);
+fair queues live in each worker process.
+"""
+import os
+import math
+import heapq
+import time
+import sqlite3
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from config_loader import load_config
+from metrics import Counter, Gauge, Histogram
+from signing_executor import SigningExecutorBusy
+from env import (
+    ADMISSION_CONCURRENCY,
+    ADMISSION_MAX_WAITING,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_MAX_TRACKED_SNS,
+    ADMISSION_COST_BYTES,
+    RATE_LIMIT_BACKEND,
+    SIGNING_WORKERS
+)
+
+ADMISSION_REJECTED = Counter('mx_admission_rejected_total', 'Requests refused by admission control, by reason', ('reason',))
+ADMISSION_WAIT = Histogram('mx_admission_wait_seconds', 'Time spent waiting for a fair-queue signing slot')
+
+RATE_LIMIT_DB_FILE = os.path.join(os.getcwd(), 'rate_limits.db')
+
+
+# Quotas are read from managex_signer.config on first use
+_settings = {'config': None}
+_settings_lock = threading.Lock()
+
+
+def _config():
+    with _settings_lock:
+        if _settings['config'] is None:
+            try:
+                config = load_config()
+                # SNs are compared in lowercase, as in request validation
+                config['SN_QUOTAS'] = {str(SN).lower(): quota for SN, quota in (config.get('SN_QUOTAS') or {}).items()}
+                _settings['config'] = config
+            except Exception as e:
+                print(f"Error loading rate limit settings: {e}")
+                _settings['config'] = {}
+        return _settings['config']
+
+
+def get_quota(SN):
+    """Rate (requests per second, 0 for unlimited), burst and weight for SN."""
+    config = _config()
+    quota = {
+        'rate': config.get('SN_RATE_LIMIT', 0),
+        'burst': config.get('SN_RATE_BURST', 10),
+        'weight': config.get('SN_WEIGHT', 1),
+    }
+    quota.update((config.get('SN_QUOTAS') or {}).get(SN.lower()) or {})
+    return quota
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        """Take cost tokens; returns 0 when granted, else the seconds until they are available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class MemoryRateLimiter:
+    """Per-process token buckets by SN, least recently used dropped beyond ADMISSION_MAX_TRACKED_SNS."""
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, SN, rate, burst, cost=1):
+        with self._lock:
+            bucket = self._buckets.get(SN)
+            if bucket is None or (bucket.rate, bucket.burst) != (rate, burst):
+                bucket = self._buckets[SN] = TokenBucket(rate, burst)
+            self._buckets.move_to_end(SN)
+            while len(self._buckets) > ADMISSION_MAX_TRACKED_SNS:
+                self._buckets.popitem(last=False)
+            return bucket.take(cost)
+
+
+class SQLiteRateLimiter:
+    """
+    Token buckets by SN on disk, shared by every worker process.
+
+    Each take is one write transaction; a row is dropped once its bucket would be full
+    again, since a missing row means a full bucket.
+    """
+
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._purged = 0
+
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets ("
+            "SN TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL) WITHOUT ROWID"
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS rate_buckets_full_at ON rate_buckets (full_at)")
+
+    def _connection(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def take(self, SN, rate, burst, cost=1):
+        # Wall-clock time, since the monotonic clock is not comparable across processes
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if now - self._purged >= self.PURGE_INTERVAL:
+                self._purged = now
+                connection.execute("DELETE FROM rate_buckets WHERE full_at <= ?", (now,))
+
+            row = connection.execute("SELECT tokens, updated FROM rate_buckets WHERE SN = ?", (SN,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0
+            else:
+                wait = (cost - tokens) / rate
+            connection.execute(
+                "INSERT OR REPLACE INTO rate_buckets (SN, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                (SN, tokens, now, now + (burst - tokens) / rate))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+
+def create_rate_limiter(backend=RATE_LIMIT_BACKEND):
+    if backend == 'sqlite':
+        return SQLiteRateLimiter(RATE_LIMIT_DB_FILE)
+    return MemoryRateLimiter()
+
+
+# Token buckets used by check_rate_limit
+rate_limiter = create_rate_limiter()
+
+
+def check_rate_limit(request_data, txn_id, cost=1):
+    """
+    Take cost tokens from the bucket of the request's pfx.SN.
+
+    Returns:
+        dict: {'success': True}, or an error with status 429 and retry_after seconds.
+    """
+    SN = request_data.get('request', {}).get('pfx', {}).get('SN')
+    if not SN:
+        return {'success': True}  # Reported as a missing SN by the request validation
+    SN = str(SN).lower()
+
+    quota = get_quota(SN)
+    if not quota['rate']:
+        return {'success': True}
+
+    # A request larger than the burst could never be admitted; let it through once the bucket is full
+    cost = min(cost, quota['burst'])
+    try:
+        wait = rate_limiter.take(SN, quota['rate'], quota['burst'], cost)
+    except sqlite3.Error as e:
+        # Admit rather than refuse every request while the store is unavailable
+        print(f"Error checking rate limit for {SN}: {e}")
+        wait = 0
+
+    if wait:
+        ADMISSION_REJECTED.inc(reason='rate_limit')
+        retry_after = max(1, math.ceil(wait))
+        # Not logged per transaction: a client over its limit would flood the journal and webhooks
+        return {'error': f'Rate limit exceeded for this certificate. Retry after {retry_after} second(s).',
+                'status': 429, 'retry_after': retry_after}
+    return {'success': True}
+
+
+class _Waiter:
+    __slots__ = ('event', 'SN', 'start', 'granted')
+
+    def __init__(self, SN, start):
+        self.event = threading.Event()
+        self.SN = SN
+        self.start = start
+        self.granted = False
+
+
+class FairScheduler:
+    """
+    Start-time weighted fair queuing over a fixed number of slots.
+
+    Each request gets a finish tag of max(virtual time, the SN's last finish tag) plus
+    cost / weight; free slots go to the waiting request with the smallest tag.
+    """
+
+    def __init__(self, slots, max_waiting):
+        self._lock = threading.Lock()
+        self._free = slots
+        self._max_waiting = max_waiting
+        self._virtual_time = 0.0
+        self._last_finish = {}  # SN -> finish tag of its latest request
+        self._waiting = []  # Heap of (finish tag, sequence, waiter)
+        self._sequence = itertools.count()
+
+    def acquire(self, SN, cost=1.0, weight=1.0, timeout=None):
+        """
+        Wait for a slot.
+
+        Raises:
+            SigningExecutorBusy: If too many requests are waiting or none was free in time.
+        """
+        with self._lock:
+            self._forget_finished()
+            start = max(self._virtual_time, self._last_finish.get(SN, 0.0))
+            finish = start + cost / max(weight, 0.001)
+            if self._free and not self._waiting:
+                self._free -= 1
+                self._virtual_time = start
+                self._last_finish[SN] = finish
+                return
+            if len(self._waiting) >= self._max_waiting:
+                ADMISSION_REJECTED.inc(reason='queue_full')
+                raise SigningExecutorBusy()
+            self._last_finish[SN] = finish
+            waiter = _Waiter(SN, start)
+            heapq.heappush(self._waiting, (finish, next(self._sequence), waiter))
+
+        started = time.perf_counter()
+        waiter.event.wait(timeout)
+        with self._lock:
+            if not waiter.granted:
+                self._withdraw(waiter, finish)
+                ADMISSION_REJECTED.inc(reason='timeout')
+                raise SigningExecutorBusy()
+        ADMISSION_WAIT.observe(time.perf_counter() - started)
+
+    def _withdraw(self, waiter, finish):
+        """
+        Take a timed-out waiter out of the queue and give back the virtual time it was
+        charged, so requests of the same SN queued after it (and its next ones) move up.
+        """
+        charged = finish - waiter.start
+        waiting = []
+        for tag, sequence, other in self._waiting:
+            if other is waiter:
+                continue
+            if other.SN == waiter.SN and tag > finish:
+                tag -= charged
+                other.start -= charged
+            waiting.append((tag, sequence, other))
+        heapq.heapify(waiting)
+        self._waiting = waiting
+        if waiter.SN in self._last_finish:
+            self._last_finish[waiter.SN] -= charged
+
+    def release(self):
+        with self._lock:
+            if self._waiting:
+                _, _, waiter = heapq.heappop(self._waiting)
+                waiter.granted = True
+                self._virtual_time = waiter.start
+                waiter.event.set()
+                return
+            self._free += 1
+
+    def _forget_finished(self):
+        # Tags at or below the virtual time no longer hold an SN back
+        if len(self._last_finish) > ADMISSION_MAX_TRACKED_SNS:
+            for SN in [SN for SN, tag in self._last_finish.items() if tag <= self._virtual_time]:
+                del self._last_finish[SN]
+
+    def waiting(self):
+        with self._lock:
+            return len(self._waiting)
+
+
+scheduler = FairScheduler(ADMISSION_CONCURRENCY or SIGNING_WORKERS or os.cpu_count() or 1, ADMISSION_MAX_WAITING)
+
+
+@contextmanager
+def fair_slot(SN, size_bytes=0):
+    """Hold a fair-queue signing slot for SN; the cost of a request grows with the PDF size."""
+    scheduler.acquire(SN, 1 + size_bytes / ADMISSION_COST_BYTES, get_quota(SN)['weight'], ADMISSION_MAX_WAIT)
+    try:
+        yield
+    finally:
+        scheduler.release()
+
+
+Gauge('mx_admission_waiting', 'Requests waiting for a fair-queue signing slot', function=scheduler.waiting)
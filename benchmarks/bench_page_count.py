@@ -0,0 +1,83 @@
+# bench_page_count.py
+"""
+Compare the PyMuPDF page-count probe (pdf_utils.probe_pdf) with the old full
+PyPDF2 parse on generated multi-hundred-page PDFs.
+
+Run from the repository root:
+    python benchmarks/bench_page_count.py --pages 100 500 1000 --repeat 5
+"""
+import io
+import os
+import sys
+import time
+import json
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz  # PyMuPDF
+import PyPDF2
+from pdf_utils import probe_pdf
+
+
+def make_pdf(pages, lines_per_page=40):
+    """Build a text PDF with the given number of pages."""
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        for line in range(lines_per_page):
+            page.insert_text((50, 50 + line * 18), f"Page {number + 1} line {line + 1}: benchmark filler text")
+    data = doc.tobytes(garbage=0, deflate=True)
+    doc.close()
+    return data
+
+
+def pypdf2_page_count(pdf_data):
+    return len(PyPDF2.PdfReader(io.BytesIO(pdf_data)).pages)
+
+
+def probe_page_count(pdf_data):
+    return probe_pdf(pdf_data)['page_count']
+
+
+def time_call(function, pdf_data, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(pdf_data)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 500, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'pages':>6} {'size KB':>9} {'PyPDF2 ms':>10} {'probe ms':>9} {'speedup':>8}")
+    for pages in args.pages:
+        pdf_data = make_pdf(pages)
+        assert pypdf2_page_count(pdf_data) == probe_page_count(pdf_data) == pages
+
+        pypdf2_seconds = time_call(pypdf2_page_count, pdf_data, args.repeat)
+        probe_seconds = time_call(probe_page_count, pdf_data, args.repeat)
+        results.append({
+            'pages': pages,
+            'size_bytes': len(pdf_data),
+            'pypdf2_seconds': pypdf2_seconds,
+            'probe_seconds': probe_seconds,
+        })
+        print(f"{pages:>6} {len(pdf_data) / 1024:>9.0f} {pypdf2_seconds * 1000:>10.2f} "
+              f"{probe_seconds * 1000:>9.2f} {pypdf2_seconds / probe_seconds:>7.1f}x")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+# bench_stages.py
+"""
+Micro-benchmarks for each stage of the signing pipeline, on generated fixture PDFs
+(1 to 1000 pages, 10 KB to 50 MB) and a self-signed test PFX.
+
+Every stage is timed on its own: base64 validation, page count, PFX loading, the plain
+endesive pdf.cms.sign, the server's sign_pdf, writing the response and logging a
+transaction into a journal that already holds --log-records records. The server
+modules run in a throwaway working directory, never against the repository's state.
+
+Run from the repository root:
+    python benchmarks/bench_stages.py --repeat 5 --output stages.json
+    python benchmarks/bench_stages.py --fixture 1:10 1000:0 --log-records 50000
+"""
+import os
+import json
+import time
+import uuid
+import base64
+import argparse
+import datetime
+
+from fixtures import (
+    DEFAULT_PDF_FIXTURES,
+    enter_workspace,
+    make_pdf,
+    make_pfx,
+    fixture_name,
+    install_pfx,
+    sign_request
+)
+from report import summarize, run_metadata, write_results
+
+SIGNATURE_BOX = (50, 50, 250, 110)
+
+
+def time_samples(function, repeat, *args):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def parse_fixture(value):
+    """PAGES:SIZE_KB, with 0 for a plain text PDF of that many pages."""
+    pages, size_kb = value.split(':')
+    return int(pages), int(size_kb) * 1024 or None
+
+
+def prefill_journal(records):
+    """Write records into the journal of the working directory before the tracker is imported."""
+    journal_dir = os.path.join(os.getcwd(), 'transaction_journal')
+    os.makedirs(journal_dir, exist_ok=True)
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with open(os.path.join(journal_dir, 'segment-000001.jsonl'), 'w') as f:
+        for number in range(records):
+            f.write(json.dumps({
+                "transaction_id": f"prefill-{number}",
+                "status": "success" if number % 10 else "failure",
+                "reason": "PDF signed successfully",
+                "timestamp": timestamp,
+            }) + '\n')
+
+
+def bench_logging(repeat, records):
+    from transaction_tracker import log_transaction, flush_log, get_transaction, count_transactions
+
+    results = {}
+    started = time.perf_counter()
+    total = count_transactions()
+    results['journal_index_catch_up'] = summarize([time.perf_counter() - started])
+    results['journal_index_catch_up']['records'] = total
+
+    # Enqueue cost on the request thread
+    samples = time_samples(lambda: log_transaction(f"bench-{uuid.uuid4().hex}", "success",
+                                                   "PDF signed successfully", notify=False), repeat * 100)
+    results['log_transaction'] = summarize(samples)
+
+    # Enqueue plus the writer's append and fsync, per record
+    def logged_and_flushed():
+        log_transaction(f"bench-{uuid.uuid4().hex}", "success", "PDF signed successfully", notify=False)
+        flush_log()
+    results['log_transaction_flushed'] = summarize(time_samples(logged_and_flushed, repeat * 10))
+
+    results['get_transaction'] = summarize(time_samples(get_transaction, repeat * 100, f"prefill-{records // 2}"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixture', type=parse_fixture, nargs='+', metavar='PAGES:SIZE_KB',
+                        default=DEFAULT_PDF_FIXTURES, help='PDFs to generate (default: 1 page/10 KB up to 50 MB)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--log-records', type=int, default=200000, help='Records already in the journal')
+    parser.add_argument('--key-size', type=int, default=2048)
+    parser.add_argument('--workdir', help='Working directory for the server state (default: a new temp dir)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    workdir = enter_workspace(args.workdir)
+    prefill_journal(args.log_records)
+
+    # Server modules are imported only now, inside the working directory
+    from endesive import pdf
+    from validation import is_valid_pdf_base64
+    from pdf_utils import get_pdf_page_count
+    from signer import load_pfx
+    from signature_utils import prepare_signature_dict, sign_pdf
+    from pdf_processing import save_signed_pdf_and_send_response
+    from ManageX_Signer_Server import app
+
+    pin = "1234"
+    pfx_bytes, SN = make_pfx(pin, key_size=args.key_size)
+    pfx_path = install_pfx(pfx_bytes, SN, pin, os.path.join(workdir, 'save', 'PFX'), os.path.join(workdir, 'save', 'PIN'))
+
+    results = {}
+    results['load_pfx'] = summarize(time_samples(load_pfx, args.repeat, pfx_path, pin, 'bench'))
+    p12pk, p12pc, p12oc = load_pfx(pfx_path, pin, 'bench')
+
+    for pages, size_bytes in args.fixture:
+        name = fixture_name(pages, size_bytes)
+        pdf_data = make_pdf(pages, size_bytes)
+        pdf_base64 = base64.b64encode(pdf_data).decode('ascii')
+        print(f"{name}: {len(pdf_data) / 1024:.0f} KB")
+
+        results[f'is_valid_pdf_base64[{name}]'] = summarize(time_samples(is_valid_pdf_base64, args.repeat, pdf_base64))
+        results[f'get_pdf_page_count[{name}]'] = summarize(time_samples(get_pdf_page_count, args.repeat, pdf_data))
+
+        dct = prepare_signature_dict('bench', 0, "Digitally Signed by: Benchmark Signer", SIGNATURE_BOX,
+                                     cn="Benchmark Signer")
+        plain_dct = {key: value for key, value in dct.items() if key != 'appearance'}
+        results[f'pdf.cms.sign[{name}]'] = summarize(time_samples(
+            pdf.cms.sign, args.repeat, pdf_data, plain_dct, p12pk, p12pc, p12oc, 'sha256'))
+        results[f'sign_pdf[{name}]'] = summarize(time_samples(
+            sign_pdf, args.repeat, pdf_data, dct, p12pk, p12pc, p12oc))
+
+        signed_pdf_data = sign_pdf(pdf_data, dct, p12pk, p12pc, p12oc)
+        for mode in ('url', 'base64'):
+            def save_and_respond():
+                txn_id = f"bench-{uuid.uuid4().hex}"
+                with app.app_context():
+                    save_signed_pdf_and_send_response(pdf_data, signed_pdf_data, txn_id, "Benchmark Signer",
+                                                      sign_request(SN, b'', txn_id, response_mode=mode))
+            results[f'save_signed_pdf_and_send_response[{mode},{name}]'] = summarize(
+                time_samples(save_and_respond, args.repeat))
+
+    results.update(bench_logging(args.repeat, args.log_records))
+
+    print(f"\n{'stage':<58} {'n':>5} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for name, summary in results.items():
+        print(f"{name:<58} {summary['count']:>5} {summary['p50_ms']:>10.2f} "
+              f"{summary['p95_ms']:>10.2f} {summary['p99_ms']:>10.2f}")
+
+    if output:
+        write_results(output, run_metadata(vars(args)), results)
+
+
+if __name__ == '__main__':
+    main()
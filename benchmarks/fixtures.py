@@ -0,0 +1,127 @@
+# fixtures.py
+"""
+Deterministic fixture PDFs and self-signed test PFXs for the benchmarks.
+
+PDFs are built with PyMuPDF from a seed, so the same arguments give the same content on
+every run. A target size is reached by embedding seeded random (incompressible) bytes.
+"""
+import os
+import sys
+import base64
+import random
+import datetime
+import tempfile
+import fitz  # PyMuPDF
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Page-count / size grid used by default (pages, target size in bytes or None)
+DEFAULT_PDF_FIXTURES = [
+    (1, 10 * 1024),
+    (10, 100 * 1024),
+    (100, 1024 * 1024),
+    (1000, None),
+    (10, 10 * 1024 * 1024),
+    (10, 50 * 1024 * 1024),
+]
+
+
+def enter_workspace(path=None):
+    """
+    Switch to an empty working directory and put the repository on sys.path.
+
+    The server modules place their journal, databases, config and signed_pdfs under the
+    current directory when they are imported, so this must run before importing them;
+    a benchmark then never touches the repository's own state.
+    """
+    path = path or tempfile.mkdtemp(prefix='mx-bench-')
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    return path
+
+
+def make_pdf(pages=1, size_bytes=None, seed=0, lines_per_page=40):
+    """
+    Build a text PDF with the given number of pages, padded up to roughly size_bytes.
+
+    Returns:
+        bytes: The PDF.
+    """
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        for line in range(lines_per_page):
+            page.insert_text((50, 50 + line * 18), f"Page {number + 1} line {line + 1}: benchmark filler text")
+    data = doc.tobytes(garbage=0, deflate=True)
+
+    if size_bytes and size_bytes > len(data):
+        padding = random.Random(seed).randbytes(size_bytes - len(data))
+        doc.embfile_add("padding.bin", padding)
+        data = doc.tobytes(garbage=0, deflate=True)
+    doc.close()
+    return data
+
+
+def fixture_name(pages, size_bytes):
+    size = f"{size_bytes // 1024}kb" if size_bytes else "text"
+    return f"{pages}p-{size}"
+
+
+def make_pfx(pin="1234", cn="Benchmark Signer", key_size=2048, days=30):
+    """
+    Create a self-signed certificate with the Digital Signature key usage, packed as a PFX.
+
+    Returns:
+        tuple: (pfx_bytes, serial number in hex, i.e. the SN the server looks up)
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=days))
+        .add_extension(x509.KeyUsage(True, True, False, False, False, False, False, False, False), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    pfx = pkcs12.serialize_key_and_certificates(
+        cn.encode(), key, certificate, None, serialization.BestAvailableEncryption(pin.encode()))
+    return pfx, format(certificate.serial_number, 'x')
+
+
+def install_pfx(pfx_bytes, SN, pin, pfx_folder, pin_folder):
+    """Write a PFX and its PIN file where the server looks them up by SN."""
+    os.makedirs(pfx_folder, exist_ok=True)
+    os.makedirs(pin_folder, exist_ok=True)
+    pfx_path = os.path.join(pfx_folder, f"{SN}.pfx")
+    with open(pfx_path, 'wb') as f:
+        f.write(pfx_bytes)
+    with open(os.path.join(pin_folder, SN), 'w') as f:
+        f.write(f'file_path: "{pfx_path}"\nfile_pin: "{pin}"')
+    return pfx_path
+
+
+def sign_request(SN, pdf_data, transaction_id, response_mode="url", **pdf_options):
+    """JSON body for /sign/api/v1.0/postjson."""
+    return {
+        "request": {
+            "command": "managexserversign",
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "transaction_id": transaction_id,
+            "pfx": {"SN": SN},
+            "pdf": dict(pdf_options),
+            "pdf_data": base64.b64encode(pdf_data).decode('ascii'),
+            "response_mode": response_mode,
+        }
+    }
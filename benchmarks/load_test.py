@@ -0,0 +1,160 @@
+# load_test.py
+"""
+Offline load generator for /sign/api/v1.0/postjson.
+
+Keeps --concurrency requests in flight until --requests have completed (or for
+--duration seconds) and reports p50/p95/p99 latency, throughput and status codes.
+Without --url the server runs in-process on a throwaway working directory with a
+generated test PFX, so no network or existing server state is needed. With --url a
+running server is driven instead; --sn must then name a PFX already uploaded to it.
+
+Run from the repository root:
+    python benchmarks/load_test.py --concurrency 8 --requests 200 --pages 10 --output load.json
+    python benchmarks/load_test.py --url http://127.0.0.1:5020 --sn <serial> --duration 60
+"""
+import os
+import time
+import uuid
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from fixtures import enter_workspace, make_pdf, make_pfx, install_pfx, sign_request
+from report import summarize, run_metadata, write_results
+
+SIGN_PATH = '/sign/api/v1.0/postjson'
+
+
+def in_process_client(workdir, key_size):
+    """Import the server in workdir, install a test PFX and return (post, SN)."""
+    import validation
+    from ManageX_Signer_Server import app
+
+    pin = "1234"
+    pfx_bytes, SN = make_pfx(pin, key_size=key_size)
+    pin_folder = os.path.join(workdir, 'save', 'PIN')
+    install_pfx(pfx_bytes, SN, pin, os.path.join(workdir, 'save', 'PFX'), pin_folder)
+    # PIN files are looked up in a fixed folder; point it at the working directory
+    validation.PIN_FOLDER = pin_folder
+
+    local = threading.local()
+
+    def post(body):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        return local.client.post(SIGN_PATH, json=body).status_code
+    return post, SN
+
+
+def http_client(url, timeout):
+    import requests
+
+    local = threading.local()
+
+    def post(body):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        try:
+            return local.session.post(url.rstrip('/') + SIGN_PATH, json=body, timeout=timeout).status_code
+        except requests.RequestException:
+            return 'error'
+    return post
+
+
+def run_load(post, SN, pdf_data, concurrency, total, duration, response_mode, pdf_options):
+    """Send requests from concurrency workers; return (latencies, status counts, elapsed seconds)."""
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    issued = {'count': 0}
+    deadline = time.perf_counter() + duration if duration else None
+
+    def next_request():
+        with lock:
+            if deadline is None and issued['count'] >= total:
+                return False
+            issued['count'] += 1
+        return deadline is None or time.perf_counter() < deadline
+
+    def worker():
+        while next_request():
+            txn_id = f"load-{uuid.uuid4().hex}"
+            # Built per request so the timestamp stays inside the server's replay window
+            body = sign_request(SN, pdf_data, txn_id, response_mode=response_mode, **pdf_options)
+            started = time.perf_counter()
+            status = post(body)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return latencies, statuses, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='Base URL of a running server (default: in-process)')
+    parser.add_argument('--sn', help='Serial number of the PFX to sign with (required with --url)')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100, help='Requests to send (ignored with --duration)')
+    parser.add_argument('--duration', type=float, help='Send requests for this many seconds instead')
+    parser.add_argument('--warmup', type=int, default=5, help='Requests sent first and not measured')
+    parser.add_argument('--pages', type=int, default=1)
+    parser.add_argument('--size-kb', type=int, default=0, help='Pad the PDF to this size (max 2 MB for postjson)')
+    parser.add_argument('--response-mode', choices=('url', 'base64', 'pdf'), default='url')
+    parser.add_argument('--invisible', action='store_true', help='Request invisible signatures')
+    parser.add_argument('--key-size', type=int, default=2048)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--workdir', help='Working directory for the in-process server (default: a new temp dir)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+    if args.url and not args.sn:
+        parser.error('--sn is required with --url')
+    output = os.path.abspath(args.output) if args.output else None
+
+    workdir = enter_workspace(args.workdir)
+    if args.url:
+        post, SN = http_client(args.url, args.timeout), args.sn
+    else:
+        post, SN = in_process_client(workdir, args.key_size)
+
+    pdf_data = make_pdf(args.pages, args.size_kb * 1024 or None)
+    pdf_options = {"page": "1", "invisiblesign": "Yes" if args.invisible else "No"}
+
+    if args.warmup:
+        run_load(post, SN, pdf_data, min(args.concurrency, args.warmup), args.warmup, None,
+                 args.response_mode, pdf_options)
+    latencies, statuses, elapsed = run_load(post, SN, pdf_data, args.concurrency, args.requests, args.duration,
+                                            args.response_mode, pdf_options)
+
+    ok = statuses.get(200, 0)
+    results = {
+        'target': args.url or 'in-process',
+        'pdf_size_bytes': len(pdf_data),
+        'elapsed_seconds': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'success_rps': ok / elapsed if elapsed else 0.0,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'latency': summarize(latencies),
+    }
+
+    latency = results['latency']
+    print(f"{len(latencies)} requests in {elapsed:.2f}s at concurrency {args.concurrency} "
+          f"({len(pdf_data) / 1024:.0f} KB, {args.pages} pages)")
+    print(f"throughput {results['throughput_rps']:.1f} req/s, {results['success_rps']:.1f} ok/s, "
+          f"statuses {results['statuses']}")
+    if latencies:
+        print(f"latency ms  p50 {latency['p50_ms']:.1f}  p95 {latency['p95_ms']:.1f}  "
+              f"p99 {latency['p99_ms']:.1f}  max {latency['max_ms']:.1f}")
+
+    if output:
+        write_results(output, run_metadata(vars(args)), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# report.py
+"""
+Summaries, run metadata and JSON results shared by the benchmarks, plus a comparison of
+two result files.
+
+Compare two runs (e.g. the parent commit and this one):
+    python benchmarks/report.py baseline.json current.json --threshold 10
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    if len(samples) > 1:
+        cuts = statistics.quantiles(samples, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = samples[0]
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'min_ms': samples[0] * 1000,
+        'p50_ms': p50 * 1000,
+        'p95_ms': p95 * 1000,
+        'p99_ms': p99 * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def run_metadata(arguments):
+    """Where and how the results were produced, so runs can be matched to commits."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        'commit': commit,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'arguments': arguments,
+    }
+
+
+def write_results(path, metadata, results):
+    with open(path, 'w') as f:
+        json.dump({'metadata': metadata, 'results': results}, f, indent=4)
+
+
+def _latency_rows(results):
+    """Flatten {name: {..., 'p50_ms': ...}} (stage benchmarks) or a load-test result into name -> summary."""
+    if 'latency' in results:
+        return {'load_test': dict(results['latency'], throughput_rps=results.get('throughput_rps'))}
+    return {name: summary for name, summary in results.items() if isinstance(summary, dict) and 'p50_ms' in summary}
+
+
+def compare(baseline, current, threshold):
+    """Print p50/p95 per benchmark and return the names that got slower by more than threshold percent."""
+    base_rows = _latency_rows(baseline['results'])
+    current_rows = _latency_rows(current['results'])
+    regressions = []
+    print(f"{'benchmark':<40} {'p50 ms':>10} {'→':^3} {'p50 ms':>10} {'change':>8}   {'p95 change':>10}")
+    for name in sorted(set(base_rows) & set(current_rows)):
+        before, after = base_rows[name], current_rows[name]
+        change = (after['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0.0
+        change95 = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0.0
+        flag = '  REGRESSION' if change > threshold else ''
+        print(f"{name:<40} {before['p50_ms']:>10.2f} {'→':^3} {after['p50_ms']:>10.2f} {change:>+7.1f}%   "
+              f"{change95:>+9.1f}%{flag}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed p50 slowdown in percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    print(f"baseline {baseline['metadata'].get('commit')}  current {current['metadata'].get('commit')}")
+    regressions = compare(baseline, current, args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
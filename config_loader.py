@@ -7,7 +7,33 @@ def load_config(config_file='managex_signer.config'):
     # Default config values
     default_config = {
         "FLASK_HOST": "0.0.0.0",
-        "FLASK_PORT": 5020
+        "FLASK_PORT": 5020,
+        "SERVER_MODE": "development",
+        "SERVER_WORKERS": 4,
+        "SERVER_THREADS": 8,
+        "SERVER_KEEPALIVE": 5,
+        "SERVER_TIMEOUT": 120,
+        "SERVER_GRACEFUL_TIMEOUT": 30,
+        "SERVER_MAX_REQUESTS": 0,
+        "WEBHOOK_URL": "",
+        "WEBHOOK_ALLOWED_HOSTS": [],
+        "SMTP_HOST": "",
+        "SMTP_PORT": 587,
+        "SMTP_STARTTLS": True,
+        "SMTP_USER": "",
+        "SMTP_PASSWORD": "",
+        "SMTP_FROM": "",
+        "TSA_URL": "",
+        "TSA_FALLBACK_URL": "",
+        "TSA_USERNAME": "",
+        "TSA_PASSWORD": "",
+        "TSA_REQUIRED": True,
+        "REVOCATION_URL_OVERRIDES": {},
+        "SN_RATE_LIMIT": 0,
+        "SN_RATE_BURST": 10,
+        "SN_WEIGHT": 1,
+        "SN_QUOTAS": {},
+        "PKCS11_SIGNERS": {}
     }
     
     # Check if the config file exists
@@ -0,0 +1,118 @@
+# credential_cache.py
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from signer import load_pfx
+from env import CREDENTIAL_CACHE_TTL, CREDENTIAL_CACHE_MAX_ENTRIES
+from metrics import Counter, Gauge
+
+# Loaded (private_key, certificate, additional_certificates) tuples keyed by certificate SN,
+# kept in least-recently-used order
+_cache = OrderedDict()
+
+# Lock to ensure thread-safety when reading / updating the cache
+_cache_lock = threading.Lock()
+
+cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+
+def _file_mtime(file_path):
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _pin_digest(file_pin):
+    return hashlib.sha256((file_pin or '').encode()).digest()
+
+
+def get_credential(SN, file_path, file_pin, txn_id):
+    """
+    Return the decrypted credential for SN, loading the PFX only on a cache miss.
+
+    An entry is reused only while it is younger than CREDENTIAL_CACHE_TTL and the PFX
+    path, PIN and file modification time are unchanged.
+    """
+    mtime = _file_mtime(file_path)
+    pin_digest = _pin_digest(file_pin)
+
+    with _cache_lock:
+        entry = _cache.get(SN)
+        if entry is not None:
+            if (entry['file_path'] == file_path and entry['mtime'] == mtime
+                    and entry['pin_digest'] == pin_digest
+                    and time.monotonic() - entry['loaded_at'] < CREDENTIAL_CACHE_TTL):
+                _cache.move_to_end(SN)
+                cache_stats['hits'] += 1
+                return entry['credential']
+
+            # Expired or the PFX changed on disk
+            del _cache[SN]
+            cache_stats['invalidations'] += 1
+        cache_stats['misses'] += 1
+
+    # Decrypt outside the lock so other signers are not blocked by the slow PBKDF
+    credential = load_pfx(file_path, file_pin, txn_id)
+
+    with _cache_lock:
+        _cache[SN] = {
+            'credential': credential,
+            'file_path': file_path,
+            'mtime': mtime,
+            'pin_digest': pin_digest,
+            'loaded_at': time.monotonic(),
+        }
+        _cache.move_to_end(SN)
+        while len(_cache) > CREDENTIAL_CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+            cache_stats['evictions'] += 1
+
+    return credential
+
+
+def invalidate(SN):
+    """Drop the cached credential for SN (e.g. after /upload replaced the PFX)."""
+    with _cache_lock:
+        if _cache.pop(SN.lower(), None) is not None:
+            cache_stats['invalidations'] += 1
+
+
+def get_cache_stats():
+    with _cache_lock:
+        stats = dict(cache_stats)
+        stats['entries'] = len(_cache)
+    return stats
+
+
+def prewarm(pin_folder):
+    """Load the credential of every SN that has a PIN file, up to the cache size."""
+    if not os.path.isdir(pin_folder):
+        return 0
+
+    loaded = 0
+    for SN in sorted(os.listdir(pin_folder))[:CREDENTIAL_CACHE_MAX_ENTRIES]:
+        try:
+            with open(os.path.join(pin_folder, SN), "r", encoding="utf-8") as file:
+                file_content = file.read()
+
+            file_path_match = re.search(r'file_path:\s*"(.+?)"', file_content)
+            file_pin_match = re.search(r'file_pin:\s*"(.+?)"', file_content)
+            if not file_path_match or not file_pin_match:
+                continue
+
+            # No transaction ID: a failure here is printed below, not logged as a transaction
+            get_credential(SN.lower(), file_path_match.group(1), file_pin_match.group(1), None)
+            loaded += 1
+        except Exception as e:
+            print(f"Error pre-warming credential {SN}: {e}")
+
+    return loaded
+
+
+Counter('mx_credential_cache_events_total', 'Credential cache hits, misses, evictions and invalidations', ('event',),
+        function=lambda: {(event,): count for event, count in cache_stats.items()})
+Gauge('mx_credential_cache_entries', 'Decrypted credentials currently cached', function=lambda: len(_cache))
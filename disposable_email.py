@@ -0,0 +1,91 @@
+# disposable_email.py
+"""
+Matcher for disposable (throwaway) email domains listed in temp-mail.config.
+
+The list is loaded once into a set of blocked domains plus a set of every proper suffix
+of those domains. A domain is checked from its last label backwards, one set lookup per
+label, and the walk stops as soon as no blocked domain ends with the suffix seen so far;
+subdomains of a blocked domain (x.10minutemail.com) therefore match too. The file is
+reloaded when its modification time changes.
+"""
+import os
+import time
+import threading
+from env import DISPOSABLE_EMAIL_RECHECK_SECONDS
+
+DISPOSABLE_DOMAINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp-mail.config')
+
+# Blocked domains, suffixes of blocked domains and the file they came from; swapped as a whole on reload
+_matcher = {'sets': (frozenset(), frozenset()), 'path': DISPOSABLE_DOMAINS_FILE,
+            'mtime': None, 'checked_at': 0.0}
+_reload_lock = threading.Lock()
+
+
+def _build(lines):
+    domains, suffixes = set(), set()
+    for line in lines:
+        domain = line.strip().lower().lstrip('@.')
+        if not domain or domain.startswith('#'):
+            continue
+        domains.add(domain)
+        labels = domain.split('.')
+        for i in range(1, len(labels)):
+            suffixes.add('.'.join(labels[i:]))
+    return frozenset(domains), frozenset(suffixes)
+
+
+def load_disposable_domains(file_path=DISPOSABLE_DOMAINS_FILE):
+    """(Re)load the domain list; returns the number of domains."""
+    try:
+        mtime = os.stat(file_path).st_mtime_ns
+        with open(file_path, 'r', encoding='utf-8') as f:
+            domains, suffixes = _build(f)
+    except OSError as e:
+        print(f"Error loading disposable email domains: {e}")
+        return len(_matcher['sets'][0])
+
+    _matcher.update(sets=(domains, suffixes), path=file_path, mtime=mtime, checked_at=time.monotonic())
+    return len(domains)
+
+
+def _reload_if_changed():
+    # stat the file at most once per DISPOSABLE_EMAIL_RECHECK_SECONDS
+    if time.monotonic() - _matcher['checked_at'] < DISPOSABLE_EMAIL_RECHECK_SECONDS:
+        return
+    with _reload_lock:
+        if time.monotonic() - _matcher['checked_at'] < DISPOSABLE_EMAIL_RECHECK_SECONDS:
+            return
+        try:
+            mtime = os.stat(_matcher['path']).st_mtime_ns
+        except OSError:
+            mtime = _matcher['mtime']
+        if mtime != _matcher['mtime']:
+            load_disposable_domains(_matcher['path'])
+        _matcher['checked_at'] = time.monotonic()
+
+
+def is_disposable_domain(domain):
+    """True if domain, or any parent domain of it, is on the disposable list."""
+    _reload_if_changed()
+    domains, suffixes = _matcher['sets']
+
+    labels = domain.strip().lower().rstrip('.').split('.')
+    suffix = ''
+    for label in reversed(labels):
+        suffix = f"{label}.{suffix}" if suffix else label
+        if suffix in domains:
+            return True
+        if suffix not in suffixes:
+            # No blocked domain ends with this suffix, so no longer one can match either
+            return False
+    return False
+
+
+def is_disposable_email(email):
+    """True if the address belongs to a disposable email domain."""
+    _, _, domain = str(email).rpartition('@')
+    return bool(domain) and is_disposable_domain(domain)
+
+
+# Load the list once when the program begins
+load_disposable_domains()
@@ -1,4 +1,121 @@
 MAX_PDF_SIZE_MB = 2
 Default_Date_Format = 'dd-MMM-yyyy HH:mm:ss'
 Default_File_Title = "MX_Signer_Server"
-Default_Coordinates = "64,406,538,714"
\ No newline at end of file
+Default_Coordinates = "64,406,538,714"
+# Visible signature text; {cn} is the signer's name and {date} the signing time in Default_Date_Format
+Appearance_Templates = {
+    'default': ["Digitally Signed by: {cn}", "Date: {date}"],
+    'name_only': ["Digitally Signed by: {cn}"],
+}
+Default_Appearance_Template = 'default'
+Appearance_Font_Size = 12
+APPEARANCE_CACHE_MAX_ENTRIES = 256  # Pre-rendered appearances kept (one per signer, box size, template and date format)
+MAX_SIGNATURE_PLACEMENTS = 1000  # Max widgets (pdf.placements, "all" expanded per page) for one signature
+
+# Transaction journal (append-only log segments)
+JOURNAL_SEGMENT_MAX_MB = 16  # Rotate to a new segment once the tail segment reaches this size
+JOURNAL_WRITE_BATCH_SIZE = 512  # Max records appended per write
+JOURNAL_FSYNC_INTERVAL = 1.0  # Seconds between group-commit fsyncs while records are pending
+JOURNAL_FSYNC_BATCH_SIZE = 256  # Fsync early once this many records are pending
+
+# Decrypted PFX credential cache
+CREDENTIAL_CACHE_TTL = 900  # Seconds a decrypted credential is reused before the PFX is reloaded
+CREDENTIAL_CACHE_MAX_ENTRIES = 64  # Least recently used credentials are evicted beyond this
+CREDENTIAL_CACHE_PREWARM = False  # Load every PFX listed in save/PIN at startup
+
+# Batch signing endpoint
+MAX_BATCH_DOCUMENTS = 50  # Max documents accepted in one /sign/api/v1.0/batch request
+BATCH_SIGN_WORKERS = 4  # Threads signing batch documents in parallel
+
+# Signing executor
+SIGNING_EXECUTOR_MODE = 'thread'  # 'inline', 'thread' or 'process'
+SIGNING_WORKERS = 0  # Worker threads/processes; 0 uses the CPU count
+SIGNING_QUEUE_DEPTH = 32  # Jobs queued or running before new requests get 503
+SIGNING_JOB_TIMEOUT = 60  # Seconds to wait for one signing job; a job still running keeps its queue slot until it ends
+SIGNING_RETRY_AFTER = 1  # Retry-After seconds sent with 503 when the queue is full
+
+# Streamed (raw application/pdf or multipart) uploads on /sign/api/v1.0/postpdf
+MAX_STREAM_PDF_SIZE_MB = 50  # Max PDF size accepted as a raw body / multipart part
+STREAM_SPOOL_MEMORY_MB = 1  # Uploads larger than this are spooled to a temporary file
+STREAM_DEFAULT_RESPONSE_MODE = 'pdf'  # Response mode when none is sent; 'pdf' / 'url' avoid a base64 copy of the file
+
+# Transaction-ID replay protection
+TIMESTAMP_WINDOW_SECONDS = 30  # Requests whose timestamp is further than this from now are rejected
+REPLAY_STORE_BACKEND = 'sqlite'  # 'sqlite' (shared by all worker processes) or 'memory' (per process)
+REPLAY_STORE_BUCKET_SECONDS = 10  # Seen IDs expire in buckets of this many seconds
+
+# Live stats (/api/stats and its server-sent-events stream)
+LIVE_STATS_RECENT = 20  # Most recent transactions kept for the status page
+LIVE_STATS_RATE_WINDOWS = (1, 5, 15)  # Minutes over which per-minute rates are reported
+LIVE_STATS_STREAM_ENABLED = False  # Serve /api/stats/stream; each open stream holds a server thread, so the status page polls /api/stats unless this is on
+LIVE_STATS_MAX_STREAMS = 2  # Open streams per process; further ones get 503 and the page falls back to polling
+LIVE_STATS_PUSH_INTERVAL = 1.0  # Seconds between checks for new records on the stream
+LIVE_STATS_STREAM_MAX_SECONDS = 300  # Streams are closed after this long; browsers reconnect on their own
+
+# Transaction history query API (/api/transactions)
+TRANSACTION_QUERY_DEFAULT_LIMIT = 50  # Page size when the request gives no limit
+TRANSACTION_QUERY_MAX_LIMIT = 500  # Largest page a request may ask for
+
+# Signed PDF store (signed_pdfs)
+SIGNED_PDF_MAX_SIZE_MB = 100  # Eviction starts once the stored PDFs exceed this size
+SIGNED_PDF_LOW_WATER_MB = 80  # Eviction stops once the total is back under this size
+SIGNED_PDF_TTL = 86400  # Seconds a signed PDF is kept at most; 0 keeps it until evicted for space
+SIGNED_PDF_GRACE_SECONDS = 300  # Files younger than this are never deleted
+SIGNED_PDF_SWEEP_INTERVAL = 60  # Seconds between checks for expired files
+
+# Webhook / email notifications (targets and SMTP server are set in managex_signer.config)
+NOTIFY_QUEUE_SIZE = 1000  # Pending notifications per channel; beyond this they go to the dead-letter file
+NOTIFY_WEBHOOK_WORKERS = 4  # Threads delivering webhooks
+NOTIFY_MAX_ATTEMPTS = 5  # Delivery attempts before a notification is dead-lettered
+NOTIFY_BACKOFF_BASE = 1.0  # Seconds before the first retry; doubles on every attempt
+NOTIFY_BACKOFF_MAX = 60  # Longest wait between retries
+WEBHOOK_TIMEOUT = 5  # Seconds per webhook POST / SMTP operation
+SMTP_BATCH_SIZE = 20  # Emails sent back to back over one SMTP connection
+SMTP_IDLE_TIMEOUT = 30  # Seconds an idle SMTP connection is kept open
+
+# Disposable email domains (temp-mail.config)
+DISPOSABLE_EMAIL_RECHECK_SECONDS = 5  # How often the list file is checked for changes
+
+# Search-by-text signature placement (pdf.search_text)
+SEARCH_TEXT_MAX_PAGES = 50  # Pages searched at most per request
+SEARCH_TEXT_BOX_WIDTH = 200  # Width of the signature box placed next to the found text
+SEARCH_TEXT_BOX_HEIGHT = 60  # Height of that box
+SEARCH_TEXT_BOX_GAP = 5  # Space between the found text and the box
+TEXT_INDEX_MAX_PAGES = 2000  # Extracted pages (word positions) kept in memory, keyed by document hash
+
+# Revocation checking (OCSP / CRL) and LTV embedding into the signed PDF's DSS
+REVOCATION_MODE = 'off'  # 'off', 'embed' (embed what is available, refuse revoked certificates) or 'require' (also refuse when the status cannot be confirmed)
+REVOCATION_TIMEOUT = 5  # Seconds per OCSP request / CRL download
+REVOCATION_DEFAULT_TTL = 3600  # Seconds a response or CRL without nextUpdate is reused
+REVOCATION_REFRESH_BEFORE = 300  # Cached entries are refreshed in the background this many seconds before nextUpdate
+REVOCATION_REFRESH_INTERVAL = 30  # Seconds between background refresh sweeps
+REVOCATION_IDLE_SECONDS = 86400  # Entries unused for this long are dropped instead of refreshed
+REVOCATION_FAILURE_BACKOFF = 60  # Seconds a failed OCSP responder / CRL source is skipped before being tried again
+REVOCATION_MAX_BYTES = 10 * 1024 * 1024  # Largest OCSP response / CRL read from a URL or file
+
+# RFC 3161 timestamping (TSA URLs are set in managex_signer.config)
+TSA_TIMEOUT = 10  # Seconds per TSA request
+TSA_MAX_CONCURRENT = 8  # TSA requests in flight at once per process; further ones wait for a free slot
+TSA_RESERVED_BYTES = 16384  # Space reserved in /Contents for the timestamp token on top of the signature itself
+
+# Asynchronous signing jobs (/sign/api/v1.0/jobs)
+JOB_WORKERS = 2  # Threads per server process running queued jobs
+JOB_PRIORITY_DELAYS = {'interactive': 0, 'bulk': 30}  # Seconds added to a job's submit time when ordering the queue, so bulk jobs wait at most this long behind interactive ones
+JOB_MAX_QUEUED = 1000  # Queued jobs before new submissions get 503
+JOB_LEASE_SECONDS = 300  # A running job not finished within this long (e.g. its process died) is run again
+JOB_MAX_ATTEMPTS = 3  # Runs of one job before it is marked failed
+JOB_POLL_INTERVAL = 1.0  # Seconds between queue checks for jobs submitted by other worker processes
+JOB_RESULT_TTL = 86400  # Seconds a finished job's status and response are kept for /jobs/<id>
+
+# Per-SN admission control (rates, bursts and weights are set in managex_signer.config)
+ADMISSION_CONCURRENCY = 0  # Requests signing at once per process before the rest queue fairly by SN; 0 uses SIGNING_WORKERS
+ADMISSION_MAX_WAITING = 256  # Requests waiting for a slot before new ones get 503
+ADMISSION_MAX_WAIT = 30  # Seconds a request waits for a slot before it gets 503
+ADMISSION_MAX_TRACKED_SNS = 10000  # SNs whose rate-limit / fair-queue state is kept per process
+RATE_LIMIT_BACKEND = 'sqlite'  # 'sqlite' (one bucket per SN shared by all worker processes) or 'memory' (per process)
+ADMISSION_COST_BYTES = 1024 * 1024  # A request counts as one more request in the fair queue per this many PDF bytes
+
+# PKCS#11 signing backend (the SNs signed with token keys are set in managex_signer.config)
+PKCS11_SESSIONS_PER_TOKEN = 4  # Logged-in sessions kept open per token and process, i.e. signatures run on the token at once (capped to the token's session limit)
+PKCS11_ACQUIRE_TIMEOUT = 10  # Seconds to wait for a free session before the request gets 503
+PKCS11_HEALTH_INTERVAL = 30  # Seconds between checks of idle sessions; broken ones are reopened
@@ -0,0 +1,117 @@
+# hash_signing.py
+"""
+Two-phase (detached hash) signing.
+
+prepare_pdf builds the incremental update of a signature with a fixed-size empty
+/Contents and returns the digest of its /ByteRange. sign_digest turns that digest into
+the CMS signature with a stored credential, and inject_signature writes the CMS into the
+prepared update, which is then appended to the original PDF. Only prepare_pdf needs the
+document and it can run on the client, so the server sees a digest and returns a few KB
+of CMS whatever the size of the PDF.
+"""
+import io
+import time
+import random
+import hashlib
+from asn1crypto import cms
+from endesive import signer
+from endesive.pdf.PyPDF2 import pdf as pypdf, generic as po
+from endesive.pdf.cms import WNumberObject
+from signature_utils import CachedAppearanceSignedData
+from timestamping import timestamp_signed_data
+
+# Digest algorithms accepted for hash signing, with their digest sizes in bytes
+HASH_ALGORITHMS = {'sha256': 32, 'sha384': 48, 'sha512': 64}
+
+
+class PreparedSignedData(CachedAppearanceSignedData):
+    """SignedData that stops before signing, leaving /Contents for the CMS made later."""
+
+    def prepare(self, datau, udct, cert=None, othercerts=(), algomd='sha256'):
+        startdata = len(datau)
+        prev = pypdf.PdfFileReader(io.BytesIO(datau))
+        if prev.isEncrypted:
+            raise ValueError("Encrypted PDFs cannot be prepared for hash signing")
+
+        zeros = b"00" * udct['aligned']
+        self.makepdf(prev, udct, algomd, zeros, cert, list(othercerts or []), None, None,
+                     mode="sign", use_signingdate=True)
+        self._encrypt_key = None
+
+        # Same /ID handling as a one-step signature
+        ID = prev.trailer.get("/ID", None)
+        if ID is None:
+            ID = udct.get("id") or hashlib.md5(repr(time.time()).encode()).digest()
+        else:
+            ID = ID.getObject()[0].original_bytes
+        newID = udct.get("newid", repr(random.random()))
+        self._ID = po.ArrayObject([
+            po.ByteStringObject(ID),
+            po.ByteStringObject(hashlib.md5(newID.encode()).digest()),
+        ])
+
+        fo = io.BytesIO()
+        self.write(fo, prev, startdata)
+        datas = fo.getvalue()
+
+        # Fill in the /ByteRange placeholder around the empty /Contents
+        bfrom = (b"[ " + b" ".join([WNumberObject.Format] * 4) + b" ]") % (0, 0, 0, 0)
+        contents_offset = datas.find(zeros)
+        contents_end = contents_offset + len(zeros)
+        byte_range = [0, startdata + contents_offset - 1, startdata + contents_end + 1, len(datas) - contents_end - 1]
+        bto = b"[%d %d %d %d]" % tuple(byte_range)
+        datas = datas.replace(bfrom, bto + b" " * (len(bfrom) - len(bto)), 1)
+
+        md = getattr(hashlib, algomd)()
+        md.update(datau)
+        md.update(datas[:contents_offset - 1])
+        md.update(datas[contents_end + 1:])
+        return {
+            'update': datas,
+            'digest': md.digest(),
+            'hash_algorithm': algomd,
+            'contents_offset': contents_offset,
+            'contents_length': len(zeros),
+        }
+
+
+def prepare_pdf(pdf_data, dct, reserved_bytes, cert=None, othercerts=(), hashalgo='sha256'):
+    """
+    Build the signature update for pdf_data with reserved_bytes of room for the CMS.
+
+    dct is a signature dictionary from prepare_signature_dict (its 'aligned' entry is
+    set here). cert is only used when dct has no 'appearance', for endesive's own
+    rendering of the signer's name.
+
+    Returns:
+        dict: update (bytes to append to pdf_data once the CMS is injected), digest,
+        hash_algorithm, contents_offset and contents_length (hex characters).
+    """
+    dct = dict(dct, aligned=reserved_bytes)
+    return PreparedSignedData().prepare(pdf_data, dct, cert, othercerts, hashalgo)
+
+
+def sign_digest(digest, p12pk, p12pc, p12oc, hashalgo='sha256'):
+    """CMS (DER) detached signature over a precomputed digest."""
+    if len(digest) != HASH_ALGORITHMS[hashalgo]:
+        raise ValueError(f"A {hashalgo} digest must be {HASH_ALGORITHMS[hashalgo]} bytes")
+    return signer.sign(None, p12pk, p12pc, list(p12oc or []), hashalgo, True, digest)
+
+
+def timestamp_signature(signature):
+    """Add a TSA timestamp to a CMS signature from sign_digest."""
+    return timestamp_signed_data(cms.ContentInfo.load(signature)).dump(force=True)
+
+
+def inject_signature(update, contents_offset, contents_length, signature):
+    """
+    Write a CMS signature into the /Contents of a prepared update.
+
+    Returns:
+        bytes: The signed update, to append to the original PDF.
+    """
+    contents = signature.hex().encode('ascii')
+    if len(contents) > contents_length:
+        raise ValueError(f"Signature needs {len(contents) // 2} bytes but only {contents_length // 2} were reserved")
+    contents += b'0' * (contents_length - len(contents))
+    return update[:contents_offset] + contents + update[contents_offset + contents_length:]
@@ -0,0 +1,333 @@
+# job_queue.py
+"""
+Asynchronous signing jobs.
+
+A job is a validated signing request stored in SQLite, so queued jobs survive a restart
+and every worker process takes from the same queue. Jobs run in order of their due time:
+the submit time plus the delay of their priority (JOB_PRIORITY_DELAYS), so interactive
+jobs go first and a bulk job waits at most that long behind them.
+
+JOB_WORKERS threads per process claim jobs with a lease of JOB_LEASE_SECONDS; a job whose
+process died while running it is run again once the lease runs out, up to
+JOB_MAX_ATTEMPTS times. The signed PDF goes to signed_pdfs and is logged with
+log_transaction (and its webhook) like any other signature; the job keeps the response
+for JOB_RESULT_TTL seconds for /jobs/<id>.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import datetime
+import threading
+from metrics import Counter, Gauge, Histogram
+from notifications import notify as queue_notifications
+from transaction_tracker import log_transaction
+from signing_executor import SigningExecutorBusy
+from env import (
+    JOB_WORKERS,
+    JOB_PRIORITY_DELAYS,
+    JOB_MAX_QUEUED,
+    JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_POLL_INTERVAL,
+    JOB_RESULT_TTL,
+    SIGNING_RETRY_AFTER
+)
+
+JOB_DB_FILE = os.path.join(os.getcwd(), 'job_queue.db')
+JOB_PRIORITIES = tuple(JOB_PRIORITY_DELAYS)
+
+# Seconds between deletions of finished jobs older than JOB_RESULT_TTL
+PURGE_INTERVAL = 60
+
+JOBS_TOTAL = Counter('mx_jobs_total', 'Finished signing jobs, by priority and result', ('priority', 'result'))
+JOB_QUEUE_WAIT = Histogram(
+    'mx_job_queue_wait_seconds', 'Time from submission until a worker starts the job, by priority', ('priority',))
+
+
+class JobQueueFull(Exception):
+    """Raised when JOB_MAX_QUEUED jobs are already waiting; the caller should answer 503."""
+
+    def __init__(self, retry_after=SIGNING_RETRY_AFTER):
+        super().__init__("Job queue is full. Please retry later.")
+        self.retry_after = retry_after
+
+
+_local = threading.local()
+_initialised = {'path': None}
+_init_lock = threading.Lock()
+
+
+def _connection():
+    # One connection per thread and per process (connections must not cross a fork)
+    if getattr(_local, 'pid', None) != os.getpid():
+        connection = sqlite3.connect(JOB_DB_FILE, timeout=10, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.row_factory = sqlite3.Row
+        _local.connection = connection
+        _local.pid = os.getpid()
+
+    with _init_lock:
+        if _initialised['path'] != JOB_DB_FILE:
+            _create_tables(_local.connection)
+            _initialised['path'] = JOB_DB_FILE
+    return _local.connection
+
+
+def _create_tables(connection):
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "job_id TEXT PRIMARY KEY, transaction_id TEXT NOT NULL, priority TEXT NOT NULL, "
+        "status TEXT NOT NULL, due REAL NOT NULL, submitted REAL NOT NULL, started REAL, finished REAL, "
+        "lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, request TEXT NOT NULL, pdf_data BLOB, "
+        "http_status INTEGER, result TEXT)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, due)")
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (status, lease_until)")
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished)")
+
+
+# Wakes this process's workers when a job is submitted here; other processes poll
+_wakeup = threading.Condition()
+_workers = {'pid': None}
+_workers_lock = threading.Lock()
+
+
+def start_job_workers():
+    """Start this process's job workers (once per process; threads do not survive a fork)."""
+    with _workers_lock:
+        if _workers['pid'] == os.getpid():
+            return
+        _workers['pid'] = os.getpid()
+        for number in range(JOB_WORKERS):
+            threading.Thread(target=_work, name=f"sign-job-{number}", daemon=True).start()
+
+
+def enqueue_job(request_data, txn_id, pdf_data, priority):
+    """
+    Store a validated request and its PDF as a queued job.
+
+    Returns:
+        str: The job ID.
+
+    Raises:
+        JobQueueFull: If JOB_MAX_QUEUED jobs are already waiting.
+    """
+    connection = _connection()
+    queued = connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    if queued >= JOB_MAX_QUEUED:
+        raise JobQueueFull()
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    connection.execute(
+        "INSERT INTO jobs (job_id, transaction_id, priority, status, due, submitted, request, pdf_data) "
+        "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+        (job_id, txn_id, priority, now + JOB_PRIORITY_DELAYS[priority], now, json.dumps(request_data),
+         sqlite3.Binary(pdf_data)),
+    )
+
+    start_job_workers()
+    with _wakeup:
+        _wakeup.notify()
+    return job_id
+
+
+def _iso(seconds):
+    if seconds is None:
+        return None
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+
+def get_job(job_id):
+    """
+    Status of one job, with its response or error once finished.
+
+    Returns:
+        dict or None: None for an unknown (or purged) job ID.
+    """
+    connection = _connection()
+    row = connection.execute(
+        "SELECT job_id, transaction_id, priority, status, due, submitted, started, finished, attempts, "
+        "http_status, result FROM jobs WHERE job_id = ?", (job_id,)
+    ).fetchone()
+    if row is None:
+        return None
+
+    job = {
+        'job_id': row['job_id'],
+        'transaction_id': row['transaction_id'],
+        'priority': row['priority'],
+        'status': row['status'],
+        'submitted_at': _iso(row['submitted']),
+        'started_at': _iso(row['started']),
+        'finished_at': _iso(row['finished']),
+        'attempts': row['attempts'],
+    }
+    if row['status'] == 'queued':
+        job['queue_position'] = connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND due < ?", (row['due'],)
+        ).fetchone()[0] + 1
+    if row['result'] is not None:
+        job['http_status'] = row['http_status']
+        result = json.loads(row['result'])
+        if row['status'] == 'done':
+            job['response'] = result.get('response', result)
+        else:
+            job['error'] = result.get('error')
+    return job
+
+
+def _holds_lease(job_id, attempts):
+    """Whether the run that claimed the job as this attempt still owns it."""
+    return _connection().execute(
+        "SELECT 1 FROM jobs WHERE job_id = ? AND status = 'running' AND attempts = ?", (job_id, attempts)
+    ).fetchone() is not None
+
+
+def _finish(job_id, attempts, status, http_status, result):
+    """Store the result of a run; False (and nothing stored) when its lease went to another run."""
+    cursor = _connection().execute(
+        "UPDATE jobs SET status = ?, finished = ?, lease_until = NULL, http_status = ?, result = ?, "
+        "pdf_data = NULL WHERE job_id = ? AND status = 'running' AND attempts = ?",
+        (status, time.time(), http_status, json.dumps(result), job_id, attempts),
+    )
+    return cursor.rowcount > 0
+
+
+def _expire_leases(now):
+    """Requeue jobs whose worker did not finish them in time; fail those out of attempts."""
+    connection = _connection()
+    expired = connection.execute(
+        "SELECT job_id, transaction_id, priority, attempts FROM jobs WHERE status = 'running' AND lease_until < ?",
+        (now,)
+    ).fetchall()
+    for row in expired:
+        if row['attempts'] >= JOB_MAX_ATTEMPTS:
+            error = f"Job did not finish after {row['attempts']} attempt(s)"
+            cursor = connection.execute(
+                "UPDATE jobs SET status = 'failed', finished = ?, lease_until = NULL, http_status = 500, "
+                "result = ?, pdf_data = NULL WHERE job_id = ? AND status = 'running'",
+                (now, json.dumps({'error': error}), row['job_id']),
+            )
+            if cursor.rowcount:
+                log_transaction(row['transaction_id'], "failure", error)
+                JOBS_TOTAL.inc(priority=row['priority'], result='failed')
+        else:
+            connection.execute(
+                "UPDATE jobs SET status = 'queued', lease_until = NULL WHERE job_id = ? AND status = 'running'",
+                (row['job_id'],),
+            )
+
+
+def _claim():
+    """Take the queued job with the earliest due time, or return None."""
+    connection = _connection()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        _expire_leases(now)
+        row = connection.execute(
+            "SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY due LIMIT 1"
+        ).fetchone()
+        job = None
+        if row is not None:
+            connection.execute(
+                "UPDATE jobs SET status = 'running', started = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE job_id = ?",
+                (now, now + JOB_LEASE_SECONDS, row['job_id']),
+            )
+            job = connection.execute(
+                "SELECT job_id, transaction_id, priority, submitted, attempts, request, pdf_data FROM jobs WHERE job_id = ?",
+                (row['job_id'],)
+            ).fetchone()
+        connection.execute("COMMIT")
+        return job
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def _purge_finished():
+    _connection().execute("DELETE FROM jobs WHERE finished < ?", (time.time() - JOB_RESULT_TTL,))
+
+
+def _run(job):
+    # Imported here: sign_pdf_pfx submits its jobs through this module
+    from sign_pdf_pfx import sign_job_request
+
+    job_id, txn_id, priority, attempts = job['job_id'], job['transaction_id'], job['priority'], job['attempts']
+    JOB_QUEUE_WAIT.observe(time.time() - job['submitted'], priority=priority)
+    request_data = json.loads(job['request'])
+
+    try:
+        result, http_status = sign_job_request(request_data, txn_id, bytes(job['pdf_data']),
+                                               lease_held=lambda: _holds_lease(job_id, attempts))
+    except SigningExecutorBusy as e:
+        # Back into the queue at its old position; this was not a real attempt
+        _connection().execute(
+            "UPDATE jobs SET status = 'queued', lease_until = NULL, attempts = attempts - 1 "
+            "WHERE job_id = ? AND status = 'running' AND attempts = ?",
+            (job_id, attempts))
+        time.sleep(e.retry_after)
+        return
+    except Exception as e:
+        log_transaction(txn_id, "failure", str(e))
+        result, http_status = {'error': str(e)}, 500
+
+    # The lease expired and the job was requeued; the run that owns it now reports the result
+    if http_status is None:
+        return
+
+    if http_status == 200:
+        if _finish(job_id, attempts, 'done', http_status, result):
+            JOBS_TOTAL.inc(priority=priority, result='done')
+        return
+
+    if not _finish(job_id, attempts, 'failed', http_status, result):
+        return
+    JOBS_TOTAL.inc(priority=priority, result='failed')
+
+    # Failures were logged (and sent to WEBHOOK_URL) where they happened; the request's
+    # own webhook is told here, as the client is not waiting on a response
+    webhook_url = request_data.get('request', {}).get('webhook_url')
+    if webhook_url:
+        queue_notifications({
+            "transaction_id": txn_id,
+            "status": "failure",
+            "reason": result.get('error'),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }, {'job_id': job_id, 'status': 'failed', 'error': result.get('error')}, webhook_url)
+
+
+def _work():
+    last_purge = 0.0
+    while True:
+        try:
+            job = _claim()
+            if job is not None:
+                _run(job)
+                continue
+
+            if time.monotonic() - last_purge >= PURGE_INTERVAL:
+                last_purge = time.monotonic()
+                _purge_finished()
+
+            with _wakeup:
+                _wakeup.wait(JOB_POLL_INTERVAL)
+        except Exception as e:
+            print(f"Error in signing job worker: {e}")
+            time.sleep(JOB_POLL_INTERVAL)
+
+
+def _queued_by_priority():
+    rows = _connection().execute(
+        "SELECT priority, COUNT(*) FROM jobs WHERE status = 'queued' GROUP BY priority").fetchall()
+    counts = {(priority,): 0 for priority in JOB_PRIORITIES}
+    counts.update({(priority,): count for priority, count in rows})
+    return counts
+
+
+Gauge('mx_jobs_queued', 'Signing jobs waiting in the queue, by priority', ('priority',), function=_queued_by_priority)
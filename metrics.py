@@ -0,0 +1,179 @@
+# metrics.py
+"""
+Minimal Prometheus-style metrics (text exposition format 0.0.4) without extra dependencies.
+
+Recording a value is a dict lookup plus a few additions under a lock, cheap enough to
+leave on in production. Values are per process: every sample carries a `worker` label
+with the process ID, so the series of the worker processes stay apart when successive
+scrapes reach different workers (sum them without `worker` for server totals).
+"""
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from fast cache hits up to slow signatures
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# PDF size buckets in bytes (10 KB .. 50 MB)
+SIZE_BUCKETS = (10240, 51200, 102400, 262144, 524288, 1048576, 2097152, 5242880, 10485760, 26214400, 52428800)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(labelnames, labelvalues, *extra):
+    pairs = list(zip(labelnames, labelvalues))
+    pairs.extend(pair for pair in extra if pair)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Optional callback evaluated at scrape time for values owned by another module:
+        # returns a number, or {label values tuple: number}
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                print(f"Error collecting metric {self.name}: {e}")
+                return []
+            if isinstance(value, dict):
+                return [(self.name, key if isinstance(key, tuple) else (key,), None, v) for key, v in value.items()]
+            return [(self.name, (), None, value)]
+
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        # Read at render time: a forked worker has a new process ID
+        worker = ('worker', os.getpid())
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra, worker)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per-bucket (non-cumulative) counts, plus sum and count
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            snapshot = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()]
+
+        samples = []
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", key, ('le', _format_value(bound)), cumulative))
+            samples.append((f"{self.name}_sum", key, None, total))
+            samples.append((f"{self.name}_count", key, None, count))
+        return samples
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by the request / signing path
+REQUESTS_TOTAL = Counter(
+    'mx_requests_total', 'HTTP requests handled, by endpoint and status code', ('endpoint', 'status'))
+REQUESTS_IN_FLIGHT = Gauge(
+    'mx_requests_in_flight', 'HTTP requests currently being handled')
+REQUEST_DURATION = Histogram(
+    'mx_request_duration_seconds', 'HTTP request latency, by endpoint', ('endpoint',))
+SIGN_STAGE_DURATION = Histogram(
+    'mx_sign_stage_duration_seconds', 'Latency of each signing pipeline stage', ('stage',))
+PDF_SIZE = Histogram(
+    'mx_pdf_size_bytes', 'Size of PDFs received for signing', buckets=SIZE_BUCKETS)
+
+
+def time_stage(stage):
+    """Context manager timing one signing stage, e.g. `with time_stage('load_pfx'):`."""
+    return SIGN_STAGE_DURATION.time(stage=stage)
+
+
+def observe_stage(stage, seconds):
+    """Record a stage duration measured elsewhere (e.g. inside a signing worker process)."""
+    SIGN_STAGE_DURATION.observe(seconds, stage=stage)
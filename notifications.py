@@ -0,0 +1,352 @@
+# notifications.py
+"""
+Background delivery of webhook and email notifications.
+
+log_transaction hands notifications to bounded queues and returns at once; worker threads
+deliver them over pooled keep-alive HTTP sessions and a reused SMTP connection. Failed
+deliveries are retried with exponential backoff; what still fails, or does not fit in the
+queue, is appended to the dead-letter file.
+
+A request's own webhook_url must be on a host listed in WEBHOOK_ALLOWED_HOSTS and resolve
+to public addresses only; this is checked when the request is validated and again right
+before every delivery, and redirects are not followed.
+"""
+import os
+import json
+import socket
+import ipaddress
+import time
+import heapq
+import queue
+import random
+import smtplib
+import datetime
+import itertools
+import threading
+from urllib.parse import urlparse
+from email.message import EmailMessage
+import requests
+from requests.adapters import HTTPAdapter
+from config_loader import load_config
+from metrics import Counter, Gauge, Histogram
+from env import (
+    NOTIFY_QUEUE_SIZE,
+    NOTIFY_WEBHOOK_WORKERS,
+    NOTIFY_MAX_ATTEMPTS,
+    NOTIFY_BACKOFF_BASE,
+    NOTIFY_BACKOFF_MAX,
+    WEBHOOK_TIMEOUT,
+    SMTP_BATCH_SIZE,
+    SMTP_IDLE_TIMEOUT
+)
+
+DEAD_LETTER_FILE = os.path.join(os.getcwd(), 'notifications_dead_letter.jsonl')
+
+NOTIFICATIONS_TOTAL = Counter(
+    'mx_notifications_total', 'Notification outcomes, by channel', ('channel', 'result'))
+NOTIFICATION_DURATION = Histogram(
+    'mx_notification_delivery_seconds', 'Time to deliver one notification attempt, by channel', ('channel',))
+
+_dead_letter_lock = threading.Lock()
+
+
+class PermanentDeliveryError(Exception):
+    """A delivery failure that retrying cannot fix (e.g. the webhook answered 400)."""
+
+
+def _write_dead_letter(channel, item, error, attempts):
+    record = {
+        'channel': channel,
+        'attempts': attempts,
+        'error': str(error),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'notification': item,
+    }
+    try:
+        with _dead_letter_lock:
+            with open(DEAD_LETTER_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+    except Exception as e:
+        print(f"Error writing notification dead letter: {e}")
+    NOTIFICATIONS_TOTAL.inc(channel=channel, result='dead_lettered')
+
+
+class _DeliveryChannel:
+    """
+    A bounded queue drained by worker threads, plus a retry schedule.
+
+    deliver(items) receives up to batch_size items and returns the failed ones as
+    (item, exception) pairs.
+    """
+
+    def __init__(self, name, deliver, workers=1, batch_size=1, idle=None):
+        self.name = name
+        self.deliver = deliver
+        self.workers = workers
+        self.batch_size = batch_size
+        self.idle = idle  # Called when a worker has been idle for SMTP_IDLE_TIMEOUT seconds
+        self.queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+        self._retries = []  # Heap of (due, sequence, attempts, item)
+        self._retry_sequence = itertools.count()
+        self._retry_condition = threading.Condition()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so every worker process starts its own
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            for _ in range(self.workers):
+                threading.Thread(target=self._work, daemon=True).start()
+            threading.Thread(target=self._schedule_retries, daemon=True).start()
+
+    def submit(self, item, attempts=0):
+        """Queue an item without blocking; a full queue sends it straight to the dead-letter file."""
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((attempts, item))
+        except queue.Full:
+            _write_dead_letter(self.name, item, "Notification queue is full", attempts)
+
+    def _work(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=SMTP_IDLE_TIMEOUT if self.idle else None)]
+            except queue.Empty:
+                self.idle()
+                continue
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                started = time.perf_counter()
+                failures = self.deliver([item for _, item in batch])
+                if batch:
+                    NOTIFICATION_DURATION.observe((time.perf_counter() - started) / len(batch), channel=self.name)
+            except Exception as e:
+                failures = [(item, e) for _, item in batch]
+
+            failed = {id(item): error for item, error in failures}
+            for attempts, item in batch:
+                if id(item) not in failed:
+                    NOTIFICATIONS_TOTAL.inc(channel=self.name, result='delivered')
+                else:
+                    self._retry_or_give_up(item, failed[id(item)], attempts + 1)
+                self.queue.task_done()
+
+    def _retry_or_give_up(self, item, error, attempts):
+        if isinstance(error, PermanentDeliveryError) or attempts >= NOTIFY_MAX_ATTEMPTS:
+            print(f"Giving up {self.name} notification after {attempts} attempt(s): {error}")
+            _write_dead_letter(self.name, item, error, attempts)
+            return
+
+        # Exponential backoff with full jitter
+        delay = random.uniform(0, min(NOTIFY_BACKOFF_MAX, NOTIFY_BACKOFF_BASE * 2 ** (attempts - 1)))
+        NOTIFICATIONS_TOTAL.inc(channel=self.name, result='retried')
+        with self._retry_condition:
+            heapq.heappush(self._retries, (time.monotonic() + delay, next(self._retry_sequence), attempts, item))
+            self._retry_condition.notify()
+
+    def _schedule_retries(self):
+        """Move retries back onto the queue once their backoff has elapsed."""
+        while True:
+            with self._retry_condition:
+                while not self._retries or self._retries[0][0] > time.monotonic():
+                    self._retry_condition.wait(self._retries[0][0] - time.monotonic() if self._retries else None)
+                _, _, attempts, item = heapq.heappop(self._retries)
+            self.submit(item, attempts)
+
+
+# Deployment settings (webhook URL, SMTP server) are read from managex_signer.config on first use
+_settings = {'config': None}
+_settings_lock = threading.Lock()
+
+
+def _config():
+    with _settings_lock:
+        if _settings['config'] is None:
+            try:
+                _settings['config'] = load_config()
+            except Exception as e:
+                print(f"Error loading notification settings: {e}")
+                _settings['config'] = {}
+        return _settings['config']
+
+
+def _host_allowed(host, allowed_hosts):
+    for allowed in allowed_hosts:
+        allowed = str(allowed).lower()
+        if allowed.startswith('*.'):
+            allowed = allowed[1:]
+        if host == allowed or (allowed.startswith('.') and host.endswith(allowed)):
+            return True
+    return False
+
+
+def check_webhook_url(url):
+    """
+    Check a client-supplied webhook URL before anything is sent to it.
+
+    Returns:
+        str or None: Why the URL is refused, or None when it may be used.
+    """
+    parsed = urlparse(str(url))
+    host = (parsed.hostname or '').lower()
+    if parsed.scheme not in ('http', 'https') or not host:
+        return "Use an http(s) URL."
+    if not _host_allowed(host, _config().get('WEBHOOK_ALLOWED_HOSTS') or []):
+        return f"Host {host} is not in WEBHOOK_ALLOWED_HOSTS."
+
+    # Every address the name resolves to must be public (no loopback, private, link-local / metadata)
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parsed.port or None, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError, ValueError):
+        return f"Host {host} cannot be resolved."
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if getattr(ip, 'ipv4_mapped', None):
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            return f"Host {host} resolves to a non-public address."
+    return None
+
+
+# Webhooks: one keep-alive session per worker thread
+_http = threading.local()
+
+
+def _session():
+    if getattr(_http, 'session', None) is None:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        _http.session = session
+    return _http.session
+
+
+def _deliver_webhooks(items):
+    failures = []
+    for item in items:
+        try:
+            # Checked again here: the name may resolve differently than at validation
+            if item.get('client_url'):
+                refused = check_webhook_url(item['url'])
+                if refused:
+                    raise PermanentDeliveryError(f"Webhook URL refused: {refused}")
+            response = _session().post(item['url'], json=item['payload'], timeout=WEBHOOK_TIMEOUT,
+                                       allow_redirects=False)
+            if response.status_code >= 400:
+                message = f"Webhook returned HTTP {response.status_code}"
+                # Client errors other than timeout / rate limiting will not succeed on retry
+                if response.status_code < 500 and response.status_code not in (408, 429):
+                    raise PermanentDeliveryError(message)
+                raise requests.HTTPError(message)
+        except Exception as e:
+            failures.append((item, e))
+    return failures
+
+
+# Email: one SMTP connection reused across messages while the worker stays busy
+_smtp = {'connection': None}
+
+
+def _smtp_connection():
+    if _smtp['connection'] is None:
+        config = _config()
+        connection = smtplib.SMTP(config['SMTP_HOST'], config.get('SMTP_PORT', 587), timeout=WEBHOOK_TIMEOUT)
+        if config.get('SMTP_STARTTLS', True):
+            connection.starttls()
+        if config.get('SMTP_USER'):
+            connection.login(config['SMTP_USER'], config.get('SMTP_PASSWORD', ''))
+        _smtp['connection'] = connection
+    return _smtp['connection']
+
+
+def _close_smtp():
+    if _smtp['connection'] is not None:
+        try:
+            _smtp['connection'].quit()
+        except Exception:
+            pass
+        _smtp['connection'] = None
+
+
+def _build_email(item):
+    config = _config()
+    message = EmailMessage()
+    message['From'] = config.get('SMTP_FROM') or config.get('SMTP_USER')
+    message['To'] = item['to']
+    message['Subject'] = f"Document signed - transaction {item['transaction_id']}"
+    message.set_content(
+        f"Your document has been signed by {item.get('signer') or 'MXServerSign'}.\n\n"
+        f"Transaction: {item['transaction_id']}\n"
+        f"Download: {item.get('signed_pdf_url')}\n"
+    )
+    return message
+
+
+def _deliver_emails(items):
+    # Local import: transaction_tracker feeds this module
+    from transaction_tracker import log_transaction
+
+    failures = []
+    for item in items:
+        try:
+            try:
+                _smtp_connection().send_message(_build_email(item))
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the reused connection; reconnect once
+                _smtp['connection'] = None
+                _smtp_connection().send_message(_build_email(item))
+            log_transaction(item['transaction_id'], "success", f"Email Send to {item['to']}", notify=False)
+        except smtplib.SMTPRecipientsRefused as e:
+            failures.append((item, PermanentDeliveryError(str(e))))
+        except Exception as e:
+            _close_smtp()
+            failures.append((item, e))
+    return failures
+
+
+webhook_channel = _DeliveryChannel('webhook', _deliver_webhooks, workers=NOTIFY_WEBHOOK_WORKERS)
+email_channel = _DeliveryChannel('email', _deliver_emails, batch_size=SMTP_BATCH_SIZE, idle=_close_smtp)
+
+Gauge('mx_notification_queue_depth', 'Queued notifications, by channel (excluding scheduled retries)', ('channel',),
+      function=lambda: {(channel.name,): channel.queue.qsize() for channel in (webhook_channel, email_channel)})
+
+
+def notify(log_entry, response=None, webhook_url=None, email=None):
+    """
+    Queue the notifications for one logged transaction; never blocks the caller.
+
+    A webhook goes to webhook_url (checked with check_webhook_url) or, failing that, the
+    configured WEBHOOK_URL. An email goes to `email` for successful signatures when an
+    SMTP server is configured.
+    """
+    try:
+        config = _config()
+        url = webhook_url or config.get('WEBHOOK_URL')
+        if url:
+            payload = dict(log_entry)
+            if response is not None:
+                # The signed PDF itself is fetched from signed_pdf_url, not pushed
+                body = dict(response.get('response', response))
+                body.pop('signed_pdf_data', None)
+                payload['response'] = body
+            webhook_channel.submit({'url': url, 'payload': payload, 'client_url': bool(webhook_url)})
+
+        if email and log_entry.get('status') == 'success' and config.get('SMTP_HOST'):
+            body = (response or {}).get('response', {})
+            email_channel.submit({
+                'to': email,
+                'transaction_id': log_entry.get('transaction_id'),
+                'signed_pdf_url': body.get('signed_pdf_url'),
+                'signer': body.get('file', {}).get('attribute', {}).get('Name'),
+            })
+    except Exception as e:
+        print(f"Error queueing notification: {e}")
@@ -1,59 +1,133 @@
 from transaction_tracker import log_transaction
-from io import BytesIO
 import base64
 import os
-from flask import request, jsonify
+from flask import request, jsonify, send_from_directory
 from env import Default_File_Title
+from metrics import time_stage
+from signed_output_store import SIGNED_PDF_FOLDER, record_write
+
+# Response modes a request can choose with `response_mode`
+RESPONSE_MODES = ('base64', 'pdf', 'url')
+DEFAULT_RESPONSE_MODE = 'base64'
+
+
+def get_response_mode(request_data):
+    return request_data.get('request', {}).get('response_mode') or DEFAULT_RESPONSE_MODE
+
+
+def get_signed_pdf_filename(txn_id):
+    return f"{Default_File_Title}_{txn_id}_signed.pdf"
+
+
+def write_signed_pdf(path, pdf_data, signed_pdf_data):
+    """Write the original PDF followed by the signed update with a single vectored write."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        if hasattr(os, 'writev'):
+            buffers = [memoryview(pdf_data), memoryview(signed_pdf_data)]
+            while buffers:
+                written = os.writev(fd, buffers)
+                # Drop whatever a short write already covered
+                while buffers and written >= len(buffers[0]):
+                    written -= len(buffers[0])
+                    buffers.pop(0)
+                if buffers:
+                    buffers[0] = buffers[0][written:]
+        else:
+            for data in (pdf_data, signed_pdf_data):
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def b64encode_concat(first, second):
+    """Base64 of first + second without building the concatenated bytes."""
+    # Encode in 3-byte aligned pieces so the encodings join without inner padding
+    split = len(first) - len(first) % 3
+    borrow = (3 - len(first) % 3) % 3  # Bytes of second needed to complete the last group
+    head = base64.b64encode(memoryview(first)[:split])
+    seam = base64.b64encode(bytes(memoryview(first)[split:]) + bytes(memoryview(second)[:borrow]))
+    rest = base64.b64encode(memoryview(second)[borrow:])
+    return b''.join((head, seam, rest)).decode()
+
 
 def save_signed_pdf_and_send_response(
     pdf_data, signed_pdf_data, txn_id,  cn, request_data
 ):
     try:
-        # Save the signed PDF to a file
-        signed_pdf_filename = f"{Default_File_Title}_{txn_id}_signed.pdf"
-        signed_pdf_path = f"signed_pdfs/{signed_pdf_filename}"
-
-        # Ensure the directory exists
-        os.makedirs('signed_pdfs', exist_ok=True)
-
-        # Save signed PDF
-        with open(signed_pdf_path, 'wb') as f:
-            f.write(pdf_data)  # Original PDF data
-            f.write(signed_pdf_data)  # Signed PDF data
-
-        # Generate the URL to access the signed PDF
-        signed_pdf_url = f"http://192.168.1.10:5020/signed_pdf/{signed_pdf_filename}"
-
-        # Combine the signed PDF data into base64 for response
-        output_pdf = BytesIO()
-        output_pdf.write(pdf_data)  # Original PDF data
-        output_pdf.write(signed_pdf_data)  # Signed PDF data
-        signed_pdf_base64 = base64.b64encode(output_pdf.getvalue()).decode()
-
-
-        response = {
-            "response": {
-                "command": "managexsign",
-                "ts": request_data.get('request', {}).get('timestamp'),
-                "txn": txn_id,
-                "status": "ok",
-                "file": {
-                    "attribute": {
-                        "Name": cn,
-                        "Type": "pdf"
-                    }
-                },
-                "signed_pdf_url": signed_pdf_url,
-                "signed_pdf_data": signed_pdf_base64
-            },
-        }
+        response = save_signed_pdf(pdf_data, signed_pdf_data, txn_id, cn, request_data)
 
-        # Log the transaction status as success
-        log_transaction(txn_id, status="success", reason="PDF signed successfully", response=response)
+        # Stream the signed file itself instead of JSON
+        if get_response_mode(request_data) == 'pdf':
+            pdf_response = send_from_directory(
+                os.path.abspath(SIGNED_PDF_FOLDER),
+                get_signed_pdf_filename(txn_id),
+                mimetype='application/pdf',
+                conditional=True,
+            )
+            pdf_response.headers['X-Transaction-Id'] = str(txn_id)
+            pdf_response.headers['X-Signed-PDF-URL'] = response['response']['signed_pdf_url']
+            return pdf_response
 
         # Return the response
-        return jsonify(response)
+        with time_stage('response_serialize'):
+            return jsonify(response)
     except Exception as e:
         # Log failure and return error
         log_transaction(txn_id, status="failure", reason=str(e))
         return jsonify({'error': str(e)}), 500
+
+
+def save_signed_pdf(pdf_data, signed_pdf_data, txn_id, cn, request_data):
+    """
+    Write the signed PDF to signed_pdfs, log the success and return the response dict.
+
+    The base64 copy of the signed PDF is only included for the 'base64' response mode.
+    """
+    # Save the signed PDF to a file
+    signed_pdf_filename = get_signed_pdf_filename(txn_id)
+    signed_pdf_path = f"{SIGNED_PDF_FOLDER}/{signed_pdf_filename}"
+
+    # Ensure the directory exists
+    os.makedirs(SIGNED_PDF_FOLDER, exist_ok=True)
+
+    # Save signed PDF (original PDF data followed by the signed update)
+    with time_stage('disk_write'):
+        write_signed_pdf(signed_pdf_path, pdf_data, signed_pdf_data)
+
+    # Track the file so the store can evict it later without scanning the folder
+    record_write(signed_pdf_filename, len(pdf_data) + len(signed_pdf_data))
+
+    # Generate the URL to access the signed PDF
+    signed_pdf_url = f"http://192.168.1.10:5020/signed_pdf/{signed_pdf_filename}"
+
+
+    response = {
+        "response": {
+            "command": "managexsign",
+            "ts": request_data.get('request', {}).get('timestamp'),
+            "txn": txn_id,
+            "status": "ok",
+            "file": {
+                "attribute": {
+                    "Name": cn,
+                    "Type": "pdf"
+                }
+            },
+            "signed_pdf_url": signed_pdf_url,
+        },
+    }
+
+    # Combine the signed PDF data into base64 for response
+    if get_response_mode(request_data) == 'base64':
+        with time_stage('response_encode'):
+            response["response"]["signed_pdf_data"] = b64encode_concat(pdf_data, signed_pdf_data)
+
+    # Log the transaction status as success
+    log_transaction(txn_id, status="success", reason="PDF signed successfully", response=response,
+                    webhook_url=request_data.get('request', {}).get('webhook_url'),
+                    email=request_data.get('request', {}).get('email'))
+
+    return response
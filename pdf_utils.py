@@ -1,18 +1,48 @@
 import io
+import os
+import mmap
 import logging
+import tempfile
 import base64
 import requests
 import PyPDF2
+import fitz  # PyMuPDF
+
+def probe_pdf(pdf_data):
+    """
+    Read the page count and basic structure of a PDF without parsing its pages.
+
+    PyMuPDF only loads the trailer, the xref and the page tree root (/Pages /Count)
+    here, so the cost does not grow with the page content. Falls back to a full
+    PyPDF2 parse for files PyMuPDF refuses to open.
+
+    Returns:
+        dict: page_count and is_encrypted (0 / False on failure).
+    """
+    try:
+        with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+            return {
+                'page_count': doc.page_count,
+                'is_encrypted': bool(doc.needs_pass),
+            }
+    except Exception as e:
+        logging.warning(f"PyMuPDF could not probe PDF, falling back to PyPDF2: {str(e)}")
 
-def get_pdf_page_count(pdf_data):
     try:
         # Create a PDF reader object from the PDF data
         pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_data))
-        # Return the number of pages
-        return len(pdf_reader.pages)
+        return {
+            'page_count': len(pdf_reader.pages),
+            'is_encrypted': pdf_reader.is_encrypted,
+        }
     except Exception as e:
         logging.error(f"Error reading PDF: {str(e)}")
-        return 0
+        return {'page_count': 0, 'is_encrypted': False}
+
+
+def get_pdf_page_count(pdf_data):
+    # Return the number of pages
+    return probe_pdf(pdf_data)['page_count']
 
 def is_valid_pdf_base64(pdf_base64):
     try:
@@ -25,3 +55,58 @@ def is_valid_pdf_base64(pdf_base64):
         logging.error(f"Invalid base64 PDF: {str(e)}")
     return None  # Invalid PDF base64
 
+
+class PDFTooLarge(Exception):
+    """Raised while spooling when the body grows past the allowed size."""
+
+
+def spool_stream(stream, max_bytes, memory_bytes, chunk_size=64 * 1024):
+    """
+    Copy a request body stream into a temporary file chunk by chunk.
+
+    The file stays in memory up to memory_bytes and is moved to disk beyond that, so a
+    large upload never has to be held in memory as a whole while it is received.
+
+    Returns:
+        SpooledTemporaryFile: The spooled body, rewound to the start.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=memory_bytes)
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            spool.close()
+            raise PDFTooLarge()
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+def spooled_size(spool):
+    """Size of a spooled body; the position is left at the start."""
+    spool.seek(0, os.SEEK_END)
+    size = spool.tell()
+    spool.seek(0)
+    return size
+
+
+def map_spooled(spool, memory_bytes):
+    """
+    The spooled body as a read-only buffer, without reading it into memory.
+
+    A body spooled to disk is memory-mapped, so its pages come from the page cache
+    instead of a private copy per request; one still held in memory is read as bytes.
+
+    Returns:
+        bytes or memoryview: The body.
+    """
+    if spooled_size(spool) <= memory_bytes:
+        return spool.read()
+    try:
+        fileno = spool.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return spool.read()
+    return memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
@@ -0,0 +1,456 @@
+# pkcs11_backend.py
+"""
+Signing with keys that stay in a PKCS#11 token (HSM, smart card or SoftHSM).
+
+An SN listed in PKCS11_SIGNERS in managex_signer.config is signed with the token key
+instead of a PFX. Its certificate (and any issuer certificates on the token) is read
+from the token once; the private key is represented by a cryptography RSA key object
+whose sign() runs C_Sign on the token, so endesive and the hash-signing path use it like
+a PFX key.
+
+Every token gets a pool of PKCS11_SESSIONS_PER_TOKEN sessions per process, opened and
+logged in up front, so C_OpenSession / C_Login are not paid per signature. The pool
+size is also the number of signatures run on the token at once (capped to the token's
+own session limit); a request that finds no free session within PKCS11_ACQUIRE_TIMEOUT
+gets 503. Idle sessions are checked every PKCS11_HEALTH_INTERVAL seconds and broken ones
+reopened.
+
+Sessions belong to the process that opened them and are opened on first use in each
+worker, never in the gunicorn master.
+"""
+import os
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from config_loader import load_config
+from metrics import Counter, Gauge, Histogram
+from transaction_tracker import log_transaction
+from signing_executor import SigningExecutorBusy
+from env import PKCS11_SESSIONS_PER_TOKEN, PKCS11_ACQUIRE_TIMEOUT, PKCS11_HEALTH_INTERVAL
+
+try:
+    import PyKCS11
+except ImportError:  # Only needed when PKCS11_SIGNERS is set
+    PyKCS11 = None
+
+# DER DigestInfo prefixes for RSA PKCS#1 v1.5 (CKM_RSA_PKCS signs DigestInfo || digest)
+DIGEST_INFO_PREFIXES = {
+    'sha256': bytes.fromhex('3031300d060960864801650304020105000420'),
+    'sha384': bytes.fromhex('3041300d060960864801650304020205000430'),
+    'sha512': bytes.fromhex('3051300d060960864801650304020305000440'),
+}
+
+# Errors after which a session is closed instead of going back to the pool
+_BROKEN_SESSION_ERRORS = (
+    'CKR_SESSION_HANDLE_INVALID', 'CKR_SESSION_CLOSED', 'CKR_DEVICE_ERROR', 'CKR_DEVICE_REMOVED',
+    'CKR_TOKEN_NOT_PRESENT', 'CKR_USER_NOT_LOGGED_IN', 'CKR_CRYPTOKI_NOT_INITIALIZED',
+)
+
+PKCS11_EVENTS = Counter(
+    'mx_pkcs11_session_events_total', 'PKCS#11 session pool events (opened, closed, broken, busy, unhealthy), by token',
+    ('token', 'event'))
+PKCS11_SIGN = Histogram('mx_pkcs11_sign_seconds', 'Time of one signature on the token, by token', ('token',))
+
+
+# Signers are read from managex_signer.config on first use
+_settings = {'config': None}
+_settings_lock = threading.Lock()
+
+
+def _config():
+    with _settings_lock:
+        if _settings['config'] is None:
+            try:
+                _settings['config'] = load_config()
+            except Exception as e:
+                print(f"Error loading PKCS#11 settings: {e}")
+                _settings['config'] = {}
+        return _settings['config']
+
+
+def get_signer(SN):
+    """PKCS11_SIGNERS entry for SN (library, token, pin and key_label or key_id), or None."""
+    signers = _config().get('PKCS11_SIGNERS') or {}
+    return {key.lower(): value for key, value in signers.items()}.get((SN or '').lower())
+
+
+def is_pkcs11_signer(SN):
+    return get_signer(SN) is not None
+
+
+def _error_name(error):
+    return PyKCS11.CKR.get(error.value, str(error.value)) if isinstance(error.value, int) else str(error.value)
+
+
+class SessionPool:
+    """Logged-in sessions to one token, handed out one signature at a time."""
+
+    def __init__(self, library, token_label, pin):
+        self.token_label = token_label
+        self._pin = pin
+        self._lib = PyKCS11.PyKCS11Lib()
+        self._lib.load(library)
+        self.slot = self._find_slot()
+
+        # Never more sessions than the token allows (0 or "unavailable" means no stated limit)
+        size = PKCS11_SESSIONS_PER_TOKEN
+        max_sessions = self._lib.getTokenInfo(self.slot).ulMaxSessionCount
+        if 0 < max_sessions < 2 ** 31:
+            size = min(size, max_sessions)
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._in_use = 0
+        self.healthy = True
+        for _ in range(size):
+            self._idle.append(self._open())
+
+    def _find_slot(self):
+        for slot in self._lib.getSlotList(tokenPresent=True):
+            if self._lib.getTokenInfo(slot).label.strip().rstrip('\0') == self.token_label:
+                return slot
+        raise ValueError(f"PKCS#11 token '{self.token_label}' not found")
+
+    def _open(self):
+        session = self._lib.openSession(self.slot, PyKCS11.CKF_SERIAL_SESSION)
+        try:
+            session.login(self._pin)
+        except PyKCS11.PyKCS11Error as e:
+            # The login is shared by all sessions of this process to the token
+            if e.value != PyKCS11.CKR_USER_ALREADY_LOGGED_IN:
+                session.closeSession()
+                raise
+        PKCS11_EVENTS.inc(token=self.token_label, event='opened')
+        return session
+
+    def _close(self, session, event='closed'):
+        try:
+            session.closeSession()
+        except Exception:
+            pass
+        PKCS11_EVENTS.inc(token=self.token_label, event=event)
+
+    @contextmanager
+    def session(self, timeout=None):
+        """
+        Borrow a logged-in session.
+
+        Raises:
+            SigningExecutorBusy: If every session stayed in use for timeout
+                (default PKCS11_ACQUIRE_TIMEOUT) seconds.
+        """
+        if not self._slots.acquire(timeout=PKCS11_ACQUIRE_TIMEOUT if timeout is None else timeout):
+            PKCS11_EVENTS.inc(token=self.token_label, event='busy')
+            raise SigningExecutorBusy()
+
+        session = None
+        with self._lock:
+            self._in_use += 1
+            if self._idle:
+                session = self._idle.pop()
+        try:
+            if session is None:
+                session = self._open()
+            yield session
+        except PyKCS11.PyKCS11Error as e:
+            if session is not None and _error_name(e) in _BROKEN_SESSION_ERRORS:
+                self._close(session, 'broken')
+                session = None
+            raise
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                # One opened while a health check held the idle sessions is not kept
+                if session is not None and len(self._idle) < self.size:
+                    self._idle.append(session)
+                    session = None
+            if session is not None:
+                self._close(session)
+            self._slots.release()
+
+    def check(self):
+        """Close idle sessions that are no longer logged in and open replacements."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        alive = []
+        for session in idle:
+            try:
+                state = session.getSessionInfo().state
+                if state in (PyKCS11.CKS_RO_USER_FUNCTIONS, PyKCS11.CKS_RW_USER_FUNCTIONS):
+                    alive.append(session)
+                    continue
+            except PyKCS11.PyKCS11Error:
+                pass
+            self._close(session, 'broken')
+
+        try:
+            while len(alive) < len(idle):
+                alive.append(self._open())
+            self.healthy = True
+        except Exception as e:
+            self.healthy = False
+            PKCS11_EVENTS.inc(token=self.token_label, event='unhealthy')
+            print(f"PKCS#11 token '{self.token_label}' failed its health check: {e}")
+        finally:
+            with self._lock:
+                self._idle.extend(alive)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            self._close(session)
+
+    def counts(self):
+        with self._lock:
+            return {'idle': len(self._idle), 'in_use': self._in_use}
+
+
+# Pools keyed by (library, token label), and key handles keyed by SN; both per process
+_pools = {}
+_key_handles = {}
+_credentials = {}
+_state = {'pid': None}
+_state_lock = threading.Lock()
+
+# One lock per pool key, held while that token's pool is being opened
+_pool_locks = {}
+
+
+def _reset_after_fork():
+    # Sessions and handles are only valid in the process that opened them
+    if _state['pid'] != os.getpid():
+        _pools.clear()
+        _key_handles.clear()
+        _credentials.clear()
+        _pool_locks.clear()  # May have been held by another thread at the fork
+        _state['pid'] = os.getpid()
+        threading.Thread(target=_health_loop, daemon=True).start()
+
+
+def _get_pool(signer):
+    if PyKCS11 is None:
+        raise ValueError("PyKCS11 is not installed. Install it with: pip install -r requirements.txt")
+
+    key = (signer['library'], signer['token'])
+    with _state_lock:
+        _reset_after_fork()
+        pool = _pools.get(key)
+        if pool is not None and pool.healthy:
+            return pool
+        creating = _pool_locks.setdefault(key, threading.Lock())
+
+    # Opening and logging in the sessions can take long on a slow token, so it is done
+    # outside _state_lock: only requests for this token wait for it
+    with creating:
+        with _state_lock:
+            pool = _pools.get(key)
+            if pool is not None and pool.healthy:
+                return pool  # Opened by another request meanwhile
+
+            # First use in this process, or the token failed its health check: start over
+            if pool is not None:
+                del _pools[key]
+                for SN in [SN for SN, handle in _key_handles.items() if handle[0] is pool]:
+                    del _key_handles[SN]
+        if pool is not None:
+            pool.close()
+
+        pool = SessionPool(signer['library'], signer['token'], str(signer['pin']))
+        with _state_lock:
+            _pools[key] = pool
+        return pool
+
+
+def _key_template(signer, object_class):
+    template = [(PyKCS11.CKA_CLASS, object_class)]
+    if signer.get('key_id'):
+        template.append((PyKCS11.CKA_ID, bytes.fromhex(signer['key_id'])))
+    if signer.get('key_label'):
+        template.append((PyKCS11.CKA_LABEL, signer['key_label']))
+    return template
+
+
+def _find_key(pool, SN, signer):
+    """Handle of the private key of SN in pool, looked up once per process."""
+    with _state_lock:
+        handle = _key_handles.get(SN)
+    if handle is not None and handle[0] is pool:
+        return handle[1]
+
+    with pool.session() as session:
+        keys = session.findObjects(_key_template(signer, PyKCS11.CKO_PRIVATE_KEY))
+    if not keys:
+        raise ValueError(f"No private key for Serial No. [{SN}] on PKCS#11 token '{signer['token']}'")
+    with _state_lock:
+        _key_handles[SN] = (pool, keys[0])
+    return keys[0]
+
+
+def _read_certificates(pool, signer):
+    """The signer's certificate and the issuer certificates found on the token."""
+    with pool.session() as session:
+        certificate_handles = session.findObjects([(PyKCS11.CKA_CLASS, PyKCS11.CKO_CERTIFICATE)])
+        certificates = [
+            x509.load_der_x509_certificate(bytes(session.getAttributeValue(handle, [PyKCS11.CKA_VALUE], True)[0]))
+            for handle in certificate_handles
+        ]
+        signer_handles = session.findObjects(_key_template(signer, PyKCS11.CKO_CERTIFICATE))
+        if not signer_handles:
+            raise ValueError(f"No certificate matching the key on PKCS#11 token '{signer['token']}'")
+        certificate = x509.load_der_x509_certificate(
+            bytes(session.getAttributeValue(signer_handles[0], [PyKCS11.CKA_VALUE], True)[0]))
+
+    chain = []
+    issuer = certificate
+    while issuer.issuer != issuer.subject:
+        issuer = next((c for c in certificates if c.subject == issuer.issuer and c not in chain), None)
+        if issuer is None:
+            break
+        chain.append(issuer)
+    return certificate, chain
+
+
+class TokenPrivateKey(rsa.RSAPrivateKey):
+    """RSA key that signs on the token with a pooled session; the key material never leaves it."""
+
+    def __init__(self, SN, signer, certificate):
+        self._SN = SN
+        self._signer = signer
+        self._certificate = certificate
+
+    def sign(self, data, padding_, algorithm):
+        if not isinstance(padding_, padding.PKCS1v15):
+            raise ValueError("Only PKCS#1 v1.5 signatures are supported with PKCS#11 keys")
+        if isinstance(algorithm, Prehashed):
+            name, digest = algorithm._algorithm.name, data
+        else:
+            name, digest = algorithm.name, hashlib.new(algorithm.name, data).digest()
+        if name not in DIGEST_INFO_PREFIXES:
+            raise ValueError(f"Unsupported digest for PKCS#11 signing: {name}")
+
+        # The digest is made here and only DigestInfo || digest is sent, which every token supports
+        pool = _get_pool(self._signer)
+        handle = _find_key(pool, self._SN, self._signer)
+        started = time.perf_counter()
+        try:
+            with pool.session() as session:
+                return bytes(session.sign(handle, DIGEST_INFO_PREFIXES[name] + digest,
+                                          PyKCS11.Mechanism(PyKCS11.CKM_RSA_PKCS)))
+        except PyKCS11.PyKCS11Error as e:
+            if _error_name(e) in ('CKR_KEY_HANDLE_INVALID', 'CKR_OBJECT_HANDLE_INVALID'):
+                with _state_lock:
+                    _key_handles.pop(self._SN, None)
+            raise
+        finally:
+            PKCS11_SIGN.observe(time.perf_counter() - started, token=self._signer['token'])
+
+    def public_key(self):
+        return self._certificate.public_key()
+
+    @property
+    def key_size(self):
+        return self._certificate.public_key().key_size
+
+    def decrypt(self, ciphertext, padding_):
+        raise TypeError("PKCS#11 keys are only used for signing")
+
+    def private_numbers(self):
+        raise TypeError("PKCS#11 private keys cannot be exported")
+
+    def private_bytes(self, *args, **kwargs):
+        raise TypeError("PKCS#11 private keys cannot be exported")
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def get_pkcs11_credential(SN, txn_id):
+    """
+    (private_key, certificate, additional_certificates) for a PKCS#11 signer, in the same
+    form as a loaded PFX. The certificate is read from the token once per process.
+    A failure is logged against txn_id; with txn_id None (pre-warming) it is only raised.
+    """
+    SN = SN.lower()
+    with _state_lock:
+        _reset_after_fork()
+        credential = _credentials.get(SN)
+    if credential is not None:
+        return credential
+
+    signer = get_signer(SN)
+    try:
+        pool = _get_pool(signer)
+        certificate, chain = _read_certificates(pool, signer)
+        if format(certificate.serial_number, 'x') != SN.lstrip('0'):
+            raise ValueError(f"Certificate on the token has Serial No. [{certificate.serial_number:x}], not [{SN}]")
+
+        if not isinstance(certificate.public_key(), rsa.RSAPublicKey):
+            raise ValueError("Only RSA keys are supported for PKCS#11 signing")
+        key = TokenPrivateKey(SN, signer, certificate)
+        _find_key(pool, SN, signer)
+    except SigningExecutorBusy:
+        raise
+    except Exception as e:
+        if txn_id is not None:
+            log_transaction(txn_id, "failure", f"Error loading PKCS#11 key: {e}")
+        raise ValueError(f"Error loading PKCS#11 key: {e}")
+
+    credential = (key, certificate, chain)
+    with _state_lock:
+        _credentials[SN] = credential
+    return credential
+
+
+def prewarm_pkcs11():
+    """Open the session pools of every configured PKCS#11 signer in this process."""
+    signers = _config().get('PKCS11_SIGNERS') or {}
+    loaded = 0
+    for SN in signers:
+        try:
+            # No transaction ID: a failure here is printed below, not logged as a transaction
+            get_pkcs11_credential(SN, None)
+            loaded += 1
+        except Exception as e:
+            print(f"Error opening PKCS#11 signer {SN}: {e}")
+    return loaded
+
+
+def _health_loop():
+    pid = os.getpid()
+    while _state['pid'] == pid:
+        time.sleep(PKCS11_HEALTH_INTERVAL)
+        with _state_lock:
+            pools = list(_pools.values())
+        for pool in pools:
+            pool.check()
+
+
+def _session_counts():
+    counts = {}
+    with _state_lock:
+        pools = list(_pools.values()) if _state['pid'] == os.getpid() else []
+    for pool in pools:
+        for state, count in pool.counts().items():
+            counts[(pool.token_label, state)] = count
+    return counts
+
+
+def _pool_health():
+    with _state_lock:
+        pools = list(_pools.values()) if _state['pid'] == os.getpid() else []
+    return {(pool.token_label,): int(pool.healthy) for pool in pools}
+
+
+Gauge('mx_pkcs11_sessions', 'PKCS#11 sessions per token, idle or in use', ('token', 'state'), function=_session_counts)
+Gauge('mx_pkcs11_pool_healthy', '1 while the token passed its last health check', ('token',), function=_pool_health)
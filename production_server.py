@@ -0,0 +1,109 @@
+# production_server.py
+import os
+import platform
+from config_loader import load_config
+from credential_cache import prewarm
+from validation import PIN_FOLDER
+from transaction_tracker import reinit_after_fork
+from job_queue import start_job_workers
+from pkcs11_backend import prewarm_pkcs11
+
+
+def warm_shared_state():
+    """
+    Load everything workers would otherwise load on their first request.
+
+    Called once in the master before workers are forked, so the parsed config, the
+    decrypted credentials and the PDF appearance/font modules are shared copy-on-write.
+    """
+    config = load_config()
+
+    loaded = prewarm(PIN_FOLDER)
+    print(f"Pre-warmed {loaded} signing credential(s)")
+
+    # Importing the appearance modules loads endesive's default font once
+    from endesive.pdf.PyPDF2_annotate.annotations.signature import Signature  # noqa: F401
+    import fitz  # noqa: F401
+
+    return config
+
+
+def run_gunicorn(app, config):
+    """Run app under gunicorn with gthread workers (Linux / macOS)."""
+    from gunicorn.app.base import BaseApplication
+
+    class SignerApplication(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                if key in self.cfg.settings and value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    def on_starting(server):
+        warm_shared_state()
+
+    def on_reload(server):
+        # SIGHUP: re-read the config and credentials before the new workers are forked
+        warm_shared_state()
+
+    def post_fork(server, worker):
+        # Threads do not survive fork; every worker needs its own journal writer and job workers
+        reinit_after_fork()
+        start_job_workers()
+
+        # PKCS#11 sessions cannot be shared across a fork, so each worker logs in to its tokens
+        prewarm_pkcs11()
+
+    options = {
+        'bind': f"{config.get('FLASK_HOST', '0.0.0.0')}:{config.get('FLASK_PORT', 5020)}",
+        'workers': config.get('SERVER_WORKERS', 4),
+        'threads': config.get('SERVER_THREADS', 8),
+        'worker_class': 'gthread',
+        'keepalive': config.get('SERVER_KEEPALIVE', 5),
+        'timeout': config.get('SERVER_TIMEOUT', 120),
+        'graceful_timeout': config.get('SERVER_GRACEFUL_TIMEOUT', 30),
+        'max_requests': config.get('SERVER_MAX_REQUESTS', 0),
+        'max_requests_jitter': config.get('SERVER_MAX_REQUESTS', 0) // 10,
+        'preload_app': True,
+        'on_starting': on_starting,
+        'on_reload': on_reload,
+        'post_fork': post_fork,
+    }
+    SignerApplication(app, options).run()
+
+
+def run_waitress(app, config):
+    """Run app under waitress (Windows, where gunicorn is not available); one process, many threads."""
+    from waitress import serve
+
+    warm_shared_state()
+    start_job_workers()
+    prewarm_pkcs11()
+    serve(
+        app,
+        host=config.get('FLASK_HOST', '0.0.0.0'),
+        port=config.get('FLASK_PORT', 5020),
+        threads=config.get('SERVER_THREADS', 8),
+        channel_timeout=config.get('SERVER_TIMEOUT', 120),
+    )
+
+
+def run_production_server(app, config):
+    """Serve app with the production WSGI server for this platform."""
+    try:
+        if platform.system() == "Windows":
+            run_waitress(app, config)
+        else:
+            run_gunicorn(app, config)
+    except ImportError as e:
+        raise RuntimeError(
+            f"SERVER_MODE is 'production' but the WSGI server is not installed ({e}). "
+            "Install it with: pip install -r requirements.txt"
+        )
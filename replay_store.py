@@ -0,0 +1,106 @@
+# replay_store.py
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from env import (
+    TIMESTAMP_WINDOW_SECONDS,
+    REPLAY_STORE_BACKEND,
+    REPLAY_STORE_BUCKET_SECONDS
+)
+
+# A request is accepted while its timestamp is within +/- TIMESTAMP_WINDOW_SECONDS of now,
+# so the same ID could be replayed for up to twice the window after it was first seen.
+REPLAY_RETENTION_SECONDS = 2 * TIMESTAMP_WINDOW_SECONDS
+
+REPLAY_DB_FILE = os.path.join(os.getcwd(), 'replay_store.db')
+
+
+class MemoryReplayStore:
+    """Per-process store: one set of IDs per time bucket, whole buckets dropped on expiry."""
+
+    def __init__(self, retention_seconds, bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+        self.retention_buckets = -(-retention_seconds // bucket_seconds) + 1
+        self._buckets = OrderedDict()  # bucket number -> set of transaction IDs
+        self._lock = threading.Lock()
+
+    def check_and_add(self, transaction_id, now=None):
+        bucket = int((now or time.time()) // self.bucket_seconds)
+        with self._lock:
+            # Expire whole buckets that fell out of the retention window
+            while self._buckets and next(iter(self._buckets)) <= bucket - self.retention_buckets:
+                self._buckets.popitem(last=False)
+
+            for ids in self._buckets.values():
+                if transaction_id in ids:
+                    return False
+
+            self._buckets.setdefault(bucket, set()).add(transaction_id)
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(ids) for ids in self._buckets.values())
+
+
+class SQLiteReplayStore:
+    """On-disk store shared by every worker process; the primary key makes check-and-add atomic."""
+
+    def __init__(self, path, retention_seconds, bucket_seconds):
+        self.path = path
+        self.bucket_seconds = bucket_seconds
+        self.retention_buckets = -(-retention_seconds // bucket_seconds) + 1
+        self._local = threading.local()
+        self._purged_bucket = None
+
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS seen_transactions ("
+            "transaction_id TEXT PRIMARY KEY, bucket INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        self._connection().execute(
+            "CREATE INDEX IF NOT EXISTS seen_transactions_bucket ON seen_transactions (bucket)"
+        )
+
+    def _connection(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def check_and_add(self, transaction_id, now=None):
+        bucket = int((now or time.time()) // self.bucket_seconds)
+        cutoff = bucket - self.retention_buckets + 1
+        connection = self._connection()
+
+        # Drop expired buckets once per bucket period
+        if self._purged_bucket != bucket:
+            self._purged_bucket = bucket
+            connection.execute("DELETE FROM seen_transactions WHERE bucket < ?", (cutoff,))
+
+        # New IDs are inserted; an expired leftover row is taken over; a live row is a replay
+        cursor = connection.execute(
+            "INSERT INTO seen_transactions (transaction_id, bucket) VALUES (?, ?) "
+            "ON CONFLICT(transaction_id) DO UPDATE SET bucket = excluded.bucket "
+            "WHERE seen_transactions.bucket < ?",
+            (transaction_id, bucket, cutoff),
+        )
+        return cursor.rowcount == 1
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM seen_transactions").fetchone()[0]
+
+
+def create_replay_store(backend=REPLAY_STORE_BACKEND):
+    if backend == 'sqlite':
+        return SQLiteReplayStore(REPLAY_DB_FILE, REPLAY_RETENTION_SECONDS, REPLAY_STORE_BUCKET_SECONDS)
+    return MemoryReplayStore(REPLAY_RETENTION_SECONDS, REPLAY_STORE_BUCKET_SECONDS)
+
+
+# Shared replay store used by request validation
+replay_store = create_replay_store()
@@ -0,0 +1,428 @@
+# revocation.py
+"""
+Revocation checking (OCSP / CRL) for the signing certificate chain, with a shared cache.
+
+OCSP responses are cached per issuer and serial number, CRLs per distribution point.
+Both are reused until their nextUpdate and refreshed in the background shortly before
+it, so signing thousands of documents with the same certificate does not go to the
+network each time. A CRL is parsed once into a set of revoked serial numbers. The DER
+responses and CRLs are embedded in the signed PDF's Document Security Store (LTV).
+
+Only http(s) URLs are taken from a certificate. REVOCATION_URL_OVERRIDES in
+managex_signer.config can point a certificate's URL elsewhere, including a file:// URL
+or path, so a local CRL file can stand in for a distribution point. Every response or
+file is read up to REVOCATION_MAX_BYTES.
+"""
+import os
+import time
+import threading
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+import requests
+from requests.adapters import HTTPAdapter
+from cryptography import x509
+from cryptography.x509 import ocsp, ExtensionOID, AuthorityInformationAccessOID, ExtendedKeyUsageOID
+from cryptography.x509 import load_der_x509_crl, load_pem_x509_crl
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.hashes import SHA1
+from cryptography.hazmat.primitives.asymmetric import padding, ec, rsa
+from config_loader import load_config
+from metrics import Counter, Gauge, Histogram
+from env import (
+    REVOCATION_MODE,
+    REVOCATION_TIMEOUT,
+    REVOCATION_DEFAULT_TTL,
+    REVOCATION_REFRESH_BEFORE,
+    REVOCATION_REFRESH_INTERVAL,
+    REVOCATION_IDLE_SECONDS,
+    REVOCATION_FAILURE_BACKOFF,
+    REVOCATION_MAX_BYTES
+)
+
+REVOCATION_EVENTS = Counter(
+    'mx_revocation_cache_events_total', 'Revocation cache hits, misses, refreshes and fetch errors, by source',
+    ('source', 'event'))
+REVOCATION_FETCH_DURATION = Histogram(
+    'mx_revocation_fetch_seconds', 'Time to fetch and verify one OCSP response or CRL', ('source',))
+
+# ('ocsp', issuer fingerprint, serial) or ('crl', url) -> entry with 'der', 'next_update' (epoch),
+# 'last_used', 'loader' and either 'status' (OCSP) or 'revoked' (set of serials, CRL)
+_cache = {}
+_cache_lock = threading.Lock()
+_fetch_locks = {}  # One lock per key, so concurrent misses fetch once
+_failed_until = {}  # key -> time before which a failed fetch is not retried
+_refresher = {'pid': None}
+
+
+class RevocationCheckFailed(Exception):
+    """Signing refused because of the certificate's revocation status."""
+
+    def __init__(self, message, status=403):
+        super().__init__(message)
+        self.status = status
+
+
+class _BackingOff(Exception):
+    """The source failed recently and is not tried again yet."""
+
+
+# HTTP: one keep-alive session per thread
+_http = threading.local()
+
+
+def _session():
+    if getattr(_http, 'session', None) is None:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        _http.session = session
+    return _http.session
+
+
+# URL overrides are read from managex_signer.config on first use
+_settings = {'config': None}
+_settings_lock = threading.Lock()
+
+
+def _config():
+    with _settings_lock:
+        if _settings['config'] is None:
+            try:
+                _settings['config'] = load_config()
+            except Exception as e:
+                print(f"Error loading revocation settings: {e}")
+                _settings['config'] = {}
+        return _settings['config']
+
+
+def _resolve_source(url):
+    """
+    Where to fetch a certificate's OCSP / CRL URL from.
+
+    Returns:
+        tuple: (url, local path) where the path is set only for a configured file override.
+
+    Raises:
+        ValueError: For a URL that is not http(s) and has no override.
+    """
+    override = (_config().get('REVOCATION_URL_OVERRIDES') or {}).get(url)
+    if override:
+        parsed = urlparse(override)
+        if parsed.scheme == 'file':
+            return override, url2pathname(parsed.path)
+        if not parsed.scheme or len(parsed.scheme) == 1:  # Plain path (or a Windows drive letter)
+            return override, override
+        url = override
+
+    # Never file://, ldap:// or paths from the certificate itself
+    if urlparse(url).scheme not in ('http', 'https'):
+        raise ValueError(f"Unsupported revocation URL: {url}")
+    return url, None
+
+
+def _read_local(path):
+    # Regular files only: a FIFO or device would block or never end
+    if not os.path.isfile(path):
+        raise ValueError(f"{path} is not a regular file")
+    with open(path, 'rb') as f:
+        data = f.read(REVOCATION_MAX_BYTES + 1)
+    if len(data) > REVOCATION_MAX_BYTES:
+        raise ValueError(f"{path} is larger than {REVOCATION_MAX_BYTES} bytes")
+    return data
+
+
+def _read_response(http_response):
+    """Body of a streamed response, refused beyond REVOCATION_MAX_BYTES."""
+    with http_response:
+        http_response.raise_for_status()
+        data = bytearray()
+        for chunk in http_response.iter_content(65536):
+            data += chunk
+            if len(data) > REVOCATION_MAX_BYTES:
+                raise ValueError(f"Response from {http_response.url} is larger than {REVOCATION_MAX_BYTES} bytes")
+    return bytes(data)
+
+
+def _expiry(next_update):
+    if next_update is None:
+        return time.time() + REVOCATION_DEFAULT_TTL
+    return next_update.timestamp()
+
+
+def _verify_signature(public_key, signature, data, hash_algorithm):
+    if isinstance(public_key, rsa.RSAPublicKey):
+        public_key.verify(signature, data, padding.PKCS1v15(), hash_algorithm)
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        public_key.verify(signature, data, ec.ECDSA(hash_algorithm))
+    else:
+        public_key.verify(signature, data)
+
+
+def _verify_ocsp_response(response, issuer):
+    """The response must be signed by the issuer or by an OCSP responder the issuer delegated to."""
+    candidates = [issuer]
+    for certificate in response.certificates:
+        try:
+            certificate.verify_directly_issued_by(issuer)
+            usage = certificate.extensions.get_extension_for_oid(ExtensionOID.EXTENDED_KEY_USAGE).value
+        except Exception:
+            continue
+        if ExtendedKeyUsageOID.OCSP_SIGNING in usage:
+            candidates.append(certificate)
+
+    for responder in candidates:
+        try:
+            _verify_signature(responder.public_key(), response.signature, response.tbs_response_bytes,
+                              response.signature_hash_algorithm)
+            return
+        except Exception:
+            continue
+    raise ValueError("OCSP response signature is not valid for the certificate issuer")
+
+
+def _fetch_ocsp(cert, issuer, url):
+    request = ocsp.OCSPRequestBuilder().add_certificate(cert, issuer, SHA1()).build()
+    data = request.public_bytes(serialization.Encoding.DER)
+    url, path = _resolve_source(url)
+    if path is not None:
+        der = _read_local(path)
+    else:
+        der = _read_response(_session().post(
+            url, data=data, headers={'Content-Type': 'application/ocsp-request'},
+            timeout=REVOCATION_TIMEOUT, stream=True))
+
+    response = ocsp.load_der_ocsp_response(der)
+    if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+        raise ValueError(f"OCSP responder answered {response.response_status.name}")
+    if response.serial_number != cert.serial_number:
+        raise ValueError("OCSP response is for a different certificate")
+    _verify_ocsp_response(response, issuer)
+
+    status = {
+        ocsp.OCSPCertStatus.GOOD: 'good',
+        ocsp.OCSPCertStatus.REVOKED: 'revoked',
+    }.get(response.certificate_status, 'unknown')
+    return {'der': der, 'status': status, 'next_update': _expiry(response.next_update_utc)}
+
+
+def _fetch_crl(url, issuer):
+    url, path = _resolve_source(url)
+    if path is not None:
+        data = _read_local(path)
+    else:
+        data = _read_response(_session().get(url, timeout=REVOCATION_TIMEOUT, stream=True))
+
+    crl = load_pem_x509_crl(data) if data.lstrip().startswith(b'-----') else load_der_x509_crl(data)
+    if crl.issuer != issuer.subject or not crl.is_signature_valid(issuer.public_key()):
+        raise ValueError("CRL is not signed by the certificate issuer")
+
+    # Indexed once; every later lookup is a set membership test
+    revoked = frozenset(entry.serial_number for entry in crl)
+    return {'der': crl.public_bytes(serialization.Encoding.DER), 'revoked': revoked,
+            'next_update': _expiry(crl.next_update_utc)}
+
+
+def _ensure_refresher():
+    # Threads do not survive a fork, so every worker process starts its own
+    with _cache_lock:
+        if _refresher['pid'] == os.getpid():
+            return
+        _refresher['pid'] = os.getpid()
+    threading.Thread(target=_refresh_loop, daemon=True).start()
+
+
+def _get(key, loader):
+    """Return the cached entry for key while it is before its nextUpdate, fetching it otherwise."""
+    source = key[0]
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry['next_update'] > time.time():
+            entry['last_used'] = time.time()
+            REVOCATION_EVENTS.inc(source=source, event='hit')
+            return entry
+        fetch_lock = _fetch_locks.setdefault(key, threading.Lock())
+
+    with fetch_lock:
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry is not None and entry['next_update'] > time.time():
+                entry['last_used'] = time.time()
+                REVOCATION_EVENTS.inc(source=source, event='hit')
+                return entry
+
+        # A source that just failed is skipped for a while instead of costing a timeout per signature
+        if _failed_until.get(key, 0) > time.time():
+            raise _BackingOff()
+
+        REVOCATION_EVENTS.inc(source=source, event='miss')
+        _ensure_refresher()
+        try:
+            with REVOCATION_FETCH_DURATION.time(source=source):
+                entry = loader()
+        except Exception:
+            REVOCATION_EVENTS.inc(source=source, event='error')
+            _failed_until[key] = time.time() + REVOCATION_FAILURE_BACKOFF
+            raise
+        entry.update(loader=loader, last_used=time.time())
+        with _cache_lock:
+            _cache[key] = entry
+            _failed_until.pop(key, None)
+        return entry
+
+
+def refresh_cache():
+    """Refetch entries close to their nextUpdate and drop idle ones. Returns the number refreshed."""
+    now = time.time()
+    with _cache_lock:
+        for key in [key for key, entry in _cache.items() if now - entry['last_used'] > REVOCATION_IDLE_SECONDS]:
+            del _cache[key]
+            _fetch_locks.pop(key, None)
+        for key in [key for key, until in _failed_until.items() if until < now]:
+            del _failed_until[key]
+        for key in [key for key in _fetch_locks if key not in _cache and key not in _failed_until]:
+            del _fetch_locks[key]
+        due = [(key, entry) for key, entry in _cache.items() if entry['next_update'] - now < REVOCATION_REFRESH_BEFORE]
+
+    refreshed = 0
+    for key, entry in due:
+        try:
+            with REVOCATION_FETCH_DURATION.time(source=key[0]):
+                fresh = entry['loader']()
+        except Exception as e:
+            # The old entry keeps being served until its nextUpdate
+            REVOCATION_EVENTS.inc(source=key[0], event='error')
+            print(f"Error refreshing revocation data {key[0]}: {e}")
+            continue
+        fresh.update(loader=entry['loader'], last_used=entry['last_used'])
+        with _cache_lock:
+            _cache[key] = fresh
+        REVOCATION_EVENTS.inc(source=key[0], event='refresh')
+        refreshed += 1
+    return refreshed
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(REVOCATION_REFRESH_INTERVAL)
+        try:
+            refresh_cache()
+        except Exception as e:
+            print(f"Error refreshing revocation cache: {e}")
+
+
+def _ocsp_url(cert):
+    try:
+        access = cert.extensions.get_extension_for_oid(ExtensionOID.AUTHORITY_INFORMATION_ACCESS).value
+    except x509.ExtensionNotFound:
+        return None
+    for description in access:
+        if description.access_method == AuthorityInformationAccessOID.OCSP:
+            return description.access_location.value
+    return None
+
+
+def _crl_urls(cert):
+    try:
+        points = cert.extensions.get_extension_for_oid(ExtensionOID.CRL_DISTRIBUTION_POINTS).value
+    except x509.ExtensionNotFound:
+        return []
+    return [
+        name.value
+        for point in points
+        for name in (point.full_name or ())
+        if isinstance(name, x509.UniformResourceIdentifier)
+    ]
+
+
+def _issuer_of(cert, candidates):
+    for candidate in candidates:
+        if candidate.subject == cert.issuer and candidate is not cert:
+            try:
+                cert.verify_directly_issued_by(candidate)
+                return candidate
+            except Exception:
+                continue
+    return None
+
+
+def check_certificate(cert, issuer):
+    """
+    Revocation status of cert from OCSP (preferred) or its CRLs.
+
+    Returns:
+        tuple: (status, source, der) where status is 'good', 'revoked', 'unknown' or
+        'unavailable', source is 'ocsp' / 'crl' / None and der the evidence to embed.
+    """
+    url = _ocsp_url(cert)
+    if url:
+        key = ('ocsp', issuer.fingerprint(SHA1()), cert.serial_number)
+        try:
+            entry = _get(key, lambda: _fetch_ocsp(cert, issuer, url))
+            return entry['status'], 'ocsp', entry['der']
+        except _BackingOff:
+            pass
+        except Exception as e:
+            print(f"OCSP check failed for serial {cert.serial_number:x}: {e}")
+
+    for url in _crl_urls(cert):
+        try:
+            entry = _get(('crl', url), lambda url=url: _fetch_crl(url, issuer))
+            status = 'revoked' if cert.serial_number in entry['revoked'] else 'good'
+            return status, 'crl', entry['der']
+        except _BackingOff:
+            pass
+        except Exception as e:
+            print(f"CRL check failed for {url}: {e}")
+
+    return 'unavailable', None, None
+
+
+def collect_revocation_info(cert, othercerts, mode=None):
+    """
+    Check the signing certificate and its intermediate CAs and gather what to embed.
+
+    Returns:
+        dict: DER 'certs', 'ocsps' and 'crls' for the signed PDF's DSS.
+
+    Raises:
+        RevocationCheckFailed: If a certificate is revoked or, in 'require' mode, if a
+            status cannot be confirmed as good.
+    """
+    mode = mode or REVOCATION_MODE
+    othercerts = list(othercerts or [])
+    info = {
+        'certs': [c.public_bytes(serialization.Encoding.DER) for c in [cert] + othercerts],
+        'ocsps': [],
+        'crls': [],
+    }
+
+    current, seen = cert, set()
+    # Walk up the chain; self-signed roots are trusted anchors and not checked
+    while current.subject != current.issuer and current.fingerprint(SHA1()) not in seen:
+        seen.add(current.fingerprint(SHA1()))
+        issuer = _issuer_of(current, othercerts)
+        if issuer is None:
+            status, source, der = 'unavailable', None, None
+        else:
+            status, source, der = check_certificate(current, issuer)
+
+        name = current.subject.rfc4514_string()
+        if status == 'revoked':
+            raise RevocationCheckFailed(f"Certificate {name} is revoked.")
+        if status != 'good' and mode == 'require':
+            if status == 'unknown':
+                raise RevocationCheckFailed(f"Revocation status of certificate {name} is unknown.")
+            raise RevocationCheckFailed(f"Revocation status of certificate {name} could not be checked.", 503)
+
+        if der is not None:
+            evidence = info['ocsps'] if source == 'ocsp' else info['crls']
+            if der not in evidence:
+                evidence.append(der)
+        if issuer is None:
+            break
+        current = issuer
+    return info
+
+
+Gauge('mx_revocation_cache_entries', 'Cached OCSP responses and CRLs, by source', ('source',),
+      function=lambda: {(source,): sum(1 for key in list(_cache) if key[0] == source) for source in ('ocsp', 'crl')})
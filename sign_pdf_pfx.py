@@ -1,6 +1,7 @@
 import datetime
 import pytz  # Required for handling time zones
 import os
+import base64
 from flask import request, jsonify
 from endesive import pdf
 import pytz
@@ -13,104 +14,567 @@ from signer import (
 from validation import (
     validate_request_data,
     validate_pdf_data,
+    validate_pdf_bytes,
     validate_and_process_pdf_metadata,
-    validate_and_process_pdf_page_data
+    validate_and_process_pdf_page_data,
+    validate_hash_data
 )
 from transaction_tracker import log_transaction
+from credential_cache import get_credential
+from pkcs11_backend import is_pkcs11_signer, get_pkcs11_credential
+from signing_executor import submit_sign_job, SigningExecutorBusy
+from metrics import time_stage
+from admission import check_rate_limit, fair_slot
 from signature_utils import prepare_signature_dict, sign_pdf
-from pdf_processing import save_signed_pdf_and_send_response
-
-used_transaction_ids = set()
-
+from revocation import collect_revocation_info, RevocationCheckFailed
+from timestamping import (
+    timestamping_enabled,
+    tsa_required,
+    signature_reservation,
+    add_timestamp,
+    TimestampError
+)
+from hash_signing import prepare_pdf, sign_digest, timestamp_signature
+from job_queue import enqueue_job, JobQueueFull, JOB_PRIORITIES
+from pdf_processing import save_signed_pdf_and_send_response, save_signed_pdf
+from concurrent.futures import ThreadPoolExecutor
+from env import MAX_BATCH_DOCUMENTS, BATCH_SIGN_WORKERS, REVOCATION_MODE
+
+# Worker threads shared by all batch requests
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_SIGN_WORKERS, thread_name_prefix="batch-sign")
+
+# The only fields a batch document may set; everything else is shared by the whole batch
+BATCH_DOCUMENT_FIELDS = ('transaction_id', 'pdf', 'pdf_data')
+
+
+def load_signing_credential(request_data, txn_id):
+    """
+    Look up the PFX (or PKCS#11 token key) for the request's SN and return the loaded,
+    key-usage checked credential.
+    """
+    SN = request_data.get('request', {}).get('pfx', {}).get('SN')
+    if SN and is_pkcs11_signer(SN):
+        # The key stays in the token; its certificate is read once per process
+        with time_stage('load_pkcs11'):
+            p12pk, p12pc, p12oc = get_pkcs11_credential(SN, txn_id)
+        metadata_result = {'SN': SN.lower(), 'backend': 'pkcs11', 'file_path': None, 'file_pin': None}
+
+    else:
+        # Call validate_and_process_pdf_metadata function
+        with time_stage('pin_lookup'):
+            metadata_result = validate_and_process_pdf_metadata(request_data, txn_id)
+        if 'error' in metadata_result:
+            return metadata_result
 
-def sign_pdf_pfx(request_data, txn_id):
+        # Validate the PFX certificate and password
+        validate_args(metadata_result['file_path'], metadata_result['file_pin'], txn_id)
+
+        # Load the PFX certificate (served from the credential cache when possible)
+        with time_stage('load_pfx'):
+            p12pk, p12pc, p12oc = get_credential(
+                metadata_result['SN'], metadata_result['file_path'], metadata_result['file_pin'], txn_id)
+
+    with time_stage('validate_key_usage'):
+        validate_key_usage(p12pc, txn_id)
+
+    # Extract certificate details
+    cn = get_cn_from_cert(p12pc.subject.rdns)
+
+    return {
+        'success': True,
+        'SN': metadata_result['SN'],
+        'backend': metadata_result.get('backend', 'pfx'),
+        'file_path': metadata_result['file_path'],
+        'file_pin': metadata_result['file_pin'],
+        'credential': (p12pk, p12pc, p12oc),
+        'cn': cn,
+    }
+
+
+def build_signature_dict(page_data_result, credential_result, txn_id):
+    """Signature dictionary for the placement in page_data_result, with revocation data if enabled."""
+    cn = credential_result['cn']
+
+    # Signature details
+    signature_details = f"""Digitally Signed by: {cn}"""
+
+    # Prepare signature dictionary
+    dct = prepare_signature_dict(
+        txn_id=txn_id,
+        sigpage=page_data_result['sigpage'],
+        signature_details=signature_details,
+        signaturebox=page_data_result['signaturebox'],
+        cn=cn,
+        template=page_data_result.get('appearance'),
+        date_format=page_data_result.get('date_format'),
+        placements=page_data_result.get('placements'),
+    )
+
+    # Revocation data for LTV, checked (and mostly served from cache) before the key is used
+    if REVOCATION_MODE != 'off':
+        p12pk, p12pc, p12oc = credential_result['credential']
+        with time_stage('revocation_check'):
+            dct["revocation"] = collect_revocation_info(p12pc, p12oc)
+    return dct
+
+
+def sign_document(pdf_data, page_data_result, credential_result, txn_id):
+    """Build the signature dictionary and return the signed incremental update for pdf_data."""
+    dct = build_signature_dict(page_data_result, credential_result, txn_id)
+
+    # Space for the timestamp token is reserved up front, so the document is signed once
+    timestamp = timestamping_enabled()
+    if timestamp:
+        p12pk, p12pc, p12oc = credential_result['credential']
+        dct["aligned"] = signature_reservation(p12pc, p12oc)
+
+    # Sign on the configured signing executor (inline, thread pool or process pool),
+    # taking turns fairly with the other SNs when all signing slots are busy
+    with fair_slot(credential_result['SN'], len(pdf_data)):
+        signed_pdf_data = submit_sign_job(pdf_data, dct, credential_result)
+
+    if timestamp:
+        try:
+            with time_stage('timestamp'):
+                signed_pdf_data = add_timestamp(signed_pdf_data, len(pdf_data))
+        except Exception as e:
+            if tsa_required():
+                raise TimestampError(str(e))
+            print(f"Signed without a timestamp for {txn_id}: {e}")
+    return signed_pdf_data
+
+
+def sign_pdf_pfx(request_data, txn_id, pdf_data=None):
+    """
+    Sign one PDF. pdf_data is given for streamed uploads; otherwise it is read from
+    the base64 `pdf_data` field of request_data.
+    """
     try:
 
         print(f"Request received from URL: {request.url}")
         print(f"Client IP: {request.remote_addr}")
 
 
+        # Per-SN rate limit, checked before the transaction ID is used up
+        rate_result = check_rate_limit(request_data, txn_id)
+        if 'error' in rate_result:
+            return jsonify({'error': rate_result['error']}), rate_result['status'], {'Retry-After': str(rate_result['retry_after'])}
+
+
          # Call validate_request_data function from validation.py
         validation_result = validate_request_data(request_data, txn_id)
         if 'error' in validation_result:
             return jsonify({'error': validation_result['error']}), validation_result['status']
         
 
-         # Call validate_pdf_data function
-        pdf_result = validate_pdf_data(request_data, txn_id)
+         # Call validate_pdf_data function (or validate_pdf_bytes for streamed uploads)
+        if pdf_data is None:
+            pdf_result = validate_pdf_data(request_data, txn_id)
+        else:
+            pdf_result = validate_pdf_bytes(pdf_data, txn_id)
         if 'error' in pdf_result:
             return jsonify({'error': pdf_result['error']}), pdf_result['status']
 
         pdf_data = pdf_result['pdf_data']
 
 
-        # Call validate_and_process_pdf_metadata function
-        metadata_result = validate_and_process_pdf_metadata(request_data, txn_id)
-        if 'error' in metadata_result:
-            return jsonify({'error': metadata_result['error']}), metadata_result['status']
+         # Process PDF page and signature data
+        page_data_result = validate_and_process_pdf_page_data(request_data, pdf_data, txn_id)
+        if 'error' in page_data_result:
+            return jsonify({'error': page_data_result['error']}), page_data_result['status']
 
-        file_path_value = metadata_result['file_path']
-        file_pin_value = metadata_result['file_pin']
 
-        
+        # Resolve the SN to a validated signing credential
+        credential_result = load_signing_credential(request_data, txn_id)
+        if 'error' in credential_result:
+            return jsonify({'error': credential_result['error']}), credential_result['status']
 
-        # Validate the PFX certificate and password
-        validate_args(file_path_value, file_pin_value,txn_id)
+        cn = credential_result['cn']
+
+
+        try:
+            signed_pdf_data = sign_document(pdf_data, page_data_result, credential_result, txn_id)
+        except SigningExecutorBusy as e:
+            log_transaction(txn_id, "failure", str(e))
+            return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+        except RevocationCheckFailed as e:
+            log_transaction(txn_id, "failure", str(e))
+            return jsonify({'error': str(e)}), e.status
+        except TimestampError as e:
+            log_transaction(txn_id, "failure", str(e))
+            return jsonify({'error': str(e)}), 502
+
+
+
+        # Now use the signed_pdf_data to save the PDF and send the response
+        response = save_signed_pdf_and_send_response(
+            pdf_data=pdf_data,
+            signed_pdf_data=signed_pdf_data,
+            txn_id=txn_id,
+            cn=cn,
+            request_data=request_data
+        )
+
+        # Return the response
+        return response
+    
+
+    except Exception as e:
+
+        return jsonify({'error': str(e)}), 500
+
+
+
+def sign_job_request(request_data, txn_id, pdf_data, lease_held=None):
+    """
+    Sign a request that was validated when its job was submitted (no HTTP request here).
+
+    lease_held is asked before the signed PDF is saved (which also sends the success
+    notifications); when it returns False the job was handed to another run and nothing
+    is saved.
+
+    Returns:
+        tuple: (response dict or {'error': ...}, HTTP status), or (None, None) without the lease
+    """
+    page_data_result = validate_and_process_pdf_page_data(request_data, pdf_data, txn_id)
+    if 'error' in page_data_result:
+        return {'error': page_data_result['error']}, page_data_result['status']
+
+    credential_result = load_signing_credential(request_data, txn_id)
+    if 'error' in credential_result:
+        return {'error': credential_result['error']}, credential_result['status']
+
+    try:
+        signed_pdf_data = sign_document(pdf_data, page_data_result, credential_result, txn_id)
+    except RevocationCheckFailed as e:
+        log_transaction(txn_id, "failure", str(e))
+        return {'error': str(e)}, e.status
+    except TimestampError as e:
+        log_transaction(txn_id, "failure", str(e))
+        return {'error': str(e)}, 502
+
+    if lease_held is not None and not lease_held():
+        return None, None
+
+    return save_signed_pdf(pdf_data, signed_pdf_data, txn_id, credential_result['cn'], request_data), 200
+
+
+def submit_pdf_job(request_data, txn_id):
+    """
+    Validate a signing request and queue it as an asynchronous job.
+
+    The request is the same as for sign_pdf_pfx plus an optional `priority`
+    ('interactive' or 'bulk'). Returns 202 with the job ID at once; the result is read
+    from /jobs/<id> or delivered to the request's webhook_url.
+    """
+    try:
+
+        print(f"Job request received from URL: {request.url}")
+        print(f"Client IP: {request.remote_addr}")
+
+        rate_result = check_rate_limit(request_data, txn_id)
+        if 'error' in rate_result:
+            return jsonify({'error': rate_result['error']}), rate_result['status'], {'Retry-After': str(rate_result['retry_after'])}
+
+        # Timestamp and replay checks happen now, not when the job runs
+        validation_result = validate_request_data(request_data, txn_id)
+        if 'error' in validation_result:
+            return jsonify({'error': validation_result['error']}), validation_result['status']
+
+        if request_data.get('request', {}).get('response_mode') == 'pdf':
+            log_transaction(txn_id, "failure", "response_mode 'pdf' is not supported for jobs")
+            return jsonify({'error': "response_mode 'pdf' is not supported for jobs. Use 'url' or 'base64'."}), 400
+
+        priority = request_data.get('request', {}).get('priority') or 'interactive'
+        if priority not in JOB_PRIORITIES:
+            log_transaction(txn_id, "failure", "Invalid job priority")
+            return jsonify({'error': f"Invalid priority. Use one of: {', '.join(JOB_PRIORITIES)}."}), 400
+
+        pdf_result = validate_pdf_data(request_data, txn_id)
+        if 'error' in pdf_result:
+            return jsonify({'error': pdf_result['error']}), pdf_result['status']
+
+        # Pages, placement and the SN are checked now so a bad request is refused, not queued
+        page_data_result = validate_and_process_pdf_page_data(request_data, pdf_result['pdf_data'], txn_id)
+        if 'error' in page_data_result:
+            return jsonify({'error': page_data_result['error']}), page_data_result['status']
+
+        credential_result = load_signing_credential(request_data, txn_id)
+        if 'error' in credential_result:
+            return jsonify({'error': credential_result['error']}), credential_result['status']
+
+        # The PDF is stored once as bytes, not again inside the request
+        job_request = {'request': dict(request_data.get('request', {}))}
+        job_request['request'].pop('pdf_data', None)
+
+        try:
+            job_id = enqueue_job(job_request, txn_id, pdf_result['pdf_data'], priority)
+        except JobQueueFull as e:
+            log_transaction(txn_id, "failure", str(e))
+            return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+        status_url = f"/jobs/{job_id}"
+        return jsonify({
+            "response": {
+                "command": "managexsignjob",
+                "ts": request_data.get('request', {}).get('timestamp'),
+                "txn": txn_id,
+                "status": "queued",
+                "job_id": job_id,
+                "priority": priority,
+                "status_url": status_url,
+            }
+        }), 202, {'Location': status_url}
+
+    except Exception as e:
+
+        return jsonify({'error': str(e)}), 500
+
+
+def prepare_pdf_pfx(request_data, txn_id):
+    """
+    First phase of hash signing: build the signature update for the request's PDF with
+    room for the CMS and return it with the digest to send to sign_hash_pfx.
+    """
+    try:
+
+        print(f"Prepare request received from URL: {request.url}")
+        print(f"Client IP: {request.remote_addr}")
+
+        rate_result = check_rate_limit(request_data, txn_id)
+        if 'error' in rate_result:
+            return jsonify({'error': rate_result['error']}), rate_result['status'], {'Retry-After': str(rate_result['retry_after'])}
+
+        validation_result = validate_request_data(request_data, txn_id)
+        if 'error' in validation_result:
+            return jsonify({'error': validation_result['error']}), validation_result['status']
+
+        pdf_result = validate_pdf_data(request_data, txn_id)
+        if 'error' in pdf_result:
+            return jsonify({'error': pdf_result['error']}), pdf_result['status']
+        pdf_data = pdf_result['pdf_data']
 
-  
-         # Process PDF page and signature data
         page_data_result = validate_and_process_pdf_page_data(request_data, pdf_data, txn_id)
         if 'error' in page_data_result:
             return jsonify({'error': page_data_result['error']}), page_data_result['status']
 
-        sigpage = page_data_result['sigpage']
-        coordinates = page_data_result['coordinates']
-        signaturebox = page_data_result['signaturebox']
+        credential_result = load_signing_credential(request_data, txn_id)
+        if 'error' in credential_result:
+            return jsonify({'error': credential_result['error']}), credential_result['status']
+        p12pk, p12pc, p12oc = credential_result['credential']
+
+        try:
+            dct = build_signature_dict(page_data_result, credential_result, txn_id)
+        except RevocationCheckFailed as e:
+            log_transaction(txn_id, "failure", str(e))
+            return jsonify({'error': str(e)}), e.status
+
+        # The CMS is made later, so its room (and the timestamp's) is reserved now
+        reserved = signature_reservation(p12pc, p12oc, timestamp=timestamping_enabled())
+        prepared = prepare_pdf(pdf_data, dct, reserved, p12pc, p12oc)
+
+        response = {
+            "response": {
+                "command": "managexprepare",
+                "ts": request_data.get('request', {}).get('timestamp'),
+                "txn": txn_id,
+                "status": "ok",
+                "hash_algorithm": prepared['hash_algorithm'],
+                "digest": prepared['digest'].hex(),
+                "prepared_update": base64.b64encode(prepared['update']).decode('ascii'),
+                "contents_offset": prepared['contents_offset'],
+                "contents_length": prepared['contents_length'],
+            }
+        }
+        log_transaction(txn_id, "success", "PDF prepared for hash signing", notify=False)
+        return jsonify(response)
 
+    except Exception as e:
 
-        # Load the PFX certificate
-        p12pk, p12pc, p12oc = load_pfx(file_path_value, file_pin_value, txn_id)
+        return jsonify({'error': str(e)}), 500
 
 
-        validate_key_usage(p12pc, txn_id)      
+def sign_hash_pfx(request_data, txn_id):
+    """
+    Second phase of hash signing: sign the request's digest with the PFX of pfx.SN and
+    return the CMS signature to inject into the prepared update. No PDF is sent.
+    """
+    try:
 
-        # Extract certificate details
-        cn = get_cn_from_cert(p12pc.subject.rdns)
+        print(f"Sign-hash request received from URL: {request.url}")
+        print(f"Client IP: {request.remote_addr}")
 
+        rate_result = check_rate_limit(request_data, txn_id)
+        if 'error' in rate_result:
+            return jsonify({'error': rate_result['error']}), rate_result['status'], {'Retry-After': str(rate_result['retry_after'])}
 
+        validation_result = validate_request_data(request_data, txn_id)
+        if 'error' in validation_result:
+            return jsonify({'error': validation_result['error']}), validation_result['status']
 
-        # Signature details
-        signature_details = f"""Digitally Signed by: {cn}"""
+        hash_result = validate_hash_data(request_data, txn_id)
+        if 'error' in hash_result:
+            return jsonify({'error': hash_result['error']}), hash_result['status']
+
+        credential_result = load_signing_credential(request_data, txn_id)
+        if 'error' in credential_result:
+            return jsonify({'error': credential_result['error']}), credential_result['status']
+        p12pk, p12pc, p12oc = credential_result['credential']
+
+        try:
+            if REVOCATION_MODE != 'off':
+                with time_stage('revocation_check'):
+                    collect_revocation_info(p12pc, p12oc)
+
+            with fair_slot(credential_result['SN']), time_stage('cms_sign'):
+                signature = sign_digest(hash_result['digest'], p12pk, p12pc, p12oc, hash_result['algorithm'])
+
+            if timestamping_enabled():
+                try:
+                    with time_stage('timestamp'):
+                        signature = timestamp_signature(signature)
+                except Exception as e:
+                    if tsa_required():
+                        raise TimestampError(str(e))
+                    print(f"Signed without a timestamp for {txn_id}: {e}")
+        except SigningExecutorBusy as e:
+            log_transaction(txn_id, "failure", str(e))
+            return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+        except RevocationCheckFailed as e:
+            log_transaction(txn_id, "failure", str(e))
+            return jsonify({'error': str(e)}), e.status
+        except TimestampError as e:
+            log_transaction(txn_id, "failure", str(e))
+            return jsonify({'error': str(e)}), 502
+
+        response = {
+            "response": {
+                "command": "managexsignhash",
+                "ts": request_data.get('request', {}).get('timestamp'),
+                "txn": txn_id,
+                "status": "ok",
+                "file": {
+                    "attribute": {
+                        "Name": credential_result['cn'],
+                        "Type": "cms"
+                    }
+                },
+                "hash_algorithm": hash_result['algorithm'],
+                "signature": base64.b64encode(signature).decode('ascii'),
+            }
+        }
+        log_transaction(txn_id, status="success", reason="Digest signed successfully", response=response,
+                        webhook_url=request_data.get('request', {}).get('webhook_url'),
+                        email=request_data.get('request', {}).get('email'))
+        return jsonify(response)
 
+    except Exception as e:
 
+        return jsonify({'error': str(e)}), 500
 
-        # Prepare signature dictionary
-        dct = prepare_signature_dict(
-            txn_id=txn_id,
-            sigpage=sigpage,
-            signature_details=signature_details,
-            signaturebox=signaturebox,
-        )
 
+def _sign_batch_item(item, credential_result):
+    """Sign one validated batch document and return its per-item result."""
+    txn_id = item['txn_id']
+    try:
+        signed_pdf_data = sign_document(item['pdf_data'], item['page_data'], credential_result, txn_id)
+        response = save_signed_pdf(item['pdf_data'], signed_pdf_data, txn_id, credential_result['cn'], item['request_data'])
+        return response['response']
+    except Exception as e:
+        log_transaction(txn_id, "failure", str(e))
+        return {'txn': txn_id, 'status': 'failed', 'error': str(e)}
 
 
-        signed_pdf_data = pdf.cms.sign(pdf_data, dct, p12pk, p12pc, p12oc, 'sha256', None)
+def sign_pdf_batch(request_data):
+    """
+    Sign every document of a batch request with the one credential named by pfx.SN.
 
+    The request carries the shared command, timestamp and pfx once, plus a `documents`
+    list where each entry has only its own transaction_id, pdf options and pdf_data. The
+    credential is resolved once, documents are validated one by one and the valid ones
+    are signed in parallel; the response holds one result per document, in order.
+    """
+    try:
 
+        print(f"Batch request received from URL: {request.url}")
+        print(f"Client IP: {request.remote_addr}")
 
-        # Now use the signed_pdf_data to save the PDF and send the response
-        response = save_signed_pdf_and_send_response(
-            pdf_data=pdf_data,
-            signed_pdf_data=signed_pdf_data,
-            txn_id=txn_id,
-            cn=cn,
-            request_data=request_data
-        )
+        shared = dict(request_data.get('request', {}))
+        documents = shared.pop('documents', None)
+
+        if not isinstance(documents, list) or not documents:
+            return jsonify({'error': 'documents must be a non-empty list.'}), 400
+        if len(documents) > MAX_BATCH_DOCUMENTS:
+            return jsonify({'error': f'A batch can contain at most {MAX_BATCH_DOCUMENTS} documents.'}), 400
+        if shared.get('response_mode') == 'pdf':
+            return jsonify({'error': "response_mode 'pdf' is not supported for batch requests. Use 'url' or 'base64'."}), 400
+
+        # Each document is validated as a standalone request sharing the batch fields
+        items = []
+        for document in documents:
+            document = document if isinstance(document, dict) else {}
+            txn_id = document.get('transaction_id')
+            own_fields = {key: document[key] for key in BATCH_DOCUMENT_FIELDS if key in document}
+            item_request = {'request': {**shared, **own_fields}}
+            unsupported = sorted(key for key in document if key not in BATCH_DOCUMENT_FIELDS)
+            items.append({'txn_id': txn_id, 'request_data': item_request, 'unsupported': unsupported})
+
+        # Resolve the shared credential once for the whole batch
+        first_txn_id = next((item['txn_id'] for item in items if item['txn_id']), None)
+
+        # A batch takes one token per document from the SN's rate limit
+        rate_result = check_rate_limit({'request': shared}, first_txn_id, cost=len(documents))
+        if 'error' in rate_result:
+            return jsonify({'error': rate_result['error']}), rate_result['status'], {'Retry-After': str(rate_result['retry_after'])}
+
+        credential_result = load_signing_credential({'request': shared}, first_txn_id)
+        if 'error' in credential_result:
+            return jsonify({'error': credential_result['error']}), credential_result['status']
+
+        results = [None] * len(items)
+        futures = {}
+        for position, item in enumerate(items):
+            txn_id = item['txn_id']
+            if not txn_id:
+                results[position] = {'txn': None, 'status': 'failed', 'error': 'Transaction ID is missing'}
+                continue
+            if item['unsupported']:
+                # e.g. a different pfx or response_mode, which would be ignored or bypass the batch checks
+                error = (f"Unsupported field(s) in batch document: {', '.join(item['unsupported'])}. "
+                         f"Only {', '.join(BATCH_DOCUMENT_FIELDS)} can be set per document.")
+                log_transaction(txn_id, "failure", error)
+                results[position] = {'txn': txn_id, 'status': 'failed', 'error': error}
+                continue
+
+            validation_result = validate_request_data(item['request_data'], txn_id)
+            if 'error' not in validation_result:
+                validation_result = validate_pdf_data(item['request_data'], txn_id)
+            if 'error' not in validation_result:
+                item['pdf_data'] = validation_result['pdf_data']
+                validation_result = validate_and_process_pdf_page_data(item['request_data'], item['pdf_data'], txn_id)
+                item['page_data'] = validation_result
+
+            if 'error' in validation_result:
+                results[position] = {'txn': txn_id, 'status': 'failed', 'error': validation_result['error']}
+                continue
+
+            futures[position] = batch_executor.submit(_sign_batch_item, item, credential_result)
+
+        for position, future in futures.items():
+            results[position] = future.result()
+
+        return jsonify({
+            "response": {
+                "command": "managexsign",
+                "ts": shared.get('timestamp'),
+                "status": "ok",
+                "signed": sum(1 for result in results if result.get('status') == 'ok'),
+                "failed": sum(1 for result in results if result.get('status') != 'ok'),
+                "results": results,
+            }
+        })
 
-        # Return the response
-        return response
-    
 
     except Exception as e:
 
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
@@ -1,22 +1,374 @@
 # signature_utils.py
+import re
+import os
+import string
 import datetime
-from endesive import pdf
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from endesive.pdf.cms import SignedData
+from endesive.pdf.PyPDF2 import generic as po
+from endesive.pdf.PyPDF2_annotate.pdfttf import TTFFont
+from endesive.pdf.PyPDF2_annotate.annotations.signature import Signature
+from endesive.pdf.PyPDF2_annotate.config.appearance import Appearance
+from endesive.pdf.PyPDF2_annotate.config.location import Location
+from endesive.pdf.PyPDF2_annotate.config.constants import PDF_ANNOTATOR_FONT
+from endesive.pdf.PyPDF2_annotate.graphics import (
+    ContentStream, Save, Restore, FillColor, BeginText, EndText, Font, TextMatrix, Text
+)
+from endesive.pdf.PyPDF2_annotate.util.geometry import identity, translate
+from endesive.pdf.PyPDF2_annotate.util.text import get_wrapped_lines
+from env import (
+    Default_Date_Format,
+    Default_Appearance_Template,
+    Appearance_Templates,
+    Appearance_Font_Size,
+    APPEARANCE_CACHE_MAX_ENTRIES
+)
+from metrics import Counter
 
-def prepare_signature_dict(txn_id, sigpage, signature_details, signaturebox):
-    """Prepare the signature dictionary for signing."""
+APPEARANCE_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'Helvetica.ttf')
+
+LINE_SPACING = 1.2
+
+# Characters a formatted date can contain; embedded up front so one font subset serves every date
+DATE_DIGITS = string.digits + "+-"
+
+# Java-style date pattern letters: letter -> text of that field for (datetime, letter count)
+DATE_FIELDS = {
+    'y': lambda d, n: d.strftime('%y') if n == 2 else str(d.year).zfill(n),
+    'M': lambda d, n: d.strftime('%B') if n >= 4 else d.strftime('%b') if n == 3 else str(d.month).zfill(n),
+    'd': lambda d, n: str(d.day).zfill(n),
+    'H': lambda d, n: str(d.hour).zfill(n),
+    'h': lambda d, n: str(d.hour % 12 or 12).zfill(n),
+    'm': lambda d, n: str(d.minute).zfill(n),
+    's': lambda d, n: str(d.second).zfill(n),
+    'a': lambda d, n: d.strftime('%p'),
+    'E': lambda d, n: d.strftime('%A') if n >= 4 else d.strftime('%a'),
+    'z': lambda d, n: d.strftime('%Z'),
+    'Z': lambda d, n: d.strftime('%z'),
+}
+
+# A quoted literal ('' is a quote), a run of one pattern letter, other literal text, or a stray quote
+DATE_PATTERN_TOKENS = re.compile(r"'((?:[^']|'')*)'|(([A-Za-z])\3*)|([^'A-Za-z]+)|(')")
+
+# Parsed once at startup; only the per-appearance subset is built later
+_base_font = TTFFont(APPEARANCE_FONT_PATH)
+
+# Pre-rendered appearances keyed by (cn, box width, box height, template, date format)
+_appearance_cache = OrderedDict()
+_appearance_cache_lock = threading.Lock()
+
+APPEARANCE_CACHE_EVENTS = Counter(
+    'mx_appearance_cache_events_total', 'Signature appearance cache hits and misses', ('event',))
+
+
+@lru_cache(maxsize=256)
+def parse_date_format(date_format):
+    """
+    Split a Java-style date pattern (e.g. "dd-MMM-yyyy HH:mm:ss" or "'Date:' d.M.yy")
+    into literal text and (letter, count) fields.
+
+    Raises:
+        ValueError: For a pattern letter that is not supported or an unterminated quote.
+    """
+    tokens = []
+    for match in DATE_PATTERN_TOKENS.finditer(date_format):
+        quoted, run, letter, literal, stray = match.groups()
+        if quoted is not None:
+            tokens.append(quoted.replace("''", "'") if quoted else "'")
+        elif run is not None:
+            if letter not in DATE_FIELDS:
+                raise ValueError(f"unsupported pattern letter '{letter}'; quote literal text with '...'")
+            tokens.append((letter, len(run)))
+        elif literal is not None:
+            tokens.append(literal)
+        else:
+            raise ValueError("unterminated quote")
+    return tuple(tokens)
+
+
+def format_date(moment, date_format):
+    """Render a datetime with a Java-style date pattern."""
+    return ''.join(
+        token if isinstance(token, str) else DATE_FIELDS[token[0]](moment, token[1])
+        for token in parse_date_format(date_format)
+    )
+
+
+def date_charset(date_format):
+    """Every character a date rendered with date_format can contain."""
+    tokens = parse_date_format(date_format)
+    charset = DATE_DIGITS + ''.join(token for token in tokens if isinstance(token, str))
+    # Month / day names, AM/PM and zone names need letters
+    if any(letter in 'aEz' or (letter == 'M' and count >= 3) for letter, count in
+           (token for token in tokens if not isinstance(token, str))):
+        charset += string.ascii_letters
+    return charset
+
+
+def _pdf_text(text):
+    """Encode text for the Identity-H font as a PDF literal string body."""
+    encoded = text.encode("utf-16be").decode("latin1")
+    return encoded.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+class _SubsetFont:
+    """Stands in for a TTFFont whose embedded subset was already built."""
+
+    def __init__(self, font_object):
+        self.font_object = font_object
+
+    def get_font(self):
+        return self.font_object
+
+
+class _RenderedStream(str):
+    """A content stream that is already resolved to its PDF operators."""
+
+    def resolve(self):
+        return str(self)
+
+
+def _build_appearance(cn, width, height, template, date_format):
+    """
+    Lay out a template once: wrap the static lines, reserve the date lines and embed a
+    font subset covering the static text plus every character a date can produce.
+    """
+    font = TTFFont.__new__(TTFFont)
+    font.size = Appearance_Font_Size
+    font.font = dict(_base_font.font, subset=set(_base_font.font['subset']))
+
+    lines = []  # (text, is_dynamic)
+    for line in Appearance_Templates[template]:
+        line = line.replace('{cn}', cn)
+        if '{date}' in line:
+            lines.append((line, True))
+            font.set_text(line.replace('{date}', date_charset(date_format)))
+        else:
+            font.set_text(line)
+            wrapped = get_wrapped_lines(text=line, measure=font.measure_text, max_length=width)
+            lines.extend((part.strip(), False) for part in wrapped)
+
+    # Vertically centred, left aligned (same layout endesive uses for plain text signatures)
+    spacing = Appearance_Font_Size * LINE_SPACING
+    first_y = (height / 2.0 - (spacing - Appearance_Font_Size) + ((len(lines) - 1) / 2.0) * spacing)
+
+    static, dynamic = [], []
+    for position, (line, is_dynamic) in enumerate(lines):
+        y = first_y - position * spacing
+        if is_dynamic:
+            dynamic.append((line, y))
+        else:
+            static.extend([TextMatrix(translate(1, y)), Text(_pdf_text(line))])
+
+    prefix = ContentStream([Save(), FillColor(0, 0, 0), BeginText(),
+                            Font(PDF_ANNOTATOR_FONT, Appearance_Font_Size)] + static).resolve()
+    return {
+        'font': _SubsetFont(font.get_font()),
+        'prefix': prefix,
+        'dynamic': dynamic,
+        'suffix': ContentStream([EndText(), Restore()]).resolve(),
+    }
+
+
+def get_appearance(cn, width, height, template, date_format):
+    """Return the cached appearance for this signer and box, building it on a miss."""
+    key = (cn, round(width, 2), round(height, 2), template, date_format)
+    with _appearance_cache_lock:
+        entry = _appearance_cache.get(key)
+        if entry is not None:
+            _appearance_cache.move_to_end(key)
+            APPEARANCE_CACHE_EVENTS.inc(event='hit')
+            return entry
+
+    entry = _build_appearance(cn, width, height, template, date_format)
+    APPEARANCE_CACHE_EVENTS.inc(event='miss')
+
+    with _appearance_cache_lock:
+        _appearance_cache[key] = entry
+        while len(_appearance_cache) > APPEARANCE_CACHE_MAX_ENTRIES:
+            _appearance_cache.popitem(last=False)
+    return entry
+
+
+def render_appearance_stream(entry, date_text):
+    """The cached static part plus the freshly rendered date lines."""
+    dynamic = ContentStream([
+        command
+        for line, y in entry['dynamic']
+        for command in (TextMatrix(translate(1, y)), Text(_pdf_text(line.replace('{date}', date_text))))
+    ]).resolve()
+    return _RenderedStream(' '.join(part for part in (entry['prefix'], dynamic, entry['suffix']) if part))
+
+
+class CachedAppearanceSignedData(SignedData):
+    """
+    endesive SignedData whose visible text appearance comes from the appearance cache.
+
+    Used when the signature dictionary has an 'appearance' entry; anything else falls
+    back to endesive's own rendering. With more than one entry in 'placements' the
+    signature field gets one widget annotation per (page, box), all added in the same
+    incremental update, so the document is parsed and hashed once.
+    """
+
+    def makepdf(self, prev, udct, *args, **params):
+        # Kept so addAnnotation can reach pages other than sigpage
+        self._prev = prev
+        super().makepdf(prev, udct, *args, **params)
+        if udct.get('revocation'):
+            self._add_dss(prev, udct['revocation'])
+
+    def _add_dss(self, prev, revocation):
+        """
+        Add the chain certificates, OCSP responses and CRLs gathered before signing to the
+        Document Security Store, keeping whatever earlier signatures stored there.
+        """
+        catalog = prev.trailer["/Root"]
+        dss = po.DictionaryObject({po.NameObject("/Type"): po.NameObject("/DSS")})
+        existing = catalog["/DSS"].getObject() if "/DSS" in catalog else {}
+
+        for key, values in (("/Certs", revocation['certs']), ("/OCSPs", revocation['ocsps']),
+                            ("/CRLs", revocation['crls'])):
+            refs = po.ArrayObject(existing[key].getObject() if key in existing else [])
+            for der in values:
+                stream = po.StreamObject()
+                stream._data = der
+                refs.append(self._addObject(stream))
+            if refs:
+                dss[po.NameObject(key)] = refs
+        if "/VRI" in existing:
+            dss[po.NameObject("/VRI")] = existing.raw_get("/VRI")
+
+        catalog[po.NameObject("/DSS")] = self._addObject(dss)
+
+    def _appearance_ref(self, appearance, box, pageref):
+        """Add the appearance stream for one box and return a reference to it."""
+        x1, y1, x2, y2 = box
+        entry = get_appearance(appearance['cn'], x2 - x1, y2 - y1, appearance['template'], appearance['date_format'])
+
+        annotation = Signature(Location(x1=x1, y1=y1, x2=x2, y2=y2, page=0), Appearance())
+        annotation._ttf = {PDF_ANNOTATOR_FONT: entry['font']}
+        annotation._n2_layer = render_appearance_stream(entry, appearance['date'])
+
+        pdfa = annotation.as_pdf_object(identity(), page=pageref)
+        objapn = self._extend(pdfa["/AP"]["/N"])
+        return self._addObject(objapn)
+
+    def addAnnotation(self, cert, udct, box, page0ref, obj13, obj13ref, new_13):
+        if 'appearance' not in udct:
+            return super().addAnnotation(cert, udct, box, page0ref, obj13, obj13ref, new_13)
+        if new_13 and len(udct.get('placements') or ()) > 1:
+            return self._add_widgets(udct, obj13, obj13ref)
+
+        x1, y1, x2, y2 = box
+        objapnref = self._appearance_ref(udct['appearance'], box, page0ref)
+
+        # From here on identical to endesive: attach the appearance to the widget and the page
+        objap = po.DictionaryObject()
+        objap[po.NameObject("/N")] = objapnref
+        obj13.update({
+            po.NameObject("/Rect"): po.ArrayObject([
+                po.FloatObject(x1), po.FloatObject(y1), po.FloatObject(x2), po.FloatObject(y2),
+            ]),
+            po.NameObject("/AP"): objap,
+        })
+
+        page0 = page0ref.getObject()
+        if new_13:
+            annots = po.ArrayObject([obj13ref])
+            if "/Annots" in page0:
+                page0annots = page0["/Annots"]
+                if isinstance(page0annots, po.IndirectObject):
+                    annots.insert(0, page0annots)
+                elif isinstance(page0annots, po.ArrayObject):
+                    annots = page0annots
+                    annots.append(obj13ref)
+        else:
+            annots = page0["/Annots"]
+        page0.update({po.NameObject("/Annots"): annots})
+        self._objects[page0ref.idnum - 1] = page0
+
+    def _add_widgets(self, udct, obj13, obj13ref):
+        """
+        Split endesive's merged field/widget: obj13 stays the signature field and every
+        placement becomes a widget annotation in its /Kids. Boxes of the same size share
+        one appearance stream.
+        """
+        flags = obj13.get("/F", po.NumberObject(132))
+        for key in ("/Type", "/Subtype", "/F", "/P", "/Rect"):
+            obj13.pop(key, None)
+
+        appearance_refs = {}
+        page_widgets = {}  # page object number -> (page reference, widget references)
+        kids = po.ArrayObject()
+        for sigpage, box in udct['placements']:
+            x1, y1, x2, y2 = box
+            pageref = self._prev.getPage(sigpage).indirectRef
+            size = (x2 - x1, y2 - y1)
+            if size not in appearance_refs:
+                appearance_refs[size] = self._appearance_ref(udct['appearance'], box, pageref)
+
+            widget = po.DictionaryObject({
+                po.NameObject("/Type"): po.NameObject("/Annot"),
+                po.NameObject("/Subtype"): po.NameObject("/Widget"),
+                po.NameObject("/F"): flags,
+                po.NameObject("/Parent"): obj13ref,
+                po.NameObject("/P"): pageref,
+                po.NameObject("/Rect"): po.ArrayObject([
+                    po.FloatObject(x1), po.FloatObject(y1), po.FloatObject(x2), po.FloatObject(y2),
+                ]),
+                po.NameObject("/AP"): po.DictionaryObject({po.NameObject("/N"): appearance_refs[size]}),
+            })
+            widgetref = self._addObject(widget)
+            kids.append(widgetref)
+            page_widgets.setdefault(pageref.idnum, (pageref, []))[1].append(widgetref)
+
+        obj13[po.NameObject("/Kids")] = kids
+
+        for pageref, widgetrefs in page_widgets.values():
+            page = pageref.getObject()
+            annots = po.ArrayObject(page["/Annots"].getObject() if "/Annots" in page else [])
+            annots.extend(widgetrefs)
+            page.update({po.NameObject("/Annots"): annots})
+            self._objects[pageref.idnum - 1] = page
+
+
+def prepare_signature_dict(txn_id, sigpage, signature_details, signaturebox, cn=None,
+                           template=None, date_format=None, placements=None):
+    """
+    Prepare the signature dictionary for signing.
+
+    placements lists every (zero-based page, box) of a visible signature; with more than
+    one, each becomes a widget of the same signature.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
     dct = {
         "sigfield": f"MX Signer Server {txn_id}",
         "sigpage": sigpage,
         "contact": "N/A",
         "location": "N/A",
         "reason": "N/A",
-        "signingdate": datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"),
+        "signingdate": now.strftime("%Y%m%d%H%M%S"),
         "signature": signature_details,
         "signaturebox": signaturebox,  # Include only for visible signatures
     }
+
+    # Visible signatures are drawn from the appearance cache
+    if signaturebox is not None and cn is not None:
+        date_format = date_format or Default_Date_Format
+        dct["appearance"] = {
+            "cn": cn,
+            "template": template or Default_Appearance_Template,
+            "date_format": date_format,
+            # Rendered once so both signing passes show the same time
+            "date": format_date(now.astimezone(), date_format),
+        }
+        if placements and len(placements) > 1:
+            dct["placements"] = [(page, list(box)) for page, box in placements]
     return dct
 
 def sign_pdf(pdf_data, dct, p12pk, p12pc, p12oc):
     """Sign the PDF using the provided signature dictionary and certificate."""
-    signed_pdf_data = pdf.cms.sign(pdf_data, dct, p12pk, p12pc, p12oc, 'sha256')
+    signed_pdf_data = CachedAppearanceSignedData().sign(pdf_data, dct, p12pk, p12pc, p12oc, 'sha256', None)
     return signed_pdf_data
@@ -0,0 +1,269 @@
+# signed_output_store.py
+"""
+Bookkeeping for the signed PDFs kept in signed_pdfs.
+
+Sizes and access times are recorded as files are written and served, so enforcing the size
+limit never walks the folder. Once the total passes SIGNED_PDF_MAX_SIZE_MB the least
+recently written/served files are deleted until it is back under SIGNED_PDF_LOW_WATER_MB;
+files younger than SIGNED_PDF_GRACE_SECONDS are never deleted, so a signed_pdf_url that
+was just returned stays valid. Files also expire after their TTL.
+
+The state lives in SQLite so every worker process sees the same total.
+"""
+import os
+import time
+import sqlite3
+import threading
+from metrics import Counter, Gauge
+from env import (
+    SIGNED_PDF_MAX_SIZE_MB,
+    SIGNED_PDF_LOW_WATER_MB,
+    SIGNED_PDF_TTL,
+    SIGNED_PDF_GRACE_SECONDS,
+    SIGNED_PDF_SWEEP_INTERVAL
+)
+
+SIGNED_PDF_FOLDER = 'signed_pdfs'
+STORE_DB_FILE = os.path.join(os.getcwd(), 'signed_output_store.db')
+
+MAX_SIZE_BYTES = SIGNED_PDF_MAX_SIZE_MB * 1024 * 1024
+LOW_WATER_BYTES = SIGNED_PDF_LOW_WATER_MB * 1024 * 1024
+
+# Files deleted per SQLite transaction while evicting
+EVICT_BATCH_SIZE = 100
+
+EVICTIONS_TOTAL = Counter('mx_signed_pdf_evictions_total', 'Signed PDFs deleted, by reason', ('reason',))
+
+_local = threading.local()
+_initialised = {'path': None}
+_init_lock = threading.Lock()
+
+
+def _connection():
+    # One connection per thread and per process (connections must not cross a fork)
+    if getattr(_local, 'pid', None) != os.getpid():
+        connection = sqlite3.connect(STORE_DB_FILE, timeout=10, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        _local.connection = connection
+        _local.pid = os.getpid()
+
+    with _init_lock:
+        if _initialised['path'] != STORE_DB_FILE:
+            _create_tables(_local.connection)
+            _initialised['path'] = STORE_DB_FILE
+    return _local.connection
+
+
+def _create_tables(connection):
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS signed_outputs ("
+        "filename TEXT PRIMARY KEY, size INTEGER NOT NULL, created REAL NOT NULL, "
+        "last_access REAL NOT NULL, expires_at REAL)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS signed_outputs_last_access ON signed_outputs (last_access)")
+    connection.execute("CREATE INDEX IF NOT EXISTS signed_outputs_expires_at ON signed_outputs (expires_at)")
+    # Running total of the sizes above, kept in step by every insert / delete
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS store_totals (id INTEGER PRIMARY KEY CHECK (id = 1), total_size INTEGER NOT NULL)"
+    )
+    connection.execute("INSERT OR IGNORE INTO store_totals (id, total_size) VALUES (1, 0)")
+
+
+def _add_to_total(connection, delta):
+    connection.execute("UPDATE store_totals SET total_size = total_size + ? WHERE id = 1", (delta,))
+
+
+def _delete(connection, rows):
+    """
+    Delete files and their rows (caller holds the write transaction).
+
+    A file that cannot be removed keeps its row and is left for a later pass.
+
+    Returns:
+        tuple: (files deleted, bytes freed)
+    """
+    deleted, freed = 0, 0
+    for filename, size in rows:
+        try:
+            os.remove(os.path.join(SIGNED_PDF_FOLDER, filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error deleting signed PDF {filename}: {e}")
+            continue
+        connection.execute("DELETE FROM signed_outputs WHERE filename = ?", (filename,))
+        deleted += 1
+        freed += size
+    _add_to_total(connection, -freed)
+    return deleted, freed
+
+
+def get_total_size():
+    return _connection().execute("SELECT total_size FROM store_totals WHERE id = 1").fetchone()[0]
+
+
+def record_write(filename, size, ttl=SIGNED_PDF_TTL):
+    """
+    Record a signed PDF just written to signed_pdfs and enforce the size limit.
+
+    Args:
+        filename (str): File name inside signed_pdfs.
+        size (int): File size in bytes.
+        ttl (int, optional): Seconds the file is kept; None or 0 keeps it until evicted for space.
+    """
+    now = time.time()
+    connection = _connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        previous = connection.execute(
+            "SELECT size FROM signed_outputs WHERE filename = ?", (filename,)).fetchone()
+        connection.execute(
+            "INSERT OR REPLACE INTO signed_outputs (filename, size, created, last_access, expires_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (filename, size, now, now, now + ttl if ttl else None))
+        _add_to_total(connection, size - (previous[0] if previous else 0))
+        total = connection.execute("SELECT total_size FROM store_totals WHERE id = 1").fetchone()[0]
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+    if total > MAX_SIZE_BYTES:
+        enforce_size_limit()
+
+
+def record_access(filename):
+    """Mark a signed PDF as just served so it is evicted last."""
+    try:
+        _connection().execute("UPDATE signed_outputs SET last_access = ? WHERE filename = ?", (time.time(), filename))
+    except sqlite3.Error as e:
+        print(f"Error recording access to signed PDF {filename}: {e}")
+
+
+def enforce_size_limit():
+    """
+    Evict least recently used files until the total is at or below the low-water mark.
+
+    Files inside the grace period are skipped, so the total can stay above the limit
+    while everything stored is that recent.
+
+    Returns:
+        int: The number of bytes freed.
+    """
+    connection = _connection()
+    freed = 0
+    while True:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            total = connection.execute("SELECT total_size FROM store_totals WHERE id = 1").fetchone()[0]
+            if total <= LOW_WATER_BYTES:
+                connection.execute("COMMIT")
+                return freed
+
+            # Oldest-accessed first, taking only as many as are needed to reach the low-water mark
+            candidates = connection.execute(
+                "SELECT filename, size FROM signed_outputs WHERE created <= ? ORDER BY last_access LIMIT ?",
+                (time.time() - SIGNED_PDF_GRACE_SECONDS, EVICT_BATCH_SIZE)).fetchall()
+            rows, excess = [], total - LOW_WATER_BYTES
+            for filename, size in candidates:
+                if excess <= 0:
+                    break
+                rows.append((filename, size))
+                excess -= size
+
+            deleted, batch_freed = _delete(connection, rows)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        freed += batch_freed
+        EVICTIONS_TOTAL.inc(deleted, reason='size')
+        # Nothing in the batch could be removed (e.g. files still held open); another pass would pick the same rows
+        if len(candidates) < EVICT_BATCH_SIZE or not deleted:
+            return freed
+
+
+def remove_expired():
+    """Delete files whose TTL has passed (grace period still applies). Returns the number removed."""
+    connection = _connection()
+    now = time.time()
+    removed = 0
+    while True:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                "SELECT filename, size FROM signed_outputs WHERE expires_at <= ? AND created <= ? LIMIT ?",
+                (now, now - SIGNED_PDF_GRACE_SECONDS, EVICT_BATCH_SIZE)).fetchall()
+            deleted, _ = _delete(connection, rows)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        removed += deleted
+        EVICTIONS_TOTAL.inc(deleted, reason='ttl')
+        if len(rows) < EVICT_BATCH_SIZE or not deleted:
+            return removed
+
+
+def reconcile():
+    """
+    Bring the bookkeeping in line with the folder once at startup.
+
+    Adopts files written before the store existed (oldest modification first in LRU order)
+    and forgets rows whose file was removed by hand.
+    """
+    os.makedirs(SIGNED_PDF_FOLDER, exist_ok=True)
+    on_disk = {}
+    with os.scandir(SIGNED_PDF_FOLDER) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                on_disk[entry.name] = (stat.st_size, stat.st_mtime)
+
+    connection = _connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        known = dict(connection.execute("SELECT filename, size FROM signed_outputs").fetchall())
+        for filename in set(known) - set(on_disk):
+            connection.execute("DELETE FROM signed_outputs WHERE filename = ?", (filename,))
+        for filename in set(on_disk) - set(known):
+            size, mtime = on_disk[filename]
+            connection.execute(
+                "INSERT INTO signed_outputs (filename, size, created, last_access, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (filename, size, mtime, mtime, mtime + SIGNED_PDF_TTL if SIGNED_PDF_TTL else None))
+        connection.execute(
+            "UPDATE store_totals SET total_size = (SELECT COALESCE(SUM(size), 0) FROM signed_outputs) WHERE id = 1")
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def maintain_store():
+    """Background loop: expire files past their TTL and re-check the size limit."""
+    while True:
+        try:
+            remove_expired()
+            if get_total_size() > MAX_SIZE_BYTES:
+                enforce_size_limit()
+        except Exception as e:
+            print(f"Error maintaining signed PDF store: {e}")
+        time.sleep(SIGNED_PDF_SWEEP_INTERVAL)
+
+
+def start_store_maintenance():
+    """Reconcile with the folder, enforce the limits, then keep expiring files in a daemon thread."""
+    try:
+        reconcile()
+        enforce_size_limit()
+    except Exception as e:
+        print(f"Error reconciling signed PDF store: {e}")
+
+    maintenance_thread = threading.Thread(target=maintain_store, daemon=True)
+    maintenance_thread.start()
+
+
+Gauge('mx_signed_pdf_store_bytes', 'Total size of the signed PDFs kept in signed_pdfs', function=get_total_size)
@@ -20,7 +20,10 @@ import pytz
 
 
 def load_pfx(file_path, password, txn_id):
-    """Function to load pkcs12 object from the given password-protected pfx file."""
+    """
+    Function to load pkcs12 object from the given password-protected pfx file.
+    A failure is logged against txn_id; with txn_id None (pre-warming) it is only raised.
+    """
     try:
         with open(file_path, 'rb') as fp:
             pfx_data = fp.read()
@@ -29,15 +32,18 @@ def load_pfx(file_path, password, txn_id):
     
     except ValueError as e:
         # If ValueError is raised, it likely indicates an invalid password for the PFX file
-        log_transaction(txn_id, "failure", "Invalid password for the PFX file.")
+        if txn_id is not None:
+            log_transaction(txn_id, "failure", "Invalid password for the PFX file.")
         raise ValueError("Invalid password for the PFX file.")
     
     except FileNotFoundError:
-        log_transaction(txn_id, "failure", "No such PFX Found. Please Upload with using /upload")
+        if txn_id is not None:
+            log_transaction(txn_id, "failure", "No such PFX Found. Please Upload with using /upload")
         raise ValueError("No such PFX Found. Please Upload with using /upload")
     
     except Exception as e:
-        log_transaction(txn_id, "failure", f"Error loading PFX file: {str(e)}")
+        if txn_id is not None:
+            log_transaction(txn_id, "failure", f"Error loading PFX file: {str(e)}")
         raise ValueError(f"Error loading PFX file: {str(e)}")
 
 # Function to validate PFX certificate file extension
@@ -0,0 +1,190 @@
+# signing_executor.py
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import pkcs12
+from signature_utils import CachedAppearanceSignedData
+from metrics import Gauge, observe_stage
+from env import (
+    SIGNING_EXECUTOR_MODE,
+    SIGNING_WORKERS,
+    SIGNING_QUEUE_DEPTH,
+    SIGNING_JOB_TIMEOUT,
+    SIGNING_RETRY_AFTER
+)
+
+
+class SigningExecutorBusy(Exception):
+    """Raised when every signing slot is taken; the caller should answer 503 with Retry-After."""
+
+    def __init__(self, retry_after=SIGNING_RETRY_AFTER):
+        super().__init__("Signing queue is full. Please retry later.")
+        self.retry_after = retry_after
+
+
+# Jobs queued or running; submissions beyond SIGNING_QUEUE_DEPTH are rejected
+_slots = threading.BoundedSemaphore(SIGNING_QUEUE_DEPTH)
+
+# Pool is created on first use so importing this module never forks
+_pool = {'executor': None}
+_pool_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+executor_stats = {
+    'submitted': 0,
+    'completed': 0,
+    'failed': 0,
+    'rejected': 0,
+    'timed_out': 0,
+    'in_flight': 0,
+    'queue_wait_seconds_total': 0.0,
+    'sign_seconds_total': 0.0,
+    'sign_seconds_max': 0.0,
+}
+
+# Credentials loaded inside a process-pool worker, keyed by SN (worker-local)
+_worker_credentials = {}
+
+
+def _get_pool():
+    with _pool_lock:
+        if _pool['executor'] is None:
+            workers = SIGNING_WORKERS or os.cpu_count() or 1
+            if SIGNING_EXECUTOR_MODE == 'process':
+                _pool['executor'] = ProcessPoolExecutor(max_workers=workers)
+            else:
+                _pool['executor'] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="signing")
+        return _pool['executor']
+
+
+def _get_worker_credential(credential_ref):
+    """Load a credential inside a worker process, reusing it while the PFX is unchanged."""
+    SN = credential_ref['SN']
+    file_path = credential_ref['file_path']
+    mtime = os.stat(file_path).st_mtime_ns
+    pin_digest = hashlib.sha256(credential_ref['file_pin'].encode()).digest()
+
+    entry = _worker_credentials.get(SN)
+    if entry and entry[0] == file_path and entry[1] == mtime and entry[2] == pin_digest:
+        return entry[3]
+
+    with open(file_path, 'rb') as fp:
+        credential = pkcs12.load_key_and_certificates(fp.read(), credential_ref['file_pin'].encode(), default_backend())
+    _worker_credentials[SN] = (file_path, mtime, pin_digest, credential)
+    return credential
+
+
+def run_sign_job(pdf_data, dct, credential_ref, credential=None, submitted_at=None):
+    """
+    Sign pdf_data with the signature dictionary dct.
+
+    Runs inline, on a pool thread or inside a worker process. In-process callers pass the
+    already loaded credential; worker processes get only credential_ref (SN, PFX path and
+    PIN) and keep their own credential cache so keys are not re-shipped per job.
+
+    Returns:
+        tuple: (signed_pdf_data, queue_wait_seconds, sign_seconds)
+    """
+    started = time.time()
+    queue_wait = started - submitted_at if submitted_at else 0.0
+
+    if credential is None:
+        credential = _get_worker_credential(credential_ref)
+    p12pk, p12pc, p12oc = credential
+
+    signed_pdf_data = CachedAppearanceSignedData().sign(pdf_data, dct, p12pk, p12pc, p12oc, 'sha256', None)
+    return signed_pdf_data, queue_wait, time.time() - started
+
+
+def _release_slot(future=None):
+    with _stats_lock:
+        executor_stats['in_flight'] -= 1
+    _slots.release()
+
+
+def submit_sign_job(pdf_data, dct, credential_result):
+    """
+    Run one signing job on the configured executor and wait for its result.
+
+    Raises:
+        SigningExecutorBusy: If SIGNING_QUEUE_DEPTH jobs are already queued or running.
+    """
+    if not _slots.acquire(blocking=False):
+        with _stats_lock:
+            executor_stats['rejected'] += 1
+        raise SigningExecutorBusy()
+
+    with _stats_lock:
+        executor_stats['submitted'] += 1
+        executor_stats['in_flight'] += 1
+
+    credential_ref = {
+        'SN': credential_result['SN'],
+        'file_path': credential_result['file_path'],
+        'file_pin': credential_result['file_pin'],
+    }
+    # A job that outlives its timeout keeps its slot until it really ends
+    slot_held_by_job = False
+    try:
+        submitted_at = time.time()
+        # PKCS#11 sessions belong to this process and the token does the key operation,
+        # so those jobs are not sent to worker processes
+        if SIGNING_EXECUTOR_MODE == 'inline' or (
+                SIGNING_EXECUTOR_MODE == 'process' and credential_result.get('backend') == 'pkcs11'):
+            result = run_sign_job(pdf_data, dct, credential_ref, credential_result['credential'], submitted_at)
+        else:
+            # Keys never leave this process for threads; worker processes load their own
+            credential = credential_result['credential'] if SIGNING_EXECUTOR_MODE == 'thread' else None
+            if SIGNING_EXECUTOR_MODE == 'process' and not isinstance(pdf_data, bytes):
+                pdf_data = bytes(pdf_data)  # A mapped upload cannot be pickled to a worker process
+            future = _get_pool().submit(run_sign_job, pdf_data, dct, credential_ref, credential, submitted_at)
+            try:
+                result = future.result(timeout=SIGNING_JOB_TIMEOUT)
+            except FutureTimeoutError:
+                if not future.cancel():
+                    future.add_done_callback(_release_slot)
+                    slot_held_by_job = True
+                with _stats_lock:
+                    executor_stats['timed_out'] += 1
+                raise TimeoutError(f"Signing did not finish within {SIGNING_JOB_TIMEOUT} seconds")
+
+        signed_pdf_data, queue_wait, sign_seconds = result
+        observe_stage('signing_queue_wait', queue_wait)
+        observe_stage('cms_sign', sign_seconds)
+        with _stats_lock:
+            executor_stats['completed'] += 1
+            executor_stats['queue_wait_seconds_total'] += queue_wait
+            executor_stats['sign_seconds_total'] += sign_seconds
+            executor_stats['sign_seconds_max'] = max(executor_stats['sign_seconds_max'], sign_seconds)
+        return signed_pdf_data
+
+    except Exception:
+        with _stats_lock:
+            executor_stats['failed'] += 1
+        raise
+
+    finally:
+        if not slot_held_by_job:
+            _release_slot()
+
+
+def get_executor_stats():
+    """Snapshot of the executor counters plus average queue wait / sign time per job."""
+    with _stats_lock:
+        stats = dict(executor_stats)
+    completed = stats['completed'] or 1
+    stats['mode'] = SIGNING_EXECUTOR_MODE
+    stats['workers'] = SIGNING_WORKERS or os.cpu_count() or 1
+    stats['queue_depth'] = SIGNING_QUEUE_DEPTH
+    stats['queue_wait_seconds_avg'] = stats['queue_wait_seconds_total'] / completed
+    stats['sign_seconds_avg'] = stats['sign_seconds_total'] / completed
+    return stats
+
+
+Gauge('mx_signing_executor_jobs', 'Signing executor job counters and in-flight jobs', ('state',),
+      function=lambda: {(state,): executor_stats[state] for state in
+                        ('submitted', 'completed', 'failed', 'rejected', 'timed_out', 'in_flight')})
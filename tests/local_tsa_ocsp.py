@@ -0,0 +1,293 @@
+# local_tsa_ocsp.py
+"""
+End-to-end check of timestamping and revocation against local stand-ins for a TSA and
+an OCSP responder, so no external service is needed.
+
+A throwaway CA issues the signing certificates (with an OCSP URL pointing at the local
+responder) and a time stamping certificate. With the server running in-process:
+
+  1. a PDF is signed with REVOCATION_MODE 'require'; the OCSP response is embedded in the
+     DSS, endesive.pdf.verify accepts the signature and the embedded timestamp token
+     verifies against the TSA certificate and covers the signature value,
+  2. a TSA whose tokens carry a bad signature is refused and the fallback TSA is used,
+  3. with only that TSA configured, signing fails with 502,
+  4. a certificate the responder reports as revoked is refused with 403.
+
+Run from the repository root:
+    python tests/local_tsa_ocsp.py
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import hashlib
+import datetime
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from fixtures import enter_workspace, make_pdf, install_pfx, sign_request
+
+from asn1crypto import cms, tsp, algos, core, x509 as asn1_x509
+from cryptography import x509
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID, AuthorityInformationAccessOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.serialization import pkcs12
+
+SIGN_PATH = '/sign/api/v1.0/postjson'
+PIN = '1234'
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _name(cn):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+
+
+class TestCA:
+    """Root CA that issues signer and time stamping certificates and answers OCSP for them."""
+
+    def __init__(self):
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.cert = (
+            x509.CertificateBuilder()
+            .subject_name(_name("Local Test CA"))
+            .issuer_name(_name("Local Test CA"))
+            .public_key(self.key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(_now() - datetime.timedelta(days=1))
+            .not_valid_after(_now() + datetime.timedelta(days=90))
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(self.key.public_key()), critical=False)
+            .sign(self.key, hashes.SHA256())
+        )
+        self.issued = {}
+        self.revoked = set()
+        self.ocsp_hits = 0
+        self.ocsp_url = None
+
+    def issue(self, cn, extended_usage=None):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(_name(cn))
+            .issuer_name(self.cert.subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(_now() - datetime.timedelta(days=1))
+            .not_valid_after(_now() + datetime.timedelta(days=30))
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(self.key.public_key()), critical=False)
+        )
+        if extended_usage:
+            builder = builder.add_extension(x509.ExtendedKeyUsage([extended_usage]), critical=True)
+        else:
+            builder = builder.add_extension(
+                x509.KeyUsage(True, True, False, False, False, False, False, False, False), critical=True)
+            builder = builder.add_extension(x509.AuthorityInformationAccess([x509.AccessDescription(
+                AuthorityInformationAccessOID.OCSP, x509.UniformResourceIdentifier(self.ocsp_url))]), critical=False)
+        cert = builder.sign(self.key, hashes.SHA256())
+        self.issued[cert.serial_number] = cert
+        return key, cert
+
+    def ocsp_response(self, body):
+        self.ocsp_hits += 1
+        request = ocsp.load_der_ocsp_request(body)
+        cert = self.issued[request.serial_number]
+        revoked = request.serial_number in self.revoked
+        response = ocsp.OCSPResponseBuilder().add_response(
+            cert, self.cert, hashes.SHA1(),
+            ocsp.OCSPCertStatus.REVOKED if revoked else ocsp.OCSPCertStatus.GOOD,
+            _now(), _now() + datetime.timedelta(hours=1),
+            _now() if revoked else None, None,
+        ).responder_id(ocsp.OCSPResponderEncoding.HASH, self.cert)
+        return response.sign(self.key, hashes.SHA256()).public_bytes(serialization.Encoding.DER)
+
+
+class TestTSA:
+    """RFC 3161 responder; with forge=True the token signature is corrupted."""
+
+    def __init__(self, key, cert, forge=False):
+        self.key = key
+        self.cert = asn1_x509.Certificate.load(cert.public_bytes(serialization.Encoding.DER))
+        self.forge = forge
+        self.hits = 0
+
+    def timestamp_response(self, body):
+        self.hits += 1
+        request = tsp.TimeStampReq.load(body)
+        tst_info = tsp.TSTInfo({
+            'version': 1,
+            'policy': '1.3.6.1.4.1.99999.1',
+            'message_imprint': request['message_imprint'],
+            'serial_number': time.time_ns(),
+            'gen_time': _now(),
+            'nonce': request['nonce'],
+        }).dump()
+        signed_attrs = cms.CMSAttributes([
+            cms.CMSAttribute({'type': 'content_type', 'values': ['tst_info']}),
+            cms.CMSAttribute({'type': 'message_digest', 'values': [hashlib.sha256(tst_info).digest()]}),
+            cms.CMSAttribute({'type': 'signing_certificate_v2', 'values': [{
+                'certs': [{'cert_hash': hashlib.sha256(self.cert.dump()).digest()}],
+            }]}),
+        ])
+        signature = self.key.sign(signed_attrs.dump(), padding.PKCS1v15(), hashes.SHA256())
+        if self.forge:
+            signature = bytes([signature[0] ^ 0xFF]) + signature[1:]
+
+        signed_data = cms.SignedData({
+            'version': 'v3',
+            'digest_algorithms': [algos.DigestAlgorithm({'algorithm': 'sha256'})],
+            'encap_content_info': {'content_type': 'tst_info', 'content': core.ParsableOctetString(tst_info)},
+            'certificates': [self.cert],
+            'signer_infos': [cms.SignerInfo({
+                'version': 'v1',
+                'sid': cms.SignerIdentifier({'issuer_and_serial_number': cms.IssuerAndSerialNumber({
+                    'issuer': self.cert.issuer, 'serial_number': self.cert.serial_number})}),
+                'digest_algorithm': algos.DigestAlgorithm({'algorithm': 'sha256'}),
+                'signed_attrs': signed_attrs,
+                'signature_algorithm': algos.SignedDigestAlgorithm({'algorithm': 'rsassa_pkcs1v15'}),
+                'signature': signature,
+            })],
+        })
+        return tsp.TimeStampResp({
+            'status': {'status': 'granted'},
+            'time_stamp_token': cms.ContentInfo({'content_type': 'signed_data', 'content': signed_data}),
+        }).dump()
+
+
+def serve(respond, content_type):
+    """Answer POSTs on a free local port with respond(body); returns the URL."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = respond(self.rfile.read(int(self.headers['Content-Length'])))
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def check(condition, message, detail=''):
+    if not condition:
+        raise AssertionError(f"{message} {detail}")
+    print(f"ok   {message}")
+
+
+def configure(**values):
+    """Rewrite managex_signer.config and make the TSA settings be read again."""
+    import timestamping
+    from config_loader import load_config
+
+    config = load_config()
+    config.update(values)
+    with open('managex_signer.config', 'w') as f:
+        json.dump(config, f, indent=4)
+    timestamping._settings['config'] = None
+
+
+def embedded_token(signed_pdf):
+    """Signature value and timestamp token of the last signature in signed_pdf."""
+    contents = re.findall(rb'/Contents\s*<([0-9a-fA-F]+)>', signed_pdf)[-1]
+    # The zero padding after the CMS structure is ignored
+    signed_data = cms.ContentInfo.load(bytes.fromhex(contents.decode('ascii')))
+    signer_info = signed_data['content']['signer_infos'][0]
+    attributes = {attribute['type'].native: attribute['values'][0] for attribute in signer_info['unsigned_attrs']}
+    return signer_info['signature'].native, attributes.get('signature_time_stamp_token')
+
+
+def main():
+    workdir = enter_workspace(tempfile.mkdtemp(prefix='mx-tsa-ocsp-'))
+
+    ca = TestCA()
+    ca.ocsp_url = serve(ca.ocsp_response, 'application/ocsp-response')
+    tsa_key, tsa_cert = ca.issue("Local Test TSA", ExtendedKeyUsageOID.TIME_STAMPING)
+    good_tsa = TestTSA(tsa_key, tsa_cert)
+    forged_tsa = TestTSA(tsa_key, tsa_cert, forge=True)
+    good_tsa_url = serve(good_tsa.timestamp_response, 'application/timestamp-reply')
+    forged_tsa_url = serve(forged_tsa.timestamp_response, 'application/timestamp-reply')
+
+    import validation
+    pin_folder = os.path.join(workdir, 'save', 'PIN')
+    validation.PIN_FOLDER = pin_folder
+    signers = {}
+    for cn in ("Good Signer", "Revoked Signer"):
+        key, cert = ca.issue(cn)
+        pfx = pkcs12.serialize_key_and_certificates(
+            cn.encode(), key, cert, [ca.cert], serialization.BestAvailableEncryption(PIN.encode()))
+        SN = format(cert.serial_number, 'x')
+        install_pfx(pfx, SN, PIN, os.path.join(workdir, 'save', 'PFX'), pin_folder)
+        signers[cn] = (SN, cert)
+
+    configure(TSA_URL=good_tsa_url, TSA_FALLBACK_URL='', TSA_REQUIRED=True)
+    import revocation
+    import sign_pdf_pfx
+    from ManageX_Signer_Server import app
+    from endesive import pdf as endesive_pdf
+    from timestamping import _verify_token
+    revocation.REVOCATION_MODE = sign_pdf_pfx.REVOCATION_MODE = 'require'
+    client = app.test_client()
+    pdf_data = make_pdf(2)
+    SN, cert = signers["Good Signer"]
+
+    def sign(signer_SN):
+        return client.post(SIGN_PATH, json=sign_request(signer_SN, pdf_data, f"tsa-{time.time_ns()}",
+                                                        response_mode="base64"))
+
+    # 1. Timestamped, OCSP-checked signature
+    response = sign(SN)
+    check(response.status_code == 200, "signs with OCSP 'require' and a TSA",
+          f"({response.status_code} {response.get_json()})")
+    signed = base64.b64decode(response.get_json()['response']['signed_pdf_data'])
+    results = endesive_pdf.verify(signed, [ca.cert.public_bytes(serialization.Encoding.PEM)])
+    check(bool(results) and all(hash_ok and signature_ok for hash_ok, signature_ok, _ in results),
+          "endesive.pdf.verify accepts the signature", results)
+    check(ca.ocsp_hits >= 1 and b'/DSS' in signed and b'/OCSPs' in signed, "OCSP response is embedded in the DSS")
+
+    signature_value, token = embedded_token(signed)
+    check(token is not None, "signature carries a timestamp token")
+    tst_info = token['content']['encap_content_info']['content'].parsed
+    _verify_token(token, tst_info)
+    check(tst_info['message_imprint']['hashed_message'].native == hashlib.sha256(signature_value).digest(),
+          "embedded timestamp verifies against the TSA certificate and covers the signature value")
+
+    # 2. A TSA whose token signature does not verify is skipped for the fallback
+    configure(TSA_URL=forged_tsa_url, TSA_FALLBACK_URL=good_tsa_url)
+    hits = good_tsa.hits
+    response = sign(SN)
+    check(response.status_code == 200 and forged_tsa.hits == 1 and good_tsa.hits == hits + 1,
+          "forged token is refused and the fallback TSA is used", f"({response.status_code})")
+
+    # 3. Without a fallback the request fails
+    configure(TSA_URL=forged_tsa_url, TSA_FALLBACK_URL='')
+    response = sign(SN)
+    check(response.status_code == 502, "only a forging TSA gives 502",
+          f"({response.status_code} {response.get_json()})")
+
+    # 4. A revoked certificate is refused
+    configure(TSA_URL=good_tsa_url)
+    revoked_SN, revoked_cert = signers["Revoked Signer"]
+    ca.revoked.add(revoked_cert.serial_number)
+    response = sign(revoked_SN)
+    check(response.status_code == 403, "revoked certificate is refused",
+          f"({response.status_code} {response.get_json()})")
+
+    print("all TSA / OCSP checks passed")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
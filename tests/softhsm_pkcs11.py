@@ -0,0 +1,198 @@
+# softhsm_pkcs11.py
+"""
+End-to-end check of PKCS#11 signing against a throwaway SoftHSM token.
+
+Creates a token in a temporary SoftHSM store, imports a generated RSA key and its
+self-signed certificate, lists the certificate's SN in PKCS11_SIGNERS and then, with the
+server running in-process:
+
+  1. signs a PDF through /sign/api/v1.0/postjson and verifies it with endesive.pdf.verify,
+  2. closes an idle pool session behind the pool's back and checks that
+     SessionPool.check() replaces it and signing still works,
+  3. holds every pooled session and checks that a request gets 503 with Retry-After.
+
+Only the SoftHSM library is needed (apt install softhsm2); its path is taken from
+SOFTHSM2_LIB or the usual install locations. Exits 77 when SoftHSM is not installed.
+
+Run from the repository root:
+    python tests/softhsm_pkcs11.py
+"""
+import os
+import sys
+import json
+import time
+import base64
+import tempfile
+from contextlib import ExitStack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from fixtures import enter_workspace, make_pdf, make_pfx, sign_request
+
+import PyKCS11
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.serialization import pkcs12
+
+SIGN_PATH = '/sign/api/v1.0/postjson'
+TOKEN_LABEL = 'mx-test'
+USER_PIN = '1234'
+SO_PIN = '5678'
+KEY_LABEL = 'signer'
+KEY_ID = '01'
+
+SOFTHSM_PATHS = [
+    '/usr/lib/softhsm/libsofthsm2.so',
+    '/usr/lib/x86_64-linux-gnu/softhsm/libsofthsm2.so',
+    '/usr/lib/aarch64-linux-gnu/softhsm/libsofthsm2.so',
+    '/usr/lib64/pkcs11/libsofthsm2.so',
+    '/usr/local/lib/softhsm/libsofthsm2.so',
+    '/opt/homebrew/lib/softhsm/libsofthsm2.so',
+]
+
+
+def find_softhsm():
+    candidates = [os.environ['SOFTHSM2_LIB']] if os.environ.get('SOFTHSM2_LIB') else SOFTHSM_PATHS
+    return next((path for path in candidates if os.path.exists(path)), None)
+
+
+def _int_bytes(value):
+    return value.to_bytes((value.bit_length() + 7) // 8, 'big')
+
+
+def create_token(library, workdir):
+    """
+    Initialize a token in a SoftHSM store under workdir and import a new key and certificate.
+
+    Returns:
+        tuple: (PyKCS11Lib kept loaded for the run, SN, certificate)
+    """
+    token_dir = os.path.join(workdir, 'softhsm-tokens')
+    os.makedirs(token_dir)
+    config_path = os.path.join(workdir, 'softhsm2.conf')
+    with open(config_path, 'w') as f:
+        f.write(f"directories.tokendir = {token_dir}\nobjectstore.backend = file\nlog.level = ERROR\n")
+    # Must be set before the library is loaded
+    os.environ['SOFTHSM2_CONF'] = config_path
+
+    lib = PyKCS11.PyKCS11Lib()
+    lib.load(library)
+    lib.initToken(lib.getSlotList(tokenPresent=True)[0], SO_PIN, TOKEN_LABEL)
+    # SoftHSM moves an initialized token to a new slot
+    slot = next(slot for slot in lib.getSlotList(tokenPresent=True)
+                if lib.getTokenInfo(slot).label.strip().rstrip('\0') == TOKEN_LABEL)
+
+    session = lib.openSession(slot, PyKCS11.CKF_SERIAL_SESSION | PyKCS11.CKF_RW_SESSION)
+    session.login(SO_PIN, user_type=PyKCS11.CKU_SO)
+    session.initPin(USER_PIN)
+    session.logout()
+    session.login(USER_PIN)
+
+    pfx_bytes, SN = make_pfx(USER_PIN, cn="SoftHSM Test Signer")
+    key, certificate, _ = pkcs12.load_key_and_certificates(pfx_bytes, USER_PIN.encode())
+    numbers = key.private_numbers()
+    key_id = bytes.fromhex(KEY_ID)
+    session.createObject([
+        (PyKCS11.CKA_CLASS, PyKCS11.CKO_PRIVATE_KEY),
+        (PyKCS11.CKA_KEY_TYPE, PyKCS11.CKK_RSA),
+        (PyKCS11.CKA_TOKEN, PyKCS11.CK_TRUE),
+        (PyKCS11.CKA_PRIVATE, PyKCS11.CK_TRUE),
+        (PyKCS11.CKA_SENSITIVE, PyKCS11.CK_TRUE),
+        (PyKCS11.CKA_SIGN, PyKCS11.CK_TRUE),
+        (PyKCS11.CKA_LABEL, KEY_LABEL),
+        (PyKCS11.CKA_ID, key_id),
+        (PyKCS11.CKA_MODULUS, _int_bytes(numbers.public_numbers.n)),
+        (PyKCS11.CKA_PUBLIC_EXPONENT, _int_bytes(numbers.public_numbers.e)),
+        (PyKCS11.CKA_PRIVATE_EXPONENT, _int_bytes(numbers.d)),
+        (PyKCS11.CKA_PRIME_1, _int_bytes(numbers.p)),
+        (PyKCS11.CKA_PRIME_2, _int_bytes(numbers.q)),
+        (PyKCS11.CKA_EXPONENT_1, _int_bytes(numbers.dmp1)),
+        (PyKCS11.CKA_EXPONENT_2, _int_bytes(numbers.dmq1)),
+        (PyKCS11.CKA_COEFFICIENT, _int_bytes(numbers.iqmp)),
+    ])
+    session.createObject([
+        (PyKCS11.CKA_CLASS, PyKCS11.CKO_CERTIFICATE),
+        (PyKCS11.CKA_CERTIFICATE_TYPE, PyKCS11.CKC_X_509),
+        (PyKCS11.CKA_TOKEN, PyKCS11.CK_TRUE),
+        (PyKCS11.CKA_LABEL, KEY_LABEL),
+        (PyKCS11.CKA_ID, key_id),
+        (PyKCS11.CKA_SUBJECT, certificate.subject.public_bytes()),
+        (PyKCS11.CKA_VALUE, certificate.public_bytes(serialization.Encoding.DER)),
+    ])
+    session.logout()
+    session.closeSession()
+    return lib, SN, certificate
+
+
+def check(condition, message, detail=''):
+    if not condition:
+        raise AssertionError(f"{message} {detail}")
+    print(f"ok   {message}")
+
+
+def sign_and_verify(client, SN, pdf_data, certificate):
+    from endesive import pdf as endesive_pdf
+
+    response = client.post(SIGN_PATH, json=sign_request(SN, pdf_data, f"softhsm-{time.time_ns()}",
+                                                        response_mode="base64"))
+    check(response.status_code == 200, "postjson signs with the token key",
+          f"({response.status_code} {response.get_json()})")
+    signed = base64.b64decode(response.get_json()['response']['signed_pdf_data'])
+    results = endesive_pdf.verify(signed, [certificate.public_bytes(serialization.Encoding.PEM)])
+    check(bool(results) and all(hash_ok and signature_ok for hash_ok, signature_ok, _ in results),
+          "endesive.pdf.verify accepts the signature", results)
+
+
+def main():
+    library = find_softhsm()
+    if library is None:
+        print("SoftHSM library not found; install softhsm2 or set SOFTHSM2_LIB")
+        return 77
+
+    workdir = enter_workspace(tempfile.mkdtemp(prefix='mx-softhsm-'))
+    setup_lib, SN, certificate = create_token(library, workdir)
+
+    from config_loader import load_config
+    config = load_config()
+    config['PKCS11_SIGNERS'] = {SN: {'library': library, 'token': TOKEN_LABEL, 'pin': USER_PIN,
+                                     'key_label': KEY_LABEL, 'key_id': KEY_ID}}
+    with open('managex_signer.config', 'w') as f:
+        json.dump(config, f, indent=4)
+
+    import pkcs11_backend
+    from ManageX_Signer_Server import app
+    client = app.test_client()
+    pdf_data = make_pdf(2)
+
+    # 1. Sign through the API and verify
+    sign_and_verify(client, SN, pdf_data, certificate)
+    pool = pkcs11_backend._pools[(library, TOKEN_LABEL)]
+    check(pool.counts() == {'idle': pool.size, 'in_use': 0}, f"pool keeps {pool.size} sessions open {pool.counts()}")
+
+    # 2. A session closed outside the pool is found by the health check and replaced
+    with pool._lock:
+        dead = pool._idle[0]
+    dead.closeSession()
+    pool.check()
+    with pool._lock:
+        idle = list(pool._idle)
+    check(dead not in idle and len(idle) == pool.size and pool.healthy,
+          "SessionPool.check() replaces a closed session")
+    sign_and_verify(client, SN, pdf_data, certificate)
+
+    # 3. With every session borrowed, a request waits PKCS11_ACQUIRE_TIMEOUT and gets 503
+    pkcs11_backend.PKCS11_ACQUIRE_TIMEOUT = 1
+    with ExitStack() as held:
+        for _ in range(pool.size):
+            held.enter_context(pool.session())
+        response = client.post(SIGN_PATH, json=sign_request(SN, pdf_data, f"softhsm-{time.time_ns()}"))
+        check(response.status_code == 503 and response.headers.get('Retry-After'),
+              "exhausted pool answers 503 with Retry-After", f"({response.status_code})")
+    sign_and_verify(client, SN, pdf_data, certificate)
+
+    pool.close()
+    setup_lib.closeAllSessions(pool.slot)
+    print("all PKCS#11 checks passed")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+# text_search.py
+"""
+Find anchor text in a PDF and derive a signature box next to it.
+
+Word positions are extracted page by page with PyMuPDF and cached by the document's
+SHA-256 and page number, so signing the same template again skips extraction entirely.
+Only the pages being searched are ever extracted.
+"""
+import string
+import hashlib
+import threading
+from collections import OrderedDict
+import fitz  # PyMuPDF
+from metrics import Counter
+from env import TEXT_INDEX_MAX_PAGES, SEARCH_TEXT_BOX_WIDTH, SEARCH_TEXT_BOX_HEIGHT, SEARCH_TEXT_BOX_GAP
+
+SEARCH_POSITIONS = ('below', 'above', 'right', 'left', 'over')
+SEARCH_OCCURRENCES = ('first', 'last', 'all')
+
+# Pages extracted per step while looking for the first match
+FIRST_MATCH_BATCH_PAGES = 8
+
+# Stripped from both ends of indexed and searched words, so "Date" matches "Date:" but not "Update:"
+WORD_PUNCTUATION = string.punctuation + '\u2018\u2019\u201c\u201d\u00ab\u00bb\u2013\u2014\u2026\u2022\u00b7'
+
+# (document hash, page index) -> {'words': [(x0, y0, x1, y1, word)], 'bounds': (x0, y0, x1, y1)}
+# in PDF user space (origin bottom left), words case-folded without surrounding punctuation
+_page_index = OrderedDict()
+_page_index_lock = threading.Lock()
+
+TEXT_INDEX_EVENTS = Counter('mx_text_index_events_total', 'Page text index cache hits and misses', ('event',))
+
+
+def document_hash(pdf_data):
+    return hashlib.sha256(pdf_data).hexdigest()
+
+
+def _normalize_word(word):
+    return word.casefold().strip(WORD_PUNCTUATION)
+
+
+def _extract_page(doc, page_index):
+    page = doc[page_index]
+    to_pdf = ~page.transformation_matrix
+    a, b, c, d, e, f = to_pdf
+    words = []
+    # Content-stream order (no sort=True, which costs ~5x); the page matrix only flips and
+    # rotates by multiples of 90 degrees, so transforming two corners is enough
+    for x0, y0, x1, y1, word, *_ in page.get_text("words"):
+        word = _normalize_word(word)
+        if not word:
+            continue  # Punctuation only, e.g. a dash between words
+        px0, py0 = a * x0 + c * y0 + e, b * x0 + d * y0 + f
+        px1, py1 = a * x1 + c * y1 + e, b * x1 + d * y1 + f
+        words.append((min(px0, px1), min(py0, py1), max(px0, px1), max(py0, py1), word))
+    bounds = page.cropbox * to_pdf
+    return {'words': words, 'bounds': (bounds.x0, bounds.y0, bounds.x1, bounds.y1)}
+
+
+def get_page_index(pdf_data, pages, doc_hash=None):
+    """
+    Return {page index: page text index} for the given pages, extracting only cache misses.
+    """
+    doc_hash = doc_hash or document_hash(pdf_data)
+    indexes, missing = {}, []
+    with _page_index_lock:
+        for page_index in pages:
+            entry = _page_index.get((doc_hash, page_index))
+            if entry is None:
+                missing.append(page_index)
+            else:
+                _page_index.move_to_end((doc_hash, page_index))
+                indexes[page_index] = entry
+    TEXT_INDEX_EVENTS.inc(len(indexes), event='hit')
+
+    if missing:
+        TEXT_INDEX_EVENTS.inc(len(missing), event='miss')
+        with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+            extracted = {page_index: _extract_page(doc, page_index) for page_index in missing}
+        with _page_index_lock:
+            for page_index, entry in extracted.items():
+                _page_index[(doc_hash, page_index)] = entry
+            while len(_page_index) > TEXT_INDEX_MAX_PAGES:
+                _page_index.popitem(last=False)
+        indexes.update(extracted)
+    return indexes
+
+
+def _match_at(words, start, needle):
+    """True if the needle words are the words from position start on."""
+    end = start + len(needle)
+    if end > len(words):
+        return False
+    return all(words[start + k][4] == needle[k] for k in range(len(needle)))
+
+
+def _search(indexes, pages, search_text):
+    needle = [word for word in map(_normalize_word, search_text.split()) if word]
+    found = []
+    for page_index in pages if needle else ():
+        words = indexes[page_index]['words']
+        for start in range(len(words)):
+            if _match_at(words, start, needle):
+                matched = words[start:start + len(needle)]
+                found.append((page_index, (
+                    min(word[0] for word in matched), min(word[1] for word in matched),
+                    max(word[2] for word in matched), max(word[3] for word in matched),
+                )))
+    return found
+
+
+def find_text(pdf_data, search_text, pages):
+    """
+    Locate search_text (case-insensitive, whole whitespace-separated words, punctuation
+    around them ignored) on the given pages.
+
+    Returns:
+        list: (page index, (x0, y0, x1, y1)) per occurrence in page order, the rectangle
+        enclosing the matched words in PDF user space.
+    """
+    return _search(get_page_index(pdf_data, pages), pages, search_text)
+
+
+def box_near(anchor, bounds, position='below', width=SEARCH_TEXT_BOX_WIDTH, height=SEARCH_TEXT_BOX_HEIGHT,
+             gap=SEARCH_TEXT_BOX_GAP):
+    """
+    Place a width x height signature box at `position` relative to the anchor rectangle,
+    shifted back inside the page bounds. Returns [x1, y1, x2, y2] like the coordinates option.
+    """
+    ax0, ay0, ax1, ay1 = anchor
+    if position == 'above':
+        x0, y0 = ax0, ay1 + gap
+    elif position == 'right':
+        x0, y0 = ax1 + gap, (ay0 + ay1 - height) / 2
+    elif position == 'left':
+        x0, y0 = ax0 - gap - width, (ay0 + ay1 - height) / 2
+    elif position == 'over':
+        x0, y0 = (ax0 + ax1 - width) / 2, (ay0 + ay1 - height) / 2
+    else:  # below
+        x0, y0 = ax0, ay0 - gap - height
+
+    bx0, by0, bx1, by1 = bounds
+    x0 = max(bx0, min(x0, bx1 - width))
+    y0 = max(by0, min(y0, by1 - height))
+    return [int(round(x0)), int(round(y0)), int(round(x0 + width)), int(round(y0 + height))]
+
+
+def find_signature_boxes(pdf_data, search_text, pages, position='below', occurrence='first'):
+    """
+    Signature placements next to search_text.
+
+    Returns:
+        list: (page index, [x1, y1, x2, y2]) for the first, last or all occurrences;
+        empty if the text is not on the searched pages.
+    """
+    pages = list(pages)
+    doc_hash = document_hash(pdf_data)
+    if occurrence == 'first':
+        # Extract a few pages at a time and stop at the first page with a match
+        indexes, found = {}, []
+        for start in range(0, len(pages), FIRST_MATCH_BATCH_PAGES):
+            batch = pages[start:start + FIRST_MATCH_BATCH_PAGES]
+            indexes.update(get_page_index(pdf_data, batch, doc_hash))
+            found = _search(indexes, batch, search_text)[:1]
+            if found:
+                break
+    else:
+        indexes = get_page_index(pdf_data, pages, doc_hash)
+        found = _search(indexes, pages, search_text)
+        if occurrence == 'last':
+            found = found[-1:]
+    return [(page, box_near(anchor, indexes[page]['bounds'], position)) for page, anchor in found]
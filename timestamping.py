@@ -0,0 +1,316 @@
+# timestamping.py
+"""
+RFC 3161 signature timestamps from the TSA configured in managex_signer.config.
+
+A signature is created with space reserved for the token in /Contents, so it is signed
+once; the timestamp over its signature value is then added as an unsigned attribute and
+written into the reserved space. The document hash does not change, as /Contents is
+outside the signed byte range. This runs after the signing executor returns, so pool
+workers never wait on the network.
+
+Every request goes through one pooled keep-alive session, at most TSA_MAX_CONCURRENT at
+a time, and falls back to TSA_FALLBACK_URL when the primary TSA fails. A token is only
+used after its CMS signature has been verified against the TSA certificate it carries.
+"""
+import os
+import re
+import time
+import hashlib
+import secrets
+import threading
+from base64 import b64encode
+import requests
+from requests.adapters import HTTPAdapter
+from asn1crypto import cms, tsp, algos
+from cryptography import x509
+from cryptography.x509 import ExtensionOID, ExtendedKeyUsageOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, ec, rsa
+from config_loader import load_config
+from metrics import Counter, Gauge, Histogram
+from env import TSA_TIMEOUT, TSA_MAX_CONCURRENT, TSA_RESERVED_BYTES
+
+# Room for the CMS structure around the certificates and the signature value
+SIGNATURE_OVERHEAD_BYTES = 4096
+
+TSA_REQUESTS = Counter('mx_tsa_requests_total', 'TSA requests, by TSA and result', ('tsa', 'result'))
+TSA_DURATION = Histogram('mx_tsa_request_seconds', 'TSA round-trip time, by TSA', ('tsa',))
+
+_slots = threading.BoundedSemaphore(TSA_MAX_CONCURRENT)
+_in_flight = {'count': 0}
+_in_flight_lock = threading.Lock()
+
+
+class TimestampError(Exception):
+    """No configured TSA returned a valid timestamp."""
+
+
+# TSA settings are read from managex_signer.config on first use
+_settings = {'config': None}
+_settings_lock = threading.Lock()
+
+
+def _config():
+    with _settings_lock:
+        if _settings['config'] is None:
+            try:
+                _settings['config'] = load_config()
+            except Exception as e:
+                print(f"Error loading TSA settings: {e}")
+                _settings['config'] = {}
+        return _settings['config']
+
+
+def timestamping_enabled():
+    return bool(_config().get('TSA_URL'))
+
+
+# One session per process, its pool sized to the concurrency limit
+_http = {'session': None, 'pid': None}
+_http_lock = threading.Lock()
+
+
+def _session():
+    with _http_lock:
+        if _http['pid'] != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=TSA_MAX_CONCURRENT)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http.update(session=session, pid=os.getpid())
+        return _http['session']
+
+
+def _tsa_label(url):
+    return re.sub(r'^https?://', '', url).split('/')[0]
+
+
+def _hash_algorithm(name):
+    algorithm = getattr(hashes, name.upper(), None)
+    if algorithm is None:
+        raise TimestampError(f"Unsupported digest algorithm in TSA token: {name}")
+    return algorithm()
+
+
+def _tsa_certificate(signed_data, signer_info):
+    """The certificate in the token that the signer info names."""
+    sid = signer_info['sid']
+    for candidate in signed_data['certificates'] or []:
+        if candidate.name != 'certificate':
+            continue
+        certificate = candidate.chosen
+        if sid.name == 'issuer_and_serial_number':
+            if (certificate.issuer == sid.chosen['issuer']
+                    and certificate.serial_number == sid.chosen['serial_number'].native):
+                return certificate
+        elif certificate.key_identifier == sid.chosen.native:
+            return certificate
+    raise TimestampError("TSA token does not carry the TSA certificate")
+
+
+def _verify_token(token, tst_info):
+    """
+    Check that the token is signed by the TSA certificate it carries: the signed attributes
+    bind the TSTInfo and that certificate, and the signature over them verifies with its
+    key. The certificate must be for time stamping and valid at the token's genTime.
+
+    Raises:
+        TimestampError: If any check fails.
+    """
+    signed_data = token['content']
+    if signed_data['encap_content_info']['content_type'].native != 'tst_info':
+        raise TimestampError("TSA token does not contain a TSTInfo")
+    if len(signed_data['signer_infos']) != 1:
+        raise TimestampError("TSA token must have exactly one signer")
+    signer_info = signed_data['signer_infos'][0]
+    signed_attrs = signer_info['signed_attrs']
+    if not signed_attrs:
+        raise TimestampError("TSA token has no signed attributes")
+
+    certificate = _tsa_certificate(signed_data, signer_info)
+    certificate_der = certificate.dump()
+    hash_name = signer_info['digest_algorithm']['algorithm'].native
+    attributes = {attribute['type'].native: attribute['values'][0] for attribute in signed_attrs}
+
+    content = signed_data['encap_content_info']['content'].contents
+    if attributes.get('content_type') is None or attributes['content_type'].native != 'tst_info':
+        raise TimestampError("TSA token content type attribute is not TSTInfo")
+    if attributes.get('message_digest') is None or \
+            attributes['message_digest'].native != hashlib.new(hash_name, content).digest():
+        raise TimestampError("TSA token message digest does not match its TSTInfo")
+
+    # ESS signing certificate (RFC 3161 / RFC 5816): the hash of the TSA certificate
+    if attributes.get('signing_certificate_v2') is not None:
+        essential = attributes['signing_certificate_v2']['certs'][0]
+        cert_hash_name = essential['hash_algorithm']['algorithm'].native
+        if essential['cert_hash'].native != hashlib.new(cert_hash_name, certificate_der).digest():
+            raise TimestampError("TSA token signing certificate attribute does not match the TSA certificate")
+    elif attributes.get('signing_certificate') is not None:
+        essential = attributes['signing_certificate']['certs'][0]
+        if essential['cert_hash'].native != hashlib.sha1(certificate_der).digest():
+            raise TimestampError("TSA token signing certificate attribute does not match the TSA certificate")
+
+    tsa_cert = x509.load_der_x509_certificate(certificate_der)
+    try:
+        usage = tsa_cert.extensions.get_extension_for_oid(ExtensionOID.EXTENDED_KEY_USAGE).value
+    except x509.ExtensionNotFound:
+        usage = []
+    if ExtendedKeyUsageOID.TIME_STAMPING not in usage:
+        raise TimestampError("TSA certificate is not for time stamping")
+    gen_time = tst_info['gen_time'].native
+    if not tsa_cert.not_valid_before_utc <= gen_time <= tsa_cert.not_valid_after_utc:
+        raise TimestampError("TSA certificate is not valid at the token's time")
+
+    # The signature covers the DER of the signed attributes as a SET OF
+    signature = signer_info['signature'].native
+    data = signed_attrs.untag().dump()
+    algorithm = signer_info['signature_algorithm']
+    public_key = tsa_cert.public_key()
+    try:
+        if isinstance(public_key, rsa.RSAPublicKey):
+            if algorithm.signature_algo == 'rsassa_pss':
+                parameters = algorithm['parameters']
+                pss_hash = _hash_algorithm(parameters['hash_algorithm']['algorithm'].native)
+                public_key.verify(signature, data, padding.PSS(padding.MGF1(pss_hash), parameters['salt_length'].native),
+                                  pss_hash)
+            else:
+                public_key.verify(signature, data, padding.PKCS1v15(), _hash_algorithm(hash_name))
+        elif isinstance(public_key, ec.EllipticCurvePublicKey):
+            public_key.verify(signature, data, ec.ECDSA(_hash_algorithm(hash_name)))
+        else:
+            public_key.verify(signature, data)
+    except TimestampError:
+        raise
+    except Exception:
+        raise TimestampError("TSA token signature does not verify with the TSA certificate")
+
+
+def _request_token(url, digest, hashalgo):
+    """Ask one TSA for a token over digest and check that it answers this request."""
+    nonce = secrets.randbits(63)
+    request = tsp.TimeStampReq({
+        'version': 1,
+        'message_imprint': tsp.MessageImprint({
+            'hash_algorithm': algos.DigestAlgorithm({'algorithm': hashalgo}),
+            'hashed_message': digest,
+        }),
+        'nonce': nonce,
+        'cert_req': True,
+    })
+
+    headers = {'Content-Type': 'application/timestamp-query'}
+    config = _config()
+    if config.get('TSA_USERNAME'):
+        credentials = f"{config['TSA_USERNAME']}:{config.get('TSA_PASSWORD', '')}"
+        headers['Authorization'] = f"Basic {b64encode(credentials.encode()).decode('ascii')}"
+
+    http_response = _session().post(url, data=request.dump(), headers=headers, timeout=TSA_TIMEOUT)
+    http_response.raise_for_status()
+
+    response = tsp.TimeStampResp.load(http_response.content)
+    status = response['status']['status'].native
+    if status not in ('granted', 'granted_with_mods'):
+        raise TimestampError(f"TSA answered {status}")
+
+    token = response['time_stamp_token']
+    tst_info = token['content']['encap_content_info']['content'].parsed
+    if tst_info['message_imprint']['hashed_message'].native != digest:
+        raise TimestampError("TSA token is for a different message imprint")
+    if tst_info['nonce'].native != nonce:
+        raise TimestampError("TSA token nonce does not match the request")
+    _verify_token(token, tst_info)
+    return token
+
+
+def request_timestamp(data, hashalgo='sha256'):
+    """
+    Timestamp token (a CMS ContentInfo) over data from the primary TSA, else the fallback.
+
+    Raises:
+        TimestampError: If every configured TSA fails.
+    """
+    digest = getattr(hashlib, hashalgo)(data).digest()
+    config = _config()
+    urls = [url for url in (config.get('TSA_URL'), config.get('TSA_FALLBACK_URL')) if url]
+    if not urls:
+        raise TimestampError("No TSA is configured")
+
+    if not _slots.acquire(timeout=TSA_TIMEOUT):
+        raise TimestampError(f"Timed out waiting for one of {TSA_MAX_CONCURRENT} TSA slots")
+    with _in_flight_lock:
+        _in_flight['count'] += 1
+    try:
+        errors = []
+        for url in urls:
+            tsa = _tsa_label(url)
+            started = time.perf_counter()
+            try:
+                token = _request_token(url, digest, hashalgo)
+            except Exception as e:
+                TSA_REQUESTS.inc(tsa=tsa, result='error')
+                errors.append(f"{tsa}: {e}")
+                print(f"TSA request to {tsa} failed: {e}")
+                continue
+            TSA_DURATION.observe(time.perf_counter() - started, tsa=tsa)
+            TSA_REQUESTS.inc(tsa=tsa, result='ok')
+            return token
+        raise TimestampError(f"Timestamping failed ({'; '.join(errors)})")
+    finally:
+        with _in_flight_lock:
+            _in_flight['count'] -= 1
+        _slots.release()
+
+
+def signature_reservation(cert, othercerts, timestamp=True):
+    """Bytes to reserve in /Contents for a signature (timestamped by default) made with this chain."""
+    chain = [cert] + list(othercerts or [])
+    return SIGNATURE_OVERHEAD_BYTES + (TSA_RESERVED_BYTES if timestamp else 0) + sum(
+        len(c.public_bytes(serialization.Encoding.DER)) for c in chain)
+
+
+def timestamp_signed_data(signed_data):
+    """Add a timestamp over the signature value of a CMS ContentInfo as an unsigned attribute."""
+    signer_info = signed_data['content']['signer_infos'][0]
+    hashalgo = signer_info['digest_algorithm']['algorithm'].native
+    token = request_timestamp(signer_info['signature'].native, hashalgo)
+
+    signer_info['unsigned_attrs'] = [
+        cms.CMSAttribute({
+            'type': cms.CMSAttributeType('signature_time_stamp_token'),
+            'values': cms.SetOfContentInfo([token]),
+        })
+    ]
+    return signed_data
+
+
+def add_timestamp(signed_pdf_data, original_length):
+    """
+    Timestamp the signature in the incremental update signed_pdf_data (appended to a
+    document of original_length bytes) and write it back into the reserved /Contents.
+
+    Returns:
+        bytes: The incremental update with the timestamped signature.
+    """
+    byte_range = re.search(rb'/ByteRange\s*\[\s*0\s+(\d+)\s+(\d+)\s+\d+\s*\]', signed_pdf_data)
+    if byte_range is None:
+        raise TimestampError("Signature /ByteRange not found")
+    # /Contents <hex> sits between the two signed byte ranges
+    start = int(byte_range.group(1)) - original_length + 1
+    end = int(byte_range.group(2)) - original_length - 1
+    reserved = end - start
+
+    signed_data = cms.ContentInfo.load(bytes.fromhex(signed_pdf_data[start:end].decode('ascii')))
+    contents = timestamp_signed_data(signed_data).dump(force=True).hex().encode('ascii')
+    if len(contents) > reserved:
+        raise TimestampError(
+            f"Timestamped signature needs {len(contents) // 2} bytes but only {reserved // 2} were reserved")
+
+    contents += b'0' * (reserved - len(contents))
+    return signed_pdf_data[:start] + contents + signed_pdf_data[end:]
+
+
+def tsa_required():
+    return bool(_config().get('TSA_REQUIRED', True))
+
+
+Gauge('mx_tsa_requests_in_flight', 'TSA requests currently in flight', function=lambda: _in_flight['count'])
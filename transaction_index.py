@@ -0,0 +1,218 @@
+# transaction_index.py
+"""
+SQLite index over the transaction journal for paginated, filtered history queries.
+
+The journal stays the source of truth; this index is derived from it and can be deleted
+and rebuilt at any time. Every query first indexes the records appended since the last
+sync, so only new journal bytes are read.
+"""
+import os
+import json
+import sqlite3
+import datetime
+import threading
+from transaction_tracker import JOURNAL_DIR, list_segments, segment_path, import_legacy_log
+from env import TRANSACTION_QUERY_DEFAULT_LIMIT, TRANSACTION_QUERY_MAX_LIMIT
+
+INDEX_DB_FILE = os.path.join(os.getcwd(), 'transaction_index.db')
+
+# Records inserted per SQLite transaction while catching up
+SYNC_BATCH_SIZE = 5000
+
+
+def _normalise_timestamp(value):
+    """Parse an ISO 8601 timestamp and return it in the UTC form the journal uses."""
+    parsed = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc).isoformat()
+
+
+class TransactionIndex:
+
+    def __init__(self, path=INDEX_DB_FILE, journal_dir=JOURNAL_DIR):
+        self.path = path
+        self.journal_dir = journal_dir
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS transactions ("
+            "seq INTEGER PRIMARY KEY, transaction_id TEXT, status TEXT, reason TEXT, "
+            "timestamp TEXT, segment INTEGER NOT NULL, offset INTEGER NOT NULL, "
+            "UNIQUE (segment, offset))"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS transactions_id ON transactions (transaction_id, seq)")
+        connection.execute("CREATE INDEX IF NOT EXISTS transactions_status ON transactions (status, seq)")
+        connection.execute("CREATE INDEX IF NOT EXISTS transactions_timestamp ON transactions (timestamp, seq)")
+        # How far the journal has been indexed
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sync_position ("
+            "id INTEGER PRIMARY KEY CHECK (id = 1), segment INTEGER NOT NULL, offset INTEGER NOT NULL)"
+        )
+        connection.execute("INSERT OR IGNORE INTO sync_position (id, segment, offset) VALUES (1, 1, 0)")
+
+    def _connection(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def sync(self):
+        """
+        Index journal records appended since the last sync.
+
+        Worker processes share the index; BEGIN IMMEDIATE lets one of them catch up at a time
+        and the others then find nothing left to do. Only complete (newline-terminated)
+        records are indexed.
+
+        Returns:
+            int: The number of records added.
+        """
+        added = 0
+        with self._sync_lock:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                segment, offset = connection.execute(
+                    "SELECT segment, offset FROM sync_position WHERE id = 1").fetchone()
+
+                rows = []
+                for number in list_segments(self.journal_dir):
+                    if number < segment:
+                        continue
+                    position = offset if number == segment else 0
+
+                    with open(segment_path(number, self.journal_dir), 'rb') as f:
+                        f.seek(position)
+                        for line in f:
+                            if not line.endswith(b'\n'):
+                                break
+                            try:
+                                entry = json.loads(line)
+                                transaction_id = entry.get('transaction_id')
+                                rows.append((
+                                    None if transaction_id is None else str(transaction_id),
+                                    entry.get('status'),
+                                    entry.get('reason'),
+                                    entry.get('timestamp'),
+                                    number,
+                                    position,
+                                ))
+                            except ValueError:
+                                pass
+                            position += len(line)
+
+                            if len(rows) >= SYNC_BATCH_SIZE:
+                                added += self._insert(connection, rows, number, position)
+                                rows = []
+
+                    added += self._insert(connection, rows, number, position)
+                    rows = []
+                    segment, offset = number, position
+
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return added
+
+    def _insert(self, connection, rows, segment, offset):
+        connection.executemany(
+            "INSERT OR IGNORE INTO transactions (transaction_id, status, reason, timestamp, segment, offset) "
+            "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        connection.execute("UPDATE sync_position SET segment = ?, offset = ? WHERE id = 1", (segment, offset))
+        return len(rows)
+
+    def query(self, status=None, txn_prefix=None, reason=None, since=None, until=None, cursor=None,
+              limit=TRANSACTION_QUERY_DEFAULT_LIMIT):
+        """
+        Return one page of transactions, newest first.
+
+        Args:
+            status (str, optional): Exact status, e.g. 'failure'.
+            txn_prefix (str, optional): Transaction ID prefix; a full ID looks up one transaction.
+            reason (str, optional): Case-insensitive substring of the reason.
+            since / until (str, optional): ISO 8601 bounds on the log timestamp (inclusive / exclusive).
+            cursor (str, optional): The next_cursor of the previous page.
+            limit (int): Page size, capped at TRANSACTION_QUERY_MAX_LIMIT.
+
+        Returns:
+            dict: {'transactions': [...], 'next_cursor': str or None}
+
+        Raises:
+            ValueError: If a timestamp or the cursor cannot be parsed.
+        """
+        self.sync()
+
+        clauses, params = [], []
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if txn_prefix:
+            # Range scan on the transaction_id index instead of LIKE
+            clauses.append("transaction_id >= ? AND transaction_id < ?")
+            params.extend([txn_prefix, txn_prefix + '\U0010ffff'])
+        if reason:
+            clauses.append("instr(lower(reason), ?) > 0")
+            params.append(reason.lower())
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(_normalise_timestamp(since))
+        if until:
+            clauses.append("timestamp < ?")
+            params.append(_normalise_timestamp(until))
+        if cursor:
+            clauses.append("seq < ?")
+            params.append(int(cursor))
+
+        limit = max(1, min(int(limit), TRANSACTION_QUERY_MAX_LIMIT))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connection().execute(
+            f"SELECT seq, transaction_id, status, reason, timestamp FROM transactions {where} "
+            f"ORDER BY seq DESC LIMIT ?", params + [limit + 1]).fetchall()
+
+        transactions = [
+            {'seq': seq, 'transaction_id': transaction_id, 'status': status, 'reason': reason, 'timestamp': timestamp}
+            for seq, transaction_id, status, reason, timestamp in rows[:limit]
+        ]
+        next_cursor = str(transactions[-1]['seq']) if len(rows) > limit else None
+        return {'transactions': transactions, 'next_cursor': next_cursor}
+
+    def rebuild(self):
+        """Drop the indexed rows and re-index the whole journal."""
+        with self._sync_lock:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM transactions")
+            connection.execute("UPDATE sync_position SET segment = 1, offset = 0 WHERE id = 1")
+            connection.execute("COMMIT")
+        return self.sync()
+
+
+# Shared index used by /api/transactions (created on first use)
+_index = {'instance': None}
+_index_lock = threading.Lock()
+
+
+def get_transaction_index():
+    with _index_lock:
+        if _index['instance'] is None:
+            _index['instance'] = TransactionIndex()
+        return _index['instance']
+
+
+def query_transactions(**filters):
+    return get_transaction_index().query(**filters)
+
+
+if __name__ == '__main__':
+    # Migration: import a legacy transaction_log.json into the journal, then (re)build the index
+    imported = import_legacy_log()
+    indexed = get_transaction_index().rebuild()
+    print(f"Imported {imported} legacy records; indexed {indexed} journal records into {INDEX_DB_FILE}")
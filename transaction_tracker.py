@@ -3,52 +3,161 @@ import json
 import re
 import threading
 import queue
+import time
+import datetime
+from collections import Counter, deque
+try:
+    import fcntl  # Serialises journal appends between worker processes (POSIX only)
+except ImportError:
+    fcntl = None
+from metrics import Gauge
+from notifications import notify as queue_notifications
+from env import (
+    JOURNAL_SEGMENT_MAX_MB,
+    JOURNAL_WRITE_BATCH_SIZE,
+    JOURNAL_FSYNC_INTERVAL,
+    JOURNAL_FSYNC_BATCH_SIZE,
+    LIVE_STATS_RECENT,
+    LIVE_STATS_RATE_WINDOWS
+)
 
 
-# Path to the transaction log file
+# Path to the legacy transaction log file (a single JSON array, imported into the journal once)
 LOG_FILE = os.path.join(os.getcwd(), 'transaction_log.json')
 
-# Ensure the log file exists
-if not os.path.exists(LOG_FILE):
-    with open(LOG_FILE, 'w') as f:
-        json.dump([], f)
+# Folder holding the append-only journal segments (newline-delimited JSON records)
+JOURNAL_DIR = os.path.join(os.getcwd(), 'transaction_journal')
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.jsonl'
 
-# Queue to hold logs that need to be written to the file
+SEGMENT_MAX_BYTES = JOURNAL_SEGMENT_MAX_MB * 1024 * 1024  # Convert to bytes
+
+# Ensure the journal folder exists
+if not os.path.exists(JOURNAL_DIR):
+    os.makedirs(JOURNAL_DIR)
+
+# Queue to hold logs that need to be written to the journal
 log_queue = queue.Queue()
 
-# Lock to ensure thread-safety when writing to the log file
+Gauge('mx_log_queue_depth', 'Log entries waiting to be written to the journal', function=log_queue.qsize)
+
+# Lock to ensure thread-safety when appending to / rotating the journal
 file_lock = threading.Lock()
 
+# Currently open tail segment of the writer thread, and the inter-process lock file
+_writer = {'number': None, 'file': None, 'lock': None}
+
+# In-memory index over the journal: record positions by transaction_id and counts by status.
+# 'segment'/'offset' is how far the journal has been indexed so far.
+# Live stats are kept alongside: 'seq' numbers the indexed records, 'recent' holds the last
+# LIVE_STATS_RECENT of them and 'buckets' counts records by status per RATE_BUCKET_SECONDS.
+_index_lock = threading.Lock()
+_index = {'segment': 1, 'offset': 0, 'by_id': {}, 'counts': Counter(),
+          'seq': 0, 'recent': deque(maxlen=LIVE_STATS_RECENT), 'buckets': {}}
+
+RATE_BUCKET_SECONDS = 10
+
+
+def segment_path(number, journal_dir=JOURNAL_DIR):
+    """Path of journal segment `number` (also used by the transaction index to read the journal)."""
+    return os.path.join(journal_dir, f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}")
+
+
+def list_segments(journal_dir=JOURNAL_DIR):
+    """Return the sorted segment numbers present in the journal folder."""
+    numbers = []
+    for name in os.listdir(journal_dir):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            try:
+                numbers.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+            except ValueError:
+                continue
+    return sorted(numbers)
+
+
+def _append_to_journal(data):
+    """Append already-serialised records to the tail segment, rotating it when it is full."""
+    if fcntl is not None:
+        if _writer['lock'] is None:
+            _writer['lock'] = open(os.path.join(JOURNAL_DIR, '.lock'), 'ab')
+        fcntl.flock(_writer['lock'].fileno(), fcntl.LOCK_EX)
+
+    try:
+        # Follow rotations done by other worker processes
+        segments = list_segments()
+        tail = segments[-1] if segments else 1
+        if _writer['file'] is None or _writer['number'] != tail:
+            if _writer['file'] is not None:
+                _writer['file'].close()
+            _writer['number'] = tail
+            _writer['file'] = open(segment_path(tail), 'ab', buffering=0)
+
+        size = os.fstat(_writer['file'].fileno()).st_size
+        if size and size + len(data) > SEGMENT_MAX_BYTES:
+            # Seal the full segment before starting the next one
+            os.fsync(_writer['file'].fileno())
+            _writer['file'].close()
+            _writer['number'] += 1
+            _writer['file'] = open(segment_path(_writer['number']), 'ab', buffering=0)
+
+        _writer['file'].write(data)
+
+    finally:
+        if fcntl is not None:
+            fcntl.flock(_writer['lock'].fileno(), fcntl.LOCK_UN)
+
+
+def _sync_journal():
+    if _writer['file'] is not None:
+        os.fsync(_writer['file'].fileno())
+
+
 def write_to_log_file():
     """
-    Worker thread that listens to the log queue and writes entries to the log file one at a time.
+    Worker thread that drains the log queue in batches and appends them to the journal.
+
+    Records are appended as soon as they are dequeued; fsync is group-committed once
+    JOURNAL_FSYNC_BATCH_SIZE records are pending or JOURNAL_FSYNC_INTERVAL seconds have passed.
     """
+    unsynced = 0
+    last_sync = time.monotonic()
+
     while True:
+        batch = []
         try:
-            # Wait for a log entry from the queue
-            log_entry = log_queue.get()
+            # Block until there is work; wake up on the interval while records are unsynced
+            try:
+                batch.append(log_queue.get(timeout=JOURNAL_FSYNC_INTERVAL if unsynced else None))
+            except queue.Empty:
+                pass
 
-            # Get the current logs
-            with open(LOG_FILE, 'r') as f:
-                logs = json.load(f)
+            while batch and len(batch) < JOURNAL_WRITE_BATCH_SIZE:
+                try:
+                    batch.append(log_queue.get_nowait())
+                except queue.Empty:
+                    break
 
-            # Append the new log entry
-            logs.append(log_entry)
+            if batch:
+                data = ''.join(json.dumps(entry) + '\n' for entry in batch).encode('utf-8')
+                with file_lock:
+                    _append_to_journal(data)
+                unsynced += len(batch)
 
-            # Write the updated logs back to the file with file locking
-            with file_lock:
-                with open(LOG_FILE, 'w') as f:
-                    json.dump(logs, f, indent=4)
-                    f.flush()
-                    os.fsync(f.fileno())
-
-
-            # Mark the task as done
-            log_queue.task_done()
+            if unsynced and (unsynced >= JOURNAL_FSYNC_BATCH_SIZE
+                             or time.monotonic() - last_sync >= JOURNAL_FSYNC_INTERVAL):
+                with file_lock:
+                    _sync_journal()
+                unsynced = 0
+                last_sync = time.monotonic()
 
         except Exception as e:
             print(f"Error in log file writing thread: {e}")
 
+        finally:
+            # Mark the tasks as done
+            for _ in batch:
+                log_queue.task_done()
+
 def start_logging_thread():
     """
     Starts the worker thread to process log entries from the queue.
@@ -56,6 +165,23 @@ def start_logging_thread():
     thread = threading.Thread(target=write_to_log_file, daemon=True)
     thread.start()
 
+def reinit_after_fork():
+    """
+    Reset per-process journal state in a freshly forked worker and start its logging thread.
+    """
+    _writer['number'] = None
+    _writer['file'] = None
+    _writer['lock'] = None
+    start_logging_thread()
+
+def flush_log():
+    """
+    Block until every queued log entry has been appended to the journal and synced to disk.
+    """
+    log_queue.join()
+    with file_lock:
+        _sync_journal()
+
 def log_transaction(transaction_id, status, reason=None, response=None, **kwargs):
     """
     Log a transaction with its status and reason (if any), and optionally send it to a webhook.
@@ -64,40 +190,188 @@ def log_transaction(transaction_id, status, reason=None, response=None, **kwargs
         transaction_id (str): The transaction ID.
         status (str): The status of the transaction ('success' or 'failure').
         reason (str, optional): The reason for failure, if applicable.
+        response (dict, optional): The response returned to the client, included in the webhook.
+        webhook_url / email (str, optional): Where to notify in addition to the configured WEBHOOK_URL.
+        notify (bool, optional): Pass False to only log (e.g. for the record of a sent email).
     """
     try:
         # Prepare the log entry
         log_entry = {
             "transaction_id": transaction_id,
             "status": status,
-            "reason": reason
+            "reason": reason,
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
         }
 
         # Add the log entry to the queue
         log_queue.put(log_entry)
 
+        # Webhook / email delivery happens on the notification workers
+        if kwargs.get('notify', True):
+            queue_notifications(log_entry, response, kwargs.get('webhook_url'), kwargs.get('email'))
+
     except Exception as e:
         print(f"Error logging transaction: {e}")
 
+def _catch_up_index():
+    """
+    Index any journal records appended since the last call.
+
+    Only complete (newline-terminated) records are indexed, so a record that is
+    still being written is picked up on the next call.
+    """
+    with _index_lock:
+        for number in list_segments():
+            if number < _index['segment']:
+                continue
+            offset = _index['offset'] if number == _index['segment'] else 0
+
+            with open(segment_path(number), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        entry = json.loads(line)
+                        _index['by_id'].setdefault(entry.get('transaction_id'), []).append((number, offset))
+                        _index['counts'][entry.get('status')] += 1
+                        _add_to_live_stats(entry)
+                    except ValueError:
+                        pass
+                    offset += len(line)
+
+            _index['segment'] = number
+            _index['offset'] = offset
+
+def _add_to_live_stats(entry):
+    """Feed one newly indexed record into the running live stats (caller holds _index_lock)."""
+    _index['seq'] += 1
+    _index['recent'].append({
+        'seq': _index['seq'],
+        'transaction_id': entry.get('transaction_id'),
+        'status': entry.get('status'),
+        'reason': entry.get('reason'),
+        'timestamp': entry.get('timestamp'),
+    })
+
+    # Records imported from the legacy log have no timestamp and only count towards totals
+    try:
+        logged_at = datetime.datetime.fromisoformat(entry['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return
+
+    bucket = int(logged_at // RATE_BUCKET_SECONDS)
+    oldest = int(time.time() // RATE_BUCKET_SECONDS) - max(LIVE_STATS_RATE_WINDOWS) * 60 // RATE_BUCKET_SECONDS
+    if bucket < oldest:
+        return
+    _index['buckets'].setdefault(bucket, Counter())[entry.get('status')] += 1
+
+    # Drop buckets that fell out of the widest rate window
+    if len(_index['buckets']) > max(LIVE_STATS_RATE_WINDOWS) * 60 // RATE_BUCKET_SECONDS + 1:
+        for old in [b for b in _index['buckets'] if b < oldest]:
+            del _index['buckets'][old]
+
+def get_transaction(transaction_id):
+    """
+    Retrieve every logged record of one transaction using the index.
+
+    Returns:
+        list: The log entries for the transaction ID, oldest first.
+    """
+    try:
+        _catch_up_index()
+        with _index_lock:
+            positions = list(_index['by_id'].get(transaction_id, []))
+
+        entries = []
+        for number, offset in positions:
+            with open(segment_path(number), 'rb') as f:
+                f.seek(offset)
+                entries.append(json.loads(f.readline()))
+        return entries
+    except Exception as e:
+        print(f"Error reading transaction {transaction_id}: {e}")
+        return []
+
+def count_transactions(status=None):
+    """
+    Count logged records, optionally only those with the given status.
+    """
+    _catch_up_index()
+    with _index_lock:
+        if status is None:
+            return sum(_index['counts'].values())
+        return _index['counts'].get(status, 0)
+
+def get_live_stats(since_seq=None):
+    """
+    Running transaction counters for the status page, without reading the whole log.
+
+    Args:
+        since_seq (int, optional): Only return recent records newer than this sequence number.
+
+    Returns:
+        dict: Totals by status, per-minute rates over LIVE_STATS_RATE_WINDOWS and the most
+        recent transactions; 'seq' is the sequence number of the newest indexed record.
+    """
+    _catch_up_index()
+    now_bucket = int(time.time() // RATE_BUCKET_SECONDS)
+
+    with _index_lock:
+        counts = {str(status): count for status, count in _index['counts'].items()}
+        recent = [entry for entry in _index['recent'] if since_seq is None or entry['seq'] > since_seq]
+        buckets = [(bucket, dict(counter)) for bucket, counter in _index['buckets'].items()]
+        seq = _index['seq']
+
+    rates = {}
+    for minutes in LIVE_STATS_RATE_WINDOWS:
+        window = Counter()
+        for bucket, counter in buckets:
+            if bucket > now_bucket - minutes * 60 // RATE_BUCKET_SECONDS:
+                window.update(counter)
+        rates[f"{minutes}m"] = {
+            'success': window.get('success', 0) / minutes,
+            'failure': window.get('failure', 0) / minutes,
+        }
+
+    return {
+        'seq': seq,
+        'total': sum(counts.values()),
+        'success': counts.get('success', 0),
+        'failure': counts.get('failure', 0),
+        'by_status': counts,
+        'rates_per_minute': rates,
+        'recent': recent,
+    }
+
 def get_transactions():
     """
     Retrieve all logged transactions.
-    
+
     Returns:
         list: A list of transaction logs.
     """
     try:
-        with open(LOG_FILE, 'r') as f:
-            return json.load(f)
+        logs = []
+        for number in list_segments():
+            with open(segment_path(number), 'rb') as f:
+                for line in f:
+                    if line.endswith(b'\n'):
+                        logs.append(json.loads(line))
+        return logs
     except Exception as e:
         print(f"Error reading transaction logs: {e}")
         return []
 
-def fix_malformed_json(file_path):
+def import_legacy_log(file_path=LOG_FILE):
+    """
+    One-time migration of the old JSON-array log into the journal.
+
+    Runs only while the journal is still empty; the legacy file is left untouched.
+    """
     try:
-        # Check if the file exists
-        if not os.path.exists(file_path):
-            return []
+        if list_segments() or not os.path.exists(file_path):
+            return 0
 
         # Read the raw content of the file
         with open(file_path, 'r') as f:
@@ -111,22 +385,79 @@ def fix_malformed_json(file_path):
         if not content.endswith(']'):
             content += ']'
 
-        # Validate JSON
         logs = json.loads(content)
 
-        # Save the corrected JSON back
-        with open(file_path, 'w') as f:
-            json.dump(logs, f, indent=4)
-            f.flush()
-            os.fsync(f.fileno())
+        data = ''.join(json.dumps(entry) + '\n' for entry in logs).encode('utf-8')
+        with file_lock:
+            _append_to_journal(data)
+            _sync_journal()
 
-        return logs
+        return len(logs)
 
-    except json.JSONDecodeError as jde:
-        return []
+    except Exception as e:
+        print(f"Error importing legacy transaction log: {e}")
+        return 0
+
+def fix_malformed_json(journal_dir=JOURNAL_DIR):
+    """
+    Crash recovery for the journal: drop a torn record at the end of the tail segment.
+
+    Only the tail segment can hold a partial write, and only its last record, so this
+    reads the segment backwards until the last newline instead of parsing the history.
+
+    Returns:
+        int: The number of bytes discarded.
+    """
+    try:
+        segments = list_segments(journal_dir)
+        if not segments:
+            return 0
+
+        path = segment_path(segments[-1], journal_dir)
+        with open(path, 'r+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            chunk_size = 64 * 1024
+
+            # Find the end of the last complete record
+            while end > 0:
+                start = max(0, end - chunk_size)
+                f.seek(start)
+                chunk = f.read(end - start)
+                newline = chunk.rfind(b'\n')
+                if newline != -1:
+                    end = start + newline + 1
+                    break
+                end = start
+
+            # A complete last record must also parse, otherwise drop it too
+            if end > 0:
+                line_start = end - 1
+                while line_start > 0:
+                    f.seek(max(0, line_start - chunk_size))
+                    chunk = f.read(line_start - max(0, line_start - chunk_size))
+                    newline = chunk.rfind(b'\n')
+                    if newline != -1:
+                        line_start = max(0, line_start - chunk_size) + newline + 1
+                        break
+                    line_start = max(0, line_start - chunk_size)
+                f.seek(line_start)
+                try:
+                    json.loads(f.read(end - line_start))
+                except ValueError:
+                    end = line_start
+
+            if end < size:
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+        return size - end
 
     except Exception as e:
-        return []
+        print(f"Error recovering transaction journal: {e}")
+        return 0
 
-# Start the logging thread when the program begins
+# Migrate the old log file and start the logging thread when the program begins
+import_legacy_log()
 start_logging_thread()
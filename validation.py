@@ -4,20 +4,37 @@ import datetime
 import base64
 import requests
 import time
-from pdf_utils import get_pdf_page_count, is_valid_pdf_base64
+from pdf_utils import probe_pdf, is_valid_pdf_base64
 import fitz  # PyMuPDF
 from io import BytesIO
 from transaction_tracker import log_transaction
+from pdf_processing import RESPONSE_MODES
 import re
 import platform
 import os
 from requests.exceptions import SSLError
-from env import  MAX_PDF_SIZE_MB, Default_Coordinates
+from env import  MAX_PDF_SIZE_MB, MAX_STREAM_PDF_SIZE_MB, Default_Coordinates, TIMESTAMP_WINDOW_SECONDS, Appearance_Templates, MAX_SIGNATURE_PLACEMENTS, SEARCH_TEXT_MAX_PAGES
+from replay_store import replay_store
+from disposable_email import is_disposable_email
+from text_search import find_signature_boxes, SEARCH_POSITIONS, SEARCH_OCCURRENCES
+from metrics import time_stage, PDF_SIZE
+from hash_signing import HASH_ALGORITHMS
+from notifications import check_webhook_url
+from signature_utils import parse_date_format
 
-used_transaction_ids = set()  # Shared resource for tracking transaction IDs
+# Folder holding one PIN file per certificate serial number
+if platform.system() == "Windows":
+    PIN_FOLDER = r"D:\project\MX_Signer_Server\save\PIN"
+else:
+    PIN_FOLDER = "/home/managex/Projects/MX_Signer_Server/save/PIN"
+
+pin_file_cache = {}  # Parsed PIN files keyed by SN, reused while the file mtime is unchanged
 
 
 MAX_PDF_SIZE_BYTES = MAX_PDF_SIZE_MB * 1024 * 1024  # Convert to bytes
+MAX_STREAM_PDF_SIZE_BYTES = MAX_STREAM_PDF_SIZE_MB * 1024 * 1024  # Limit for raw / multipart uploads
+
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
 
 
 
@@ -28,12 +45,23 @@ def validate_request_data(request_data, txn_id):
         log_transaction(txn_id, "failure", "Invalid or missing command")
         return {'error': 'Invalid or missing command.', 'status': 400}
 
-    # Check if the transaction ID is unique
-    if txn_id in used_transaction_ids:
-        log_transaction(txn_id, "failure", "Duplicate transaction ID")
-        return {'error': 'Duplicate transaction ID', 'status': 400}
-    else:
-        used_transaction_ids.add(txn_id)  # Add the txn_id to the used set
+    # Check the requested response mode
+    response_mode = request_data.get('request', {}).get('response_mode')
+    if response_mode and response_mode not in RESPONSE_MODES:
+        log_transaction(txn_id, "failure", "Invalid response_mode")
+        return {'error': f"Invalid response_mode. Use one of: {', '.join(RESPONSE_MODES)}.", 'status': 400}
+
+    # Check the optional notification targets
+    webhook_url = request_data.get('request', {}).get('webhook_url')
+    if webhook_url:
+        refused = check_webhook_url(webhook_url)
+        if refused:
+            log_transaction(txn_id, "failure", "Invalid webhook_url")
+            return {'error': f'Invalid webhook_url. {refused}', 'status': 400}
+
+    email_result = validate_email_fields(request_data, txn_id)
+    if 'error' in email_result:
+        return email_result
 
     # Extract timestamp from the request data
     timestamp = request_data.get('request', {}).get('timestamp')
@@ -41,17 +69,23 @@ def validate_request_data(request_data, txn_id):
         log_transaction(txn_id, "failure", "Timestamp is missing")
         return {'error': 'Timestamp is missing.', 'status': 400}
     
-    # Validate timestamp: Must not be older than 30 seconds
+    # Validate timestamp: Must not be older than TIMESTAMP_WINDOW_SECONDS
     try:
         timestamp_dt = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
         current_time = datetime.datetime.now(datetime.timezone.utc)
         time_difference = (current_time - timestamp_dt).total_seconds()
-        if abs(time_difference) > 30:
-            log_transaction(txn_id, "failure", "Timestamp is older than 30 seconds")
-            return {'error': 'Timestamp is older than 30 seconds.', 'status': 400}
-    except ValueError:
+        if abs(time_difference) > TIMESTAMP_WINDOW_SECONDS:
+            log_transaction(txn_id, "failure", f"Timestamp is older than {TIMESTAMP_WINDOW_SECONDS} seconds")
+            return {'error': f'Timestamp is older than {TIMESTAMP_WINDOW_SECONDS} seconds.', 'status': 400}
+    except (ValueError, TypeError):
         log_transaction(txn_id, "failure", "Invalid timestamp format")
         return {'error': 'Invalid timestamp format.', 'status': 400}
+
+    # Check if the transaction ID is unique. Only requests inside the timestamp window get
+    # here, so the replay store only has to remember IDs for that window.
+    if not replay_store.check_and_add(txn_id):
+        log_transaction(txn_id, "failure", "Duplicate transaction ID")
+        return {'error': 'Duplicate transaction ID', 'status': 400}
     
    
 
@@ -60,17 +94,38 @@ def validate_request_data(request_data, txn_id):
 
 
 
+def validate_email_fields(request_data, txn_id):
+    """Check every email field of the request (`email` or `*_email`, a string or a list)."""
+    for field, value in request_data.get('request', {}).items():
+        if field != 'email' and not field.endswith('_email'):
+            continue
+        for address in (value if isinstance(value, list) else [value]):
+            if not address:
+                continue
+            if not EMAIL_PATTERN.match(str(address)):
+                log_transaction(txn_id, "failure", f"Invalid {field} address")
+                return {'error': f'Invalid {field} address.', 'status': 400}
+            if is_disposable_email(address):
+                log_transaction(txn_id, "failure", f"Disposable {field} address rejected")
+                return {'error': f'Disposable email addresses are not allowed ({field}).', 'status': 400}
+
+    return {'success': True}
+
+
 def validate_pdf_data(request_data, txn_id):
     # Extract pdf_base64 and pdf_url
     pdf_base64 = request_data.get('request', {}).get('pdf_data')
 
     
     if pdf_base64:
-        pdf_data = is_valid_pdf_base64(pdf_base64)
+        with time_stage('base64_decode'):
+            pdf_data = is_valid_pdf_base64(pdf_base64)
         if not pdf_data:
             log_transaction(txn_id, "failure", "Invalid PDF in base64 format")
             return {'error': 'Invalid PDF in base64 format.', 'status': 400}
 
+        PDF_SIZE.observe(len(pdf_data))
+
         # Check the size of the PDF (after base64 decoding)
         if len(pdf_data) > MAX_PDF_SIZE_BYTES:
             log_transaction(txn_id, "failure", f"PDF size exceeds {MAX_PDF_SIZE_MB}MB")
@@ -84,6 +139,54 @@ def validate_pdf_data(request_data, txn_id):
     # If all checks pass, return the valid PDF data
     return {'success': True, 'pdf_data': pdf_data}
 
+def validate_pdf_bytes(pdf_data, txn_id):
+    """Validate a PDF received as raw bytes or a mapped buffer (streamed upload) instead of base64 JSON."""
+    if not pdf_data:
+        log_transaction(txn_id, "failure", "Neither valid pdf_data  was provided")
+        return {'error': 'Neither valid pdf_data  was provided.', 'status': 400}
+
+    PDF_SIZE.observe(len(pdf_data))
+
+    if bytes(pdf_data[:4]) != b'%PDF':
+        log_transaction(txn_id, "failure", "Invalid PDF data")
+        return {'error': 'Invalid PDF data.', 'status': 400}
+
+    if len(pdf_data) > MAX_STREAM_PDF_SIZE_BYTES:
+        log_transaction(txn_id, "failure", f"PDF size exceeds {MAX_STREAM_PDF_SIZE_MB}MB")
+        return {'error': f'PDF size exceeds {MAX_STREAM_PDF_SIZE_MB}MB.', 'status': 413}
+
+    return {'success': True, 'pdf_data': pdf_data}
+
+
+def validate_hash_data(request_data, txn_id):
+    """
+    Validate the `hash` of a sign-hash request: an algorithm and its digest in hex or base64.
+    """
+    hash_data = request_data.get('request', {}).get('hash')
+    if not isinstance(hash_data, dict) or not hash_data.get('digest'):
+        log_transaction(txn_id, "failure", "Hash digest missing")
+        return {'error': 'hash.digest is missing.', 'status': 400}
+
+    algorithm = str(hash_data.get('algorithm', 'sha256')).lower().replace('-', '')
+    if algorithm not in HASH_ALGORITHMS:
+        log_transaction(txn_id, "failure", "Unsupported hash algorithm")
+        return {'error': f"Unsupported hash.algorithm. Use one of: {', '.join(HASH_ALGORITHMS)}.", 'status': 400}
+
+    digest_text = str(hash_data['digest']).strip()
+    try:
+        if re.fullmatch(r'[0-9a-fA-F]+', digest_text) and len(digest_text) == HASH_ALGORITHMS[algorithm] * 2:
+            digest = bytes.fromhex(digest_text)
+        else:
+            digest = base64.b64decode(digest_text, validate=True)
+    except (base64.binascii.Error, ValueError):
+        digest = None
+    if not digest or len(digest) != HASH_ALGORITHMS[algorithm]:
+        log_transaction(txn_id, "failure", "Invalid hash digest")
+        return {'error': f'hash.digest must be a {algorithm} digest in hex or base64.', 'status': 400}
+
+    return {'success': True, 'algorithm': algorithm, 'digest': digest}
+
+
 def is_valid_pdf_base64(pdf_base64):
     try:
         pdf_data = base64.b64decode(pdf_base64, validate=True)
@@ -109,19 +212,24 @@ def validate_and_process_pdf_metadata(request_data, txn_id):
     
 
 
-    # Define file path
-    if platform.system() == "Windows":
-        folder_path = r"D:\project\MX_Signer_Server\save\PIN"
-    else:
-        folder_path = "/home/managex/Projects/MX_Signer_Server/save/PIN"
-
-    file_path = os.path.join(folder_path, SN)  # File name should be same as SN
+    file_path = os.path.join(PIN_FOLDER, SN)  # File name should be same as SN
 
     # Check if file exists
     if not os.path.isfile(file_path):
         log_transaction(txn_id, "failure", f"Serial No. [{SN}] not found please upload the PFX or check the serial no. with upload pfx")
         return {'error': f"Serial No. [{SN}] not found please upload the PFX or check the serial no. with upload pfx", 'status': 404}
 
+    # Reuse the parsed PIN file while it is unchanged on disk
+    mtime = os.stat(file_path).st_mtime_ns
+    cached = pin_file_cache.get(SN)
+    if cached and cached['mtime'] == mtime:
+        return {
+            'success': True,
+            'SN': SN,
+            'file_path': cached['file_path'],
+            'file_pin': cached['file_pin'],
+        }
+
     # Read and process file content
     try:
         with open(file_path, "r", encoding="utf-8") as file:
@@ -134,7 +242,7 @@ def validate_and_process_pdf_metadata(request_data, txn_id):
             file_path_value = file_path_match.group(1) if file_path_match else None
             file_pin_value = file_pin_match.group(1) if file_pin_match else None
 
-
+        pin_file_cache[SN] = {'mtime': mtime, 'file_path': file_path_value, 'file_pin': file_pin_value}
 
     except Exception as e:
         log_transaction(txn_id, "failure", f"Error reading file {SN}: {str(e)}")
@@ -152,26 +260,28 @@ def validate_and_process_pdf_metadata(request_data, txn_id):
     }
 
 
-def validate_and_process_pdf_page_data(request_data, pdf_data, txn_id):
-    page_number = request_data.get('request', {}).get('pdf', {}).get('page', 1)
-    total_pages = get_pdf_page_count(pdf_data)
-
-    logging.info(f"Total Pages in PDF: {total_pages}")
-
-    invisible_sign = request_data.get('request', {}).get('pdf', {}).get('invisiblesign', '').strip().lower()
-
+def resolve_page_numbers(page_number, total_pages, txn_id):
+    """
+    Turn a user-facing page (1-based number, "first", "last" or "all") into zero-based page indexes.
+    """
     # Validate page number
     if page_number is None or page_number == '':
         log_transaction(txn_id, "failure", 'Please select a page number.')
         return {'error': 'Please select a page number.', 'status': 400}
 
-    # Handle special values "first" and "last"
+    # Handle special values "first", "last" and "all"
     if isinstance(page_number, str):
         page_number = page_number.strip().lower()
         if page_number == 'first':
             page_number = 1  # User-facing first page is 1
         elif page_number == 'last':
             page_number = total_pages  # User-facing last page is total_pages
+        elif page_number == 'all':
+            # A PDF whose pages could not be read probes as 0 pages
+            if total_pages < 1:
+                log_transaction(txn_id, "failure", 'Page Limit Exceeded.')
+                return {'error': 'Page Limit Exceeded.', 'status': 400}
+            return {'success': True, 'pages': list(range(total_pages))}
         else:
             # Try to convert the string to an integer
             try:
@@ -184,28 +294,143 @@ def validate_and_process_pdf_page_data(request_data, pdf_data, txn_id):
     if page_number < 1 or page_number > total_pages:
         log_transaction(txn_id, "failure", 'Page Limit Exceeded.')
         return {'error': 'Page Limit Exceeded.', 'status': 400}
-    sigpage = page_number - 1  # Convert to zero-based index
+    return {'success': True, 'pages': [page_number - 1]}  # Convert to zero-based index
 
-    # Get coordinates and search_by_text
-    coordinates = request_data.get('request', {}).get('pdf', {}).get('coordinates', '')
-    
 
+def parse_coordinates(coordinates, txn_id):
+    """Parse an "x1,y1,x2,y2" string (blank means Default_Coordinates) into a list of ints."""
     # If coordinates are blank, set default value
     if not coordinates:
         coordinates = Default_Coordinates
 
-    found_coordinates = None
+    try:
+        coordinates = [int(coord) for coord in str(coordinates).split(',')]
+    except ValueError:
+        log_transaction(txn_id, "failure", 'Invalid coordinates format.')
+        return {'error': 'Invalid coordinates format.', 'status': 400}
+    if len(coordinates) != 4:
+        log_transaction(txn_id, "failure", 'Invalid coordinates format.')
+        return {'error': 'Invalid coordinates format.', 'status': 400}
+    return {'success': True, 'coordinates': coordinates}
+
+
+def validate_placements(placements, total_pages, txn_id):
+    """
+    Expand pdf.placements, a list of {"page": ..., "coordinates": "x1,y1,x2,y2"}, into
+    (zero-based page, box) pairs; "all" places the box on every page. Repeated pairs are dropped.
+    """
+    if not isinstance(placements, list) or not placements:
+        log_transaction(txn_id, "failure", 'Invalid placements.')
+        return {'error': 'placements must be a non-empty list of {"page", "coordinates"} objects.', 'status': 400}
+
+    expanded = []
+    for placement in placements:
+        if not isinstance(placement, dict):
+            log_transaction(txn_id, "failure", 'Invalid placements.')
+            return {'error': 'placements must be a non-empty list of {"page", "coordinates"} objects.', 'status': 400}
+
+        pages_result = resolve_page_numbers(placement.get('page', 1), total_pages, txn_id)
+        if 'error' in pages_result:
+            return pages_result
+        coordinates_result = parse_coordinates(placement.get('coordinates', ''), txn_id)
+        if 'error' in coordinates_result:
+            return coordinates_result
+
+        box = tuple(coordinates_result['coordinates'])
+        expanded.extend((page, box) for page in pages_result['pages'])
+        if len(expanded) > MAX_SIGNATURE_PLACEMENTS:
+            log_transaction(txn_id, "failure", 'Too many signature placements.')
+            return {'error': f'A signature can be placed at most {MAX_SIGNATURE_PLACEMENTS} times.', 'status': 400}
+
+    unique = list(dict.fromkeys(expanded))
+    return {'success': True, 'placements': [(page, list(box)) for page, box in unique]}
+
+
+def search_signature_placements(pdf_options, pdf_data, pages, txn_id):
+    """
+    Place the signature next to pdf.search_text, searching only the given pages (at most
+    SEARCH_TEXT_MAX_PAGES of them). pdf.search_position and pdf.search_occurrence choose
+    where the box goes and which matches are used.
+    """
+    search_text = pdf_options.get('search_text')
+    if not isinstance(search_text, str) or not search_text.strip() or len(search_text) > 200:
+        log_transaction(txn_id, "failure", 'Invalid search text.')
+        return {'error': 'search_text must be a non-empty string of at most 200 characters.', 'status': 400}
+
+    position = str(pdf_options.get('search_position') or 'below').strip().lower()
+    if position not in SEARCH_POSITIONS:
+        log_transaction(txn_id, "failure", 'Invalid search position.')
+        return {'error': f"Invalid search_position. Use one of: {', '.join(SEARCH_POSITIONS)}.", 'status': 400}
+
+    occurrence = str(pdf_options.get('search_occurrence') or 'first').strip().lower()
+    if occurrence not in SEARCH_OCCURRENCES:
+        log_transaction(txn_id, "failure", 'Invalid search occurrence.')
+        return {'error': f"Invalid search_occurrence. Use one of: {', '.join(SEARCH_OCCURRENCES)}.", 'status': 400}
 
-    
+    try:
+        with time_stage('text_search'):
+            found = find_signature_boxes(pdf_data, search_text, pages[:SEARCH_TEXT_MAX_PAGES], position, occurrence)
+    except Exception as e:
+        log_transaction(txn_id, "failure", f"Error searching PDF text: {str(e)}")
+        return {'error': f"Error searching PDF text: {str(e)}", 'status': 500}
+
+    if not found:
+        log_transaction(txn_id, "failure", 'Search text not found.')
+        return {'error': 'Search text not found in the PDF.', 'status': 400}
+    return {'success': True, 'placements': found}
+
+
+def validate_and_process_pdf_page_data(request_data, pdf_data, txn_id):
+    pdf_options = request_data.get('request', {}).get('pdf', {})
+    page_number = pdf_options.get('page', 1)
+    with time_stage('page_count'):
+        probe = probe_pdf(pdf_data)
+    total_pages = probe['page_count']
 
-    # If coordinates are provided, ensure they are in valid format
-    if coordinates:
+    logging.info(f"Total Pages in PDF: {total_pages}")
+
+    invisible_sign = pdf_options.get('invisiblesign', '').strip().lower()
+
+    pages_result = resolve_page_numbers(page_number, total_pages, txn_id)
+    if 'error' in pages_result:
+        return pages_result
+    sigpage = pages_result['pages'][0]
+
+    # Appearance template and date format of a visible signature
+    appearance = request_data.get('request', {}).get('pdf', {}).get('appearance')
+    if appearance and appearance not in Appearance_Templates:
+        log_transaction(txn_id, "failure", 'Invalid appearance template.')
+        return {'error': f"Invalid appearance. Use one of: {', '.join(Appearance_Templates)}.", 'status': 400}
+
+    date_format = request_data.get('request', {}).get('pdf', {}).get('date_format')
+    if date_format and (not isinstance(date_format, str) or len(date_format) > 64):
+        log_transaction(txn_id, "failure", 'Invalid date format.')
+        return {'error': 'Invalid date_format.', 'status': 400}
+    if date_format:
         try:
-            coordinates = [int(coord) for coord in coordinates.split(',')]
-        except ValueError:
-            log_transaction(txn_id, "failure", 'Invalid coordinates format.')
-            return {'error': 'Invalid coordinates format.', 'status': 400}
-        
+            parse_date_format(date_format)
+        except ValueError as e:
+            log_transaction(txn_id, "failure", f'Invalid date format: {e}')
+            return {'error': f'Invalid date_format: {e}.', 'status': 400}
+
+    # Get coordinates and search_by_text
+    coordinates_result = parse_coordinates(pdf_options.get('coordinates', ''), txn_id)
+    if 'error' in coordinates_result:
+        return coordinates_result
+    coordinates = coordinates_result['coordinates']
+
+    found_coordinates = None
+    found_placements = None
+
+    if pdf_options.get('search_text'):
+        # An explicit page limits the search to it; otherwise pages are searched from the start
+        search_pages = pages_result['pages'] if 'page' in pdf_options else list(range(total_pages))
+        search_result = search_signature_placements(pdf_options, pdf_data, search_pages, txn_id)
+        if 'error' in search_result:
+            return search_result
+        found_placements = search_result['placements']
+        sigpage, found_coordinates = found_placements[0]
+
     # Set signaturebox based on conditions
     if found_coordinates:
         # Use found coordinates from search
@@ -216,11 +441,22 @@ def validate_and_process_pdf_page_data(request_data, pdf_data, txn_id):
     else:
         signaturebox = None  # Default to None if no coordinates are found or provided
 
-
-
-
-
-
+    # Every (page, box) the signature appears at: pdf.placements, or the page(s) and box above
+    placements = None
+    if signaturebox is not None:
+        if found_placements:
+            placements = found_placements
+        elif pdf_options.get('placements') is not None:
+            placements_result = validate_placements(pdf_options['placements'], total_pages, txn_id)
+            if 'error' in placements_result:
+                return placements_result
+            placements = placements_result['placements']
+        else:
+            placements = [(page, signaturebox) for page in pages_result['pages']]
+        if len(placements) > MAX_SIGNATURE_PLACEMENTS:
+            log_transaction(txn_id, "failure", 'Too many signature placements.')
+            return {'error': f'A signature can be placed at most {MAX_SIGNATURE_PLACEMENTS} times.', 'status': 400}
+        sigpage, signaturebox = placements[0]
 
 
     return {
@@ -228,7 +464,10 @@ def validate_and_process_pdf_page_data(request_data, pdf_data, txn_id):
         'sigpage': sigpage,
         'coordinates': coordinates if not found_coordinates else found_coordinates,
         'signaturebox': signaturebox,
+        'placements': placements,
         'invisible_sign': invisible_sign,
+        'appearance': appearance,
+        'date_format': date_format,
     }
 
 